@@ -8,11 +8,36 @@
 #
 
 
-from trac.admin import IAdminPanelProvider
+from trac.admin import IAdminCommandProvider, IAdminPanelProvider
 from trac.core import Component, implements
+from trac.util.text import printout
 from trac.web.chrome import Chrome
 
 from tractags.api import TagSystem, _
+from tractags.model import update_sort_keys
+from tractags.wiki import WikiTagProvider
+
+
+class TagAdminCommands(Component):
+    """[main] Console commands for maintaining tag system data."""
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('tags resync', '',
+               'Re-synchronize precomputed descriptions of tagged wiki pages '
+               'and sort keys of tagged resources',
+               None, self._do_resync)
+
+    def _do_resync(self):
+        count = WikiTagProvider(self.env).sync_descriptions()
+        self.log.info("Synchronized %d wiki page descriptions", count)
+        printout(_("%(num)d wiki page descriptions synchronized.",
+                   num=count))
+        count = update_sort_keys(self.env)
+        self.log.info("Added sort keys of %d tagged resources", count)
+        printout(_("%(num)d resource sort keys added.", num=count))
 
 
 class TagChangeAdminPanel(Component):
@@ -59,9 +84,7 @@ class TagChangeAdminPanel(Component):
                                            allow_delete, filter=checked_realms)
                 data['selected'] = new_tag
 
-        query = ' or '.join(['realm:%s' % r for r in checked_realms])
-        all_tags = sorted(tag_system.get_all_tags(req, query))
-        data['tags'] = all_tags
+        data['tags'] = tag_system.get_tag_names(req, checked_realms)
         try:
             Chrome(self.env).add_textarea_grips(req)
         except AttributeError:
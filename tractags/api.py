@@ -10,26 +10,33 @@
 #
 
 import re
+import time
 try:
     import threading
 except ImportError:
     import dummy_threading as threading
     threading._get_ident = lambda: 0
 
+from bisect import bisect_left
+from heapq import merge, nsmallest
+from itertools import islice
 from operator import itemgetter
 from pkg_resources import resource_filename
 
-from trac.config import BoolOption, ListOption, Option
+from trac.cache import cached
+from trac.config import BoolOption, ChoiceOption, IntOption, ListOption
+from trac.config import Option
 from trac.core import Component, ExtensionPoint, Interface, TracError
 from trac.core import implements
 from trac.perm import IPermissionPolicy, IPermissionRequestor
 from trac.perm import PermissionError, PermissionSystem
-from trac.resource import IResourceManager, get_resource_url
+from trac.resource import IResourceManager, Resource, get_resource_url
 from trac.resource import get_resource_description
-from trac.util import get_reporter_id
+from trac.util import embedded_numbers, get_reporter_id
 from trac.util.text import to_unicode
 from trac.util.translation import domain_functions
-from trac.wiki.model import WikiPage
+from trac.web.session import DetachedSession
+from trac.wiki.api import IWikiChangeListener
 
 # Import translation functions.
 add_domain, _, N_, gettext, ngettext, tag_, tagn_ = \
@@ -37,13 +44,22 @@ add_domain, _, N_, gettext, ngettext, tag_, tagn_ = \
                                   'ngettext', 'tag_', 'tagn_'))
 dgettext = None
 
-from tractags.model import resource_tags, tag_frequency, tag_resource
-from tractags.model import tagged_resources
+from tractags.index import TagIndex
+from tractags.model import names_filter, resource_tags, tag_frequencies
+from tractags.model import tag_frequency
+from tractags.model import tag_resource, tagged_resource_count
+from tractags.model import sorted_tagged_resources, tagged_resource_exists
+from tractags.model import tagged_resources, tags_generation
 # Now call module importing i18n methods from here.
 from tractags.query import *
+from tractags.util import LRUCache
 
 REALM_RE = re.compile('realm:(\w+)', re.U | re.I)
 
+# Maximum number of resource IDs to pass as bound parameters of a db query.
+# SQLite before 3.32 allows no more than 999 parameters per statement.
+MAX_NAMES_FILTER = 500
+
 
 class Counter(dict):
     """Dict subclass for counting hashable objects.
@@ -180,15 +196,23 @@ class ITagProvider(Interface):
 
         :param tags: If provided, return only those resources with the given
                      tags.
-        :param filter: If provided, skip matching resources.
+        :param filter: If provided, a sequence of SQL conditions on the `tags`
+                       db table (see `tractags.model.filter_sql`) to skip
+                       resources not satisfying all of them. Providers may
+                       ignore it, because results are matched against the
+                       query afterwards anyway.
 
         :rtype: Sequence of (resource, tags) tuples.
         """
 
-    def get_all_tags(req, filter=None):
+    def get_all_tags(req, filter=None, mincount=None, limit=None):
         """Return all tags with numbers of occurance.
 
         :param filter: If provided, skip matching resources.
+        :param mincount: If provided, skip tags occurring less often.
+        :param limit: If provided, return only as many most frequent tags.
+
+        Providers may omit the `mincount` and `limit` arguments.
 
         :rtype: Counter object (dict sub-class: {tag_name: tag_frequency} ).
 
@@ -212,6 +236,76 @@ class ITagProvider(Interface):
     def describe_tagged_resource(req, resource):
         """Return a one line description of the tagged resource."""
 
+    def describe_tagged_resources(req, resources):
+        """Return one line descriptions for a sequence of tagged resources.
+
+        Optional, batch counterpart of `describe_tagged_resource()` for
+        fetching all descriptions at once.
+
+        :rtype: dict with resource IDs as keys.
+        """
+
+
+def uses_default_permission_policies(config):
+    """Whether only Trac's default permission policies are configured.
+
+    Permissions for viewing resources are independent of resource IDs then,
+    so checking them once per realm is sufficient.
+    """
+    default_policies = _default_permission_policies(config)
+    return all(p in default_policies
+               for p in config.getlist('trac', 'permission_policies'))
+
+
+def _default_permission_policies(config):
+    """Names of Trac's default permission policies."""
+    default = config.defaults().get('trac', {}).get('permission_policies')
+    return set(p.strip() for p in (default or '').split(','))
+
+
+def _contains(names, name):
+    """Whether a sorted tuple of names contains a name."""
+    i = bisect_left(names, name)
+    return i < len(names) and names[i] == name
+
+
+def _counts_in_bulk(provider):
+    """Whether tags of the provider's realm may be counted right in the tags
+    db table together with other realms, instead of by `get_all_tags()`.
+    """
+    return isinstance(provider, DefaultTagProvider) and \
+           provider.get_all_tags.im_func is \
+           DefaultTagProvider.get_all_tags.im_func
+
+
+def _by_frequency(item):
+    """Sort key for (tag, count) tuples, most frequent tags first."""
+    return -item[1], item[0]
+
+
+def _sort_key(realm, id):
+    """Sort key for natural order of resources by ID, then by realm."""
+    id = to_unicode(id)
+    return embedded_numbers(id), realm, id
+
+
+class ITagChangeListener(Interface):
+    """Extension point interface for components, that require notification
+    when resource tags are changed by a tag provider.
+
+    Tag changes made by other means only increment the tag generation (see
+    `tractags.model.tags_generation`), so listeners keeping cached data must
+    validate it against the generation anyway.
+    """
+
+    def tags_changed(resource, tags, generation, old_id=None):
+        """Called after the tags of a resource have been changed.
+
+        :param tags: set of all current resource tags, or `None` if tags
+                     have been moved unchanged from resource `old_id`.
+        :param generation: tag generation number after the change.
+        """
+
 
 class DefaultTagProvider(Component):
     """An abstract base tag provider that stores tags in the database.
@@ -235,6 +329,7 @@ class DefaultTagProvider(Component):
         # Do this once, because configuration lookups are costly.
         cfg = self.env.config
         self.revisable = self.realm in cfg.getlist('tags', 'revisable_realms')
+        self.fast_permcheck = uses_default_permission_policies(cfg)
 
     # Public methods
 
@@ -247,6 +342,59 @@ class DefaultTagProvider(Component):
         map = {'view': 'TAGS_VIEW', 'modify': 'TAGS_MODIFY'}
         return map[action] in perm('tag')
 
+    def get_sorted_tagged_resources(self, req, tags=None, filter=None,
+                                    start=None):
+        """Return tagged resources like `get_tagged_resources()`, but lazily
+        and in natural order of resource IDs.
+
+        :param start: if provided, skip resources sorting before this ID.
+        """
+        if not self.check_permission(req.perm, 'view'):
+            return []
+        perm_filter = None
+        if not self.fast_permcheck:
+            perm_filter = lambda resources: \
+                          self.permitted_resources(req, resources, 'view')
+        return sorted_tagged_resources(self.env, self.realm, tags, filter,
+                                       start, perm_filter)
+
+    def permitted_resources(self, req, resources, action):
+        """Return the resources of a list, for which `action` is allowed.
+
+        Override together with `check_permission()` to check permissions
+        of many resources at once.
+        """
+        return [resource for resource in resources
+                if self.check_permission(req.perm(resource), action)]
+
+    def count_tagged_resources(self, req, filter=None):
+        """Return the number of tagged resources matching all conditions.
+
+        View permission is checked once for the whole realm, so callers must
+        fall back to `get_tagged_resources()` unless `fast_permcheck` is set.
+        """
+        if not self.check_permission(req.perm(self.realm), 'view'):
+            return 0
+        return tagged_resource_count(self.env, self.realm, filter)
+
+    def has_tagged_resources(self, req, filter=None):
+        """Return whether any tagged resource matches all conditions.
+
+        Same restrictions as for `count_tagged_resources()` apply.
+        """
+        if not self.check_permission(req.perm(self.realm), 'view'):
+            return False
+        return tagged_resource_exists(self.env, self.realm, filter)
+
+    def get_last_change(self):
+        """Return the time of the latest change to any resource of the
+        realm as timestamp in microseconds, or `None` if unknown.
+
+        Used to revalidate cached listings of tagged resources, that show
+        resource details besides tags.
+        """
+        return None
+
     # ITagProvider methods
 
     def get_taggable_realm(self):
@@ -256,11 +404,18 @@ class DefaultTagProvider(Component):
         if not self.check_permission(req.perm, 'view'):
             return
         return tagged_resources(self.env, self.check_permission, req.perm,
-                                self.realm, tags, filter)
+                                self.realm, tags, filter,
+                                perm_filter=lambda resources:
+                                    self.permitted_resources(req, resources,
+                                                             'view'))
 
-    def get_all_tags(self, req, filter=None):
+    def get_all_tags(self, req, filter=None, mincount=None, limit=None):
         all_tags = Counter()
-        for tag, count in tag_frequency(self.env, self.realm, filter):
+        filter = self._get_all_tags_filter(req, filter)
+        if filter is None:
+            return all_tags
+        for tag, count in tag_frequency(self.env, self.realm, filter,
+                                        mincount=mincount, limit=limit):
             all_tags[tag] = count
         return all_tags
 
@@ -278,58 +433,136 @@ class DefaultTagProvider(Component):
         assert resource.realm == self.realm
         if not self.check_permission(req.perm(resource), 'modify'):
             raise PermissionError(resource=resource, env=self.env)
-        tag_resource(self.env, resource, author=self._get_author(req),
-                     tags=tags, log=self.revisable, when=when)
+        author = self._get_author(req)
+        tag_system = TagSystem(self.env)
+        added = None
+        if tag_system.recent_tags_size and author != 'anonymous':
+            added = set(tags or ()) - set(resource_tags(self.env, resource))
+        generation = tag_resource(self.env, resource, author=author,
+                                  tags=tags, log=self.revisable, when=when)
+        self._tags_changed(resource, set(tags or ()), generation)
+        if added:
+            tag_system._remember_tags(req, author, added)
 
     def reparent_resource_tags(self, req, resource, old_id, comment=u''):
         assert resource.realm == self.realm
         if not self.check_permission(req.perm(resource), 'modify'):
             raise PermissionError(resource=resource, env=self.env)
-        tag_resource(self.env, resource, old_id, self._get_author(req),
-                     log=self.revisable)
+        generation = tag_resource(self.env, resource, old_id,
+                                  self._get_author(req), log=self.revisable)
+        self._tags_changed(resource, None, generation, old_id)
 
     def remove_resource_tags(self, req, resource, comment=u''):
         assert resource.realm == self.realm
         if not self.check_permission(req.perm(resource), 'modify'):
             raise PermissionError(resource=resource, env=self.env)
-        tag_resource(self.env, resource, author=self._get_author(req),
-                     log=self.revisable)
+        generation = tag_resource(self.env, resource,
+                                  author=self._get_author(req),
+                                  log=self.revisable)
+        self._tags_changed(resource, set(), generation)
 
     def describe_tagged_resource(self, req, resource):
         raise NotImplementedError
 
+    def describe_tagged_resources(self, req, resources):
+        return dict((resource.id, self.describe_tagged_resource(req, resource))
+                    for resource in resources)
+
+    def _get_all_tags_filter(self, req, filter=None):
+        """Return resource conditions for counting tags of the realm, or
+        None, if the user may not view tags of the realm at all.
+
+        Override this rather than `get_all_tags()`, so that `TagSystem` can
+        keep counting tags of all realms by a single db query.
+        """
+        return filter or []
+
     def _get_author(self, req):
         return get_reporter_id(req, 'author')
 
+    def _tags_changed(self, resource, tags, generation, old_id=None):
+        if generation is not None:
+            for listener in TagSystem(self.env).change_listeners:
+                listener.tags_changed(resource, tags, generation, old_id)
+
 
 class TagPolicy(Component):
     """[extra] Security policy based on tags."""
 
-    implements(IPermissionPolicy)
+    implements(IPermissionPolicy, ITagChangeListener)
 
     def check_permission(self, action, username, resource, perm):
         if resource is None or action.split('_')[0] != resource.realm.upper():
             return None
+        return self._check_acl(action, username, resource)
+
+    def check_permissions(self, action, username, resources, perm):
+        """Batch version of `check_permission()` for resources of a realm.
+
+        Returns a dict of decisions by resource ID.
+        """
+        realm = resources[0].realm
+        if action.split('_')[0] != realm.upper():
+            return None
+        return dict((resource.id, self._check_acl(action, username, resource))
+                    for resource in resources)
+
+    # ITagChangeListener method
+    def tags_changed(self, resource, tags, generation, old_id=None):
+        keys = [(resource.realm, to_unicode(resource.id))]
+        if old_id is not None:
+            keys.append((resource.realm, to_unicode(old_id)))
+        acl = self._acl
+        if any(':' in tag for tag in tags or ()) or \
+                any(key in acl for key in keys):
+            # Permissions changed, rebuild the index in all processes.
+            del self._acl
 
-        from tractags.api import TagSystem
+    # Internal methods
 
-        class FakeRequest(object):
-            def __init__(self, perm):
-                self.perm = perm
+    @cached
+    def _acl(self):
+        """Index of tagged permissions by (realm, id) of resources.
 
-        permission = action.lower().split('_')[1]
-        req = FakeRequest(perm)
-        tags = TagSystem(self.env).get_tags(None, resource)
+        Values are tuples of a dict of granted actions by username, with
+        meta actions expanded, and a dict of denied permissions by username.
+        The index relies on `tags_changed()` notifications, so all writes to
+        the tags db table must notify listeners.
+        """
+        acl_tags = {}
+        with self.env.db_query as db:
+            for realm, name, tag in db("""
+                    SELECT tagspace, name, tag FROM tags WHERE tag %s
+                    """ % db.like(), ('%:%',)):
+                username, permission = tag.split(':', 1)
+                acl_tags.setdefault((realm, name), {}) \
+                        .setdefault(username, []).append(permission)
+        perm_system = PermissionSystem(self.env)
+        acl = {}
+        for (realm, name), permissions in acl_tags.iteritems():
+            granted = {}
+            denied = {}
+            for username, user_permissions in permissions.iteritems():
+                granted[username] = frozenset(perm_system.expand_actions(
+                    ['_'.join([realm, p.split(':')[0]]).upper()
+                     for p in user_permissions]))
+                denied[username] = frozenset(p[1:] for p in user_permissions
+                                             if p.startswith('-'))
+            acl[(realm, name)] = (granted, denied)
+        return acl
+
+    def _check_acl(self, action, username, resource):
+        entry = self._acl.get((resource.realm, to_unicode(resource.id)))
+        if entry is None:
+            return None
+        granted, denied = entry
 
         # Explicitly denied?
-        if ':-'.join((username, permission)) in tags:
+        if action.lower().split('_')[1] in denied.get(username, ()):
             return False
 
-        # Find all granted permissions for the requesting user from
-        # tagged permissions by expanding any meta action as well.
-        if action in set(PermissionSystem(self.env).expand_actions(
-                         ['_'.join([resource.realm, t.split(':')[1]]).upper()
-                          for t in tags if t.split(':')[0] == username])):
+        # Granted by tagged permissions, including meta actions?
+        if action in granted.get(username, ()):
             return True
 
 
@@ -349,8 +582,10 @@ class TagSystem(Component):
     activating `[extra]` components.
     """
 
-    implements(IPermissionRequestor, IResourceManager)
+    implements(IPermissionRequestor, IResourceManager, ITagChangeListener,
+               IWikiChangeListener)
 
+    change_listeners = ExtensionPoint(ITagChangeListener)
     tag_providers = ExtensionPoint(ITagProvider)
 
     revisable = ListOption('tags', 'revisable_realms', 'wiki',
@@ -359,6 +594,29 @@ class TagSystem(Component):
         doc="Link a tag to the wiki page with same name, if it exists.")
     wiki_page_prefix = Option('tags', 'wiki_page_prefix', '',
         doc="Prefix for tag wiki page names.")
+    query_engine = ChoiceOption('tags', 'query_engine', ['default', 'bitmap'],
+        doc="""Evaluation engine for tag queries.
+
+            `bitmap` evaluates queries against an in-memory index with a
+            bitmap of tagged resources per tag, so that only matching
+            resources get fetched and permission checked. It trades
+            memory for speed with large numbers of tagged resources.
+            """)
+    permission_cache_time = IntOption('tags', 'permission_cache_time', 0,
+        doc="""Number of seconds to reuse the set of tagged resources, that
+            a user may view, for permission policies deciding per resource.
+
+            Sets are refreshed on changes of tags, user permissions or
+            configured policies anyway, but not on other changes, that
+            policies might depend on, e.g. ticket fields. `0` disables
+            the cache, so that each permission is checked on demand.
+            """)
+
+    recent_tags_size = IntOption('tags', 'recent_tags_size', 10,
+        doc="""Number of tags most recently applied by each user to
+            remember in the user's session, for ranking them first in
+            tag suggestions. `0` disables this.
+            """)
 
     # Internal variables
     _realm_provider_map = None
@@ -369,6 +627,8 @@ class TagSystem(Component):
         add_domain(self.env.path, locale_dir)
 
         self._populate_provider_map()
+        self._index = TagIndex()
+        self._visible = LRUCache(1000)
 
     # Public methods
 
@@ -381,55 +641,291 @@ class TagSystem(Component):
                                    handlers. See Query documentation for more
                                    information.
         """
-        def realm_handler(_, node, context):
-            return query.match(node, [context.realm])
-
-        all_attribute_handlers = {
-            'realm': realm_handler,
-        }
-        all_attribute_handlers.update(attribute_handlers or {})
-        query = Query(query, attribute_handlers=all_attribute_handlers)
-        providers = set()
-        for m in REALM_RE.finditer(query.as_string()):
-            realm = m.group(1)
-            providers.add(self._get_provider(realm))
-        if not providers:
-            providers = self.tag_providers
-
-        query_tags = set(query.terms())
-        for provider in providers:
+        query = self._parse_query(query, attribute_handlers)
+        index = self._get_index()
+        for provider in self.tag_providers:
+            prefilter = self._prefilter(query, provider, index)
+            if prefilter is None:
+                continue
+            tags, filter = prefilter
             self.env.log.debug('Querying ' + repr(provider))
-            for resource, tags in provider.get_tagged_resources(req,
-                                                          query_tags) or []:
+            for resource, tags in provider.get_tagged_resources(req, tags,
+                                                                filter) or []:
                 if query(tags, context=resource):
                     yield resource, tags
 
-    def get_taggable_realms(self, perm=None):
+    def get_query_tags(self, req, query, attribute_handlers=None):
+        """Get all tags of resources matching a query.
+
+        Returns a Counter object (special dict) with tag name as key and tag
+        frequency as value, like `get_all_tags()`. Where permissions can be
+        checked per realm and the query compiles to SQL or is evaluated by
+        the tag index (see `query_engine` option), tags are counted by one
+        aggregate db query per realm instead of enumerating all matching
+        resources.
+        """
+        query = self._parse_query(query, attribute_handlers)
+        index = self._get_index()
+        all_tags = Counter()
+        for provider in self.tag_providers:
+            prefilter = self._prefilter(query, provider, index)
+            if prefilter is None:
+                continue
+            filter = self._exact_filter(provider, *prefilter)
+            if filter is not None:
+                realm = provider.get_taggable_realm()
+                if provider.check_permission(req.perm(realm), 'view'):
+                    all_tags.update(provider.get_all_tags(req, filter))
+                continue
+            tags, filter = prefilter
+            for resource, tags in provider.get_tagged_resources(req, tags,
+                                                                filter) or []:
+                if query(tags, context=resource):
+                    all_tags.update(tags)
+        return all_tags
+
+    def query_page(self, req, query, limit, after=None, offset=0,
+                   attribute_handlers=None):
+        """Return a page of resources matching a query.
+
+        Results are (resource, tags) tuples like for `query()`, sorted in
+        natural order of resource IDs. Each tag provider yields its results
+        already sorted, and only as many of them are loaded, as required for
+        the requested page.
+
+        :param limit: maximum number of results to return.
+        :param after: (realm, id) tuple of the last resource of the previous
+                      page, to resume from.
+        :param offset: number of results to skip (after `after`).
+        """
+        query = self._parse_query(query, attribute_handlers)
+        index = self._get_index()
+        start = after_key = None
+        if after is not None:
+            start = after[1]
+            after_key = _sort_key(*after)
+        streams = []
+        for provider in self.tag_providers:
+            prefilter = self._prefilter(query, provider, index)
+            if prefilter is None:
+                continue
+            tags, filter = prefilter
+            streams.append(self._sorted_results(req, provider, tags, filter,
+                                                start))
+        results = ((resource, tags) for key, resource, tags in merge(*streams)
+                   if (after_key is None or key > after_key) and
+                      query(tags, context=resource))
+        return list(islice(results, offset, offset + limit))
+
+    def query_count(self, req, query, attribute_handlers=None):
+        """Return the number of resources matching a query.
+
+        Same as counting results of `query()`, but evaluated by one db query
+        per realm, where permissions can be checked per realm.
+        """
+        query = self._parse_query(query, attribute_handlers)
+        index = self._get_index()
+        count = 0
+        for provider in self.tag_providers:
+            prefilter = self._prefilter(query, provider, index)
+            if prefilter is None:
+                continue
+            filter = self._exact_filter(provider, *prefilter)
+            if filter is not None:
+                count += provider.count_tagged_resources(req, filter)
+                continue
+            tags, filter = prefilter
+            for resource, tags in provider.get_tagged_resources(req, tags,
+                                                                filter) or []:
+                if query(tags, context=resource):
+                    count += 1
+        return count
+
+    def query_exists(self, req, query, attribute_handlers=None):
+        """Return whether any resource matches a query.
+
+        Like `query_count()`, but stops at the first match.
+        """
+        query = self._parse_query(query, attribute_handlers)
+        index = self._get_index()
+        for provider in self.tag_providers:
+            prefilter = self._prefilter(query, provider, index)
+            if prefilter is None:
+                continue
+            filter = self._exact_filter(provider, *prefilter)
+            if filter is not None:
+                if provider.has_tagged_resources(req, filter):
+                    return True
+                continue
+            tags, filter = prefilter
+            for resource, tags in provider.get_tagged_resources(req, tags,
+                                                                filter) or []:
+                if query(tags, context=resource):
+                    return True
+        return False
+
+    def permitted_resources(self, req, resources, action):
+        """Return the resources of a sequence, for which `action` is allowed.
+
+        Permissions are checked like by `PermissionSystem`, but for many
+        resources at once: Trac's default policies decide once per realm,
+        and policies with a `check_permissions(action, username, resources,
+        perm)` method once per realm too. That method returns a dict of
+        decisions by resource ID or a single decision for all resources.
+        Decisions are reused for the rest of the request, and for tagged
+        resources up to `permission_cache_time` seconds for later requests.
+        """
+        resources = list(resources)
+        decisions = self._memoize(req, ('permissions', action), dict)
+        pending = {}
+        for resource in resources:
+            key = (resource.realm, to_unicode(resource.id))
+            if key not in decisions:
+                pending.setdefault(resource.realm, []).append(resource)
+        for realm, realm_resources in pending.iteritems():
+            if self.permission_cache_time and \
+                    not uses_default_permission_policies(self.config):
+                allowed, denied = self._get_visible(req, realm, action)
+                unknown = []
+                for resource in realm_resources:
+                    name = to_unicode(resource.id)
+                    if _contains(allowed, name):
+                        decisions[(realm, name)] = True
+                    elif _contains(denied, name):
+                        decisions[(realm, name)] = False
+                    else:
+                        unknown.append(resource)
+                realm_resources = unknown
+            if realm_resources:
+                for id, allowed in self._check_policies(
+                        req, realm, realm_resources, action).iteritems():
+                    decisions[(realm, to_unicode(id))] = allowed
+        return [resource for resource in resources
+                if decisions[(resource.realm, to_unicode(resource.id))]]
+
+    def get_taggable_realms(self, perm=None, req=None):
         """Returns the names of available taggable realms as set.
 
         If a `PermissionCache` object is passed as optional `perm` argument,
         permission checks will be done for tag providers that have a
-        `check_permission` method.
+        `check_permission` method. Results are reused for the rest of the
+        request, if it is passed as optional `req` argument.
+        """
+        def get_realms():
+            return set(p.get_taggable_realm()
+                       for p in self.tag_providers
+                       if perm is None or
+                           not hasattr(p, 'check_permission') or
+                           p.check_permission(perm, 'view'))
+        if perm is None:
+            return get_realms()
+        # Keep a reference to `perm` for not reusing its id.
+        return set(self._memoize(req, ('realms', id(perm)),
+                                 lambda: (perm, get_realms()))[1])
+
+    def get_last_change(self, realms):
+        """Returns the time of the latest change to any resource of the
+        given realms as timestamp in microseconds, or `None` if a tag
+        provider can't tell.
         """
-        return set(p.get_taggable_realm()
-                   for p in self.tag_providers
-                   if perm is None or not hasattr(p, 'check_permission') or
-                       p.check_permission(perm, 'view'))
+        last_change = 0
+        for provider in self.tag_providers:
+            if provider.get_taggable_realm() in realms:
+                changed = getattr(provider, 'get_last_change',
+                                  lambda: None)()
+                if changed is None:
+                    return None
+                last_change = max(last_change, changed)
+        return last_change
+
+    def complete_tags(self, req, term='', limit=None, contains=False,
+                      realms=None):
+        """Returns (tag, count) tuples for tags starting with `term`, or also
+        containing it, if `contains` is set, ignoring case.
+
+        Tags starting with `term` rank first, then tags by descending
+        frequency. Tags of realms handled by `DefaultTagProvider` are looked
+        up in the in-memory tag index, others in the tag providers.
+        """
+        all_realms, indexed = self._get_indexed_realms(req, realms)
+        if len(indexed) == len(all_realms):
+            return self._index.complete(term, indexed, limit, contains)
 
-    def get_all_tags(self, req, realms=[]):
+        all_tags = Counter(dict(self._index.complete(term, indexed, None,
+                                                     contains)))
+        term = term.lower()
+        for provider in self.tag_providers:
+            if provider.get_taggable_realm() in all_realms and \
+                    provider.get_taggable_realm() not in indexed:
+                all_tags += Counter(dict((tag, count) for tag, count
+                                         in provider.get_all_tags(req)
+                                            .iteritems()
+                                         if tag.lower().startswith(term) or
+                                            contains and term in tag.lower()))
+        return sorted(all_tags.iteritems(),
+                      key=lambda (tag, count):
+                          (not tag.lower().startswith(term), -count, tag)
+                      )[:limit]
+
+    def get_tag_names(self, req, realms=None):
+        """Returns names of tags used in realms, or all realms, that the
+        user may view, sorted alphabetically ignoring case.
+        """
+        all_realms, indexed = self._get_indexed_realms(req, realms)
+        if len(indexed) == len(all_realms):
+            return self._index.tag_names(indexed)
+        return sorted(self.get_all_tags(req, all_realms),
+                      key=lambda tag: (tag.lower(), tag))
+
+    def get_recent_tags(self, req):
+        """Returns tags most recently applied by the user, latest first."""
+        recent = req.session.get('tags.recent', '').split()
+        return recent[:self.recent_tags_size]
+
+    def get_all_tags(self, req, realms=[], mincount=None, limit=None):
         """Get all tags for all supported realms or only for specified ones.
 
         Returns a Counter object (special dict) with tag name as key and tag
-        frequency as value.
+        frequency as value. Tags occurring less often than `mincount` are
+        skipped, and only `limit` most frequent tags are returned, if these
+        arguments are provided.
         """
-        all_tags = Counter()
-        all_realms = self.get_taggable_realms(req.perm)
+        all_realms = self.get_taggable_realms(req.perm, req)
         if not realms or set(realms) == all_realms:
             realms = all_realms
+        mincount = mincount and mincount > 1 and mincount or None
+        # Tags of providers storing them in the tags db table are counted
+        # by a single query across their realms.
+        realm_filters = []
+        providers = []
         for provider in self.tag_providers:
-            if provider.get_taggable_realm() in realms:
+            if provider.get_taggable_realm() not in realms:
+                continue
+            if _counts_in_bulk(provider):
+                filter = provider._get_all_tags_filter(req)
+                if filter is not None:
+                    realm_filters.append((provider.realm, filter))
+            else:
+                providers.append(provider)
+        # Where frequencies are final, let the db do the cut.
+        cut = {}
+        exact = not providers or not realm_filters and \
+                len(providers) == 1 and \
+                isinstance(providers[0], DefaultTagProvider)
+        if exact:
+            cut = {'mincount': mincount, 'limit': limit}
+        kwargs = not realm_filters and cut or {}
+
+        def get_all_tags():
+            all_tags = Counter()
+            if realm_filters:
+                for tag, count in tag_frequencies(self.env, realm_filters,
+                                                  **cut):
+                    all_tags[tag] = count
+            for provider in providers:
                 try:
-                    all_tags += provider.get_all_tags(req)
+                    # Counter.update() adds frequencies in-place.
+                    all_tags.update(provider.get_all_tags(req, **kwargs))
                 except AttributeError:
                     # Fallback for older providers.
                     try:
@@ -437,12 +933,25 @@ class TagSystem(Component):
                             provider.get_tagged_resources(req):
                                 all_tags.update(tags)
                     except TypeError:
-                        # Defense against loose ITagProvider implementations,
-                        # that might become obsolete in the future.
-                        self.env.log.warning('ITagProvider %r has outdated'
-                                             'get_tagged_resources() method' %
+                        # Defense against loose ITagProvider
+                        # implementations, that might become obsolete
+                        # in the future.
+                        self.env.log.warning('ITagProvider %r has '
+                                             'outdated get_tagged_'
+                                             'resources() method' %
                                              provider)
-        return all_tags
+            if exact:
+                return all_tags
+            if mincount:
+                for tag in [tag for tag, count in all_tags.iteritems()
+                            if count < mincount]:
+                    del all_tags[tag]
+            if limit and len(all_tags) > limit:
+                all_tags = Counter(dict(nsmallest(limit, all_tags.iteritems(),
+                                                  key=_by_frequency)))
+            return all_tags
+        return Counter(self._memoize(req, ('all_tags', frozenset(realms),
+                                           mincount, limit), get_all_tags))
 
     def get_tags(self, req, resource, when=None):
         """Get tags for resource."""
@@ -451,14 +960,18 @@ class TagSystem(Component):
             # an IPermissionProvider.
             return set(self._get_provider(resource.realm) \
                        .resource_tags(resource))
-        return set(self._get_provider(resource.realm) \
-                   .get_resource_tags(req, resource, when=when))
+        key = ('tags', resource.realm, to_unicode(resource.id), when)
+        provider = self._get_provider(resource.realm)
+        # Providers return nothing, if viewing the resource isn't allowed.
+        return set(self._memoize(req, key, lambda: set(
+            provider.get_resource_tags(req, resource, when=when) or ())))
 
     def set_tags(self, req, resource, tags, comment=u'', when=None):
         """Set tags on a resource.
 
         Existing tags are replaced.
         """
+        self._forget(req)
         try:
             return self._get_provider(resource.realm) \
                    .set_resource_tags(req, resource, set(tags), comment, when)
@@ -469,6 +982,7 @@ class TagSystem(Component):
 
     def add_tags(self, req, resource, tags, comment=u''):
         """Add to existing tags on a resource."""
+        self._forget(req)
         tags = set(tags)
         tags.update(self.get_tags(req, resource))
         try:
@@ -482,6 +996,7 @@ class TagSystem(Component):
 
         Tags can't be moved between different tag realms with intention.
         """
+        self._forget(req)
         provider = self._get_provider(resource.realm)
         provider.reparent_resource_tags(req, resource, old_name, comment)
 
@@ -515,6 +1030,7 @@ class TagSystem(Component):
 
         If tags is None, remove all tags on the resource.
         """
+        self._forget(req)
         provider = self._get_provider(resource.realm)
         if tags is None:
             try:
@@ -543,6 +1059,36 @@ class TagSystem(Component):
                               'describe_tagged_resource()' % provider)
             return get_resource_description(self.env, resource, 'summary')
 
+    def describe_tagged_resources(self, req, resources):
+        """Returns short descriptions for a sequence of taggable resources.
+
+        Descriptions are fetched at once per realm, where supported by the
+        tag provider, and returned as dict with (realm, id) tuples as keys.
+        """
+        realm_resources = {}
+        for resource in resources:
+            realm_resources.setdefault(resource.realm, []).append(resource)
+        descriptions = {}
+        for realm, resources in realm_resources.iteritems():
+            provider = self._get_provider(realm)
+            if hasattr(provider, 'describe_tagged_resources'):
+                try:
+                    for id, desc in provider.describe_tagged_resources(
+                            req, resources).iteritems():
+                        descriptions[(realm, id)] = desc
+                    continue
+                except NotImplementedError:
+                    pass
+            for resource in resources:
+                descriptions[(realm, resource.id)] = \
+                    self.describe_tagged_resource(req, resource)
+        return descriptions
+
+    # ITagChangeListener method
+    def tags_changed(self, resource, tags, generation, old_id=None):
+        self._index.update(resource.realm, resource.id, tags, generation,
+                           old_id)
+
     # IPermissionRequestor method
     def get_permission_actions(self):
         action = ['TAGS_VIEW', 'TAGS_MODIFY']
@@ -556,30 +1102,269 @@ class TagSystem(Component):
         yield 'tag'
 
     def get_resource_url(self, resource, href, form_realms=None, **kwargs):
-        if self.wiki_page_link:
-            page = WikiPage(self.env, self.wiki_page_prefix + resource.id)
-            if page.exists:
-                return get_resource_url(self.env, page.resource, href,
-                                        **kwargs)
+        page = self._get_tag_page(resource)
+        if page:
+            return get_resource_url(self.env, page, href, **kwargs)
         if form_realms:
             return href.tags(form_realms, q=unicode(resource.id), **kwargs)
         return href.tags(unicode(resource.id), form_realms, **kwargs)
 
     def get_resource_description(self, resource, format='default',
                                  context=None, **kwargs):
-        if self.wiki_page_link:
-            page = WikiPage(self.env, self.wiki_page_prefix + resource.id)
-            if page.exists:
-                return get_resource_description(self.env, page.resource,
-                                                format, **kwargs)
+        page = self._get_tag_page(resource)
+        if page:
+            return get_resource_description(self.env, page, format, **kwargs)
         rid = to_unicode(resource.id)
         if format in ('compact', 'default'):
             return rid
         else:
             return u'tag:%s' % rid
 
+    # IWikiChangeListener methods
+
+    def wiki_page_added(self, page):
+        self._wiki_page_changed(page.name)
+
+    def wiki_page_changed(self, page, version, t, comment, author, ipnr):
+        pass
+
+    def wiki_page_deleted(self, page):
+        self._wiki_page_changed(page.name)
+
+    def wiki_page_version_deleted(self, page):
+        pass
+
+    def wiki_page_renamed(self, page, old_name):
+        self._wiki_page_changed(old_name)
+        self._wiki_page_changed(page.name)
+
     # Internal methods
 
+    @cached
+    def _tag_pages(self):
+        """Names of existing wiki pages under `wiki_page_prefix`."""
+        with self.env.db_query as db:
+            prefix = db.like_escape(self.wiki_page_prefix) + '%'
+            return frozenset(name for name, in db("""
+                SELECT DISTINCT name FROM wiki WHERE name %s
+                """ % db.like(), (prefix,)))
+
+    def _get_tag_page(self, resource):
+        """Return the resource of the wiki page linked to a tag, if any."""
+        if self.wiki_page_link:
+            name = self.wiki_page_prefix + to_unicode(resource.id)
+            if name in self._tag_pages:
+                return Resource('wiki', name)
+
+    def _wiki_page_changed(self, name):
+        if name.startswith(self.wiki_page_prefix):
+            del self._tag_pages
+
+    def _memoize(self, req, key, compute):
+        """Return the value for `key` computed once per request."""
+        if req is None:
+            return compute()
+        memo = getattr(req, '_tags_memo', None)
+        if memo is None:
+            memo = req._tags_memo = {}
+        if key not in memo:
+            memo[key] = compute()
+        return memo[key]
+
+    def _forget(self, req):
+        """Discard values memoized for a request, that changes tags."""
+        if getattr(req, '_tags_memo', None):
+            req._tags_memo.clear()
+
+    def _remember_tags(self, req, username, tags):
+        """Put tags in front of the most recently used tags of a user."""
+        session = getattr(req, 'session', None)
+        if req.authname != username or \
+                not getattr(session, 'authenticated', False):
+            # Tags applied on behalf of the user, i.e. by ticket changes.
+            session = DetachedSession(self.env, username)
+            if not session.last_visit:
+                # No authenticated session, that would keep the tags.
+                return
+        recent = [tag for tag in session.get('tags.recent', '').split()
+                  if tag not in tags]
+        recent[:0] = sorted(tags)
+        session['tags.recent'] = u' '.join(recent[:self.recent_tags_size])
+        if session is not getattr(req, 'session', None):
+            session.save()
+
+    def _check_policies(self, req, realm, resources, action):
+        """Return decisions of the permission policy chain for resources of
+        a realm as dict by resource ID.
+        """
+        decisions = {}
+        default_policies = _default_permission_policies(self.config)
+        for policy in PermissionSystem(self.env).policies:
+            if not resources:
+                break
+            if hasattr(policy, 'check_permissions'):
+                decision = policy.check_permissions(action, req.authname,
+                                                    resources, req.perm)
+            elif policy.__class__.__name__ in default_policies:
+                # Independent of resource IDs, decide once per realm.
+                resource = resources[0]
+                decision = policy.check_permission(action, req.authname,
+                                                   resource,
+                                                   req.perm(resource))
+            else:
+                decision = dict((resource.id,
+                                 policy.check_permission(action, req.authname,
+                                                         resource,
+                                                         req.perm(resource)))
+                                for resource in resources)
+            undecided = []
+            for resource in resources:
+                if isinstance(decision, dict):
+                    allowed = decision.get(resource.id)
+                else:
+                    allowed = decision
+                if allowed is None:
+                    undecided.append(resource)
+                else:
+                    decisions[resource.id] = allowed
+            resources = undecided
+        for resource in resources:
+            # No policy allowed it.
+            decisions[resource.id] = False
+        return decisions
+
+    def _get_visible(self, req, realm, action):
+        """Return sorted tuples of names of tagged resources in a realm, for
+        which `action` is allowed and denied to the user.
+        """
+        signature = self._memoize(req, ('permissions_signature',),
+                                  self._get_permissions_signature)
+        key = (req.authname, realm, action)
+        entry = self._visible.get(key)
+        if entry is None or entry[0] != signature or entry[1] < time.time():
+            names = [name for name, in self.env.db_query("""
+                SELECT DISTINCT name FROM tags WHERE tagspace=%s
+                """, (realm,))]
+            decisions = self._check_policies(req, realm,
+                                             [Resource(realm, name)
+                                              for name in names], action)
+            allowed = tuple(sorted(name for name in names
+                                   if decisions[name]))
+            denied = tuple(sorted(name for name in names
+                                  if not decisions[name]))
+            entry = (signature, time.time() + self.permission_cache_time,
+                     allowed, denied)
+            self._visible[key] = entry
+        return entry[2:]
+
+    def _get_permissions_signature(self):
+        """Return a value changing with tags, permissions and policies."""
+        permissions = hash(tuple(sorted(self.env.db_query("""
+            SELECT username, action FROM permission
+            """))))
+        return (tags_generation(self.env), permissions,
+                self.config.get('trac', 'permission_policies'))
+
+    def _parse_query(self, query, attribute_handlers=None):
+        def realm_handler(_, node, context):
+            return query.match(node, [context.realm])
+
+        def realm_prefilter(_, node, realm):
+            return query.match(node, [realm])
+
+        realm_handler.prefilter = realm_prefilter
+
+        all_attribute_handlers = {
+            'realm': realm_handler,
+        }
+        all_attribute_handlers.update(attribute_handlers or {})
+        query = Query(query, attribute_handlers=all_attribute_handlers)
+        for m in REALM_RE.finditer(query.as_string()):
+            # Reject unsupported realms early.
+            self._get_provider(m.group(1))
+        return query
+
+    def _get_indexed_realms(self, req, realms=None):
+        """Return realms that the user may view, optionally restricted to
+        `realms`, and those of them with tags in the validated tag index.
+        """
+        all_realms = self.get_taggable_realms(req.perm, req)
+        if realms:
+            all_realms.intersection_update(realms)
+        # Counts of realms with extra resource conditions, like excluded
+        # wiki page templates, can't be taken from the index.
+        indexed = [p.get_taggable_realm() for p in self.tag_providers
+                   if isinstance(p, DefaultTagProvider) and
+                      p.get_taggable_realm() in all_realms and
+                      p._get_all_tags_filter(req) == []]
+        if indexed:
+            self._index.validate(self.env)
+        return all_realms, indexed
+
+    def _get_index(self):
+        """Return the validated tag index, if enabled by `query_engine`."""
+        if self.query_engine == 'bitmap':
+            self._index.validate(self.env)
+            return self._index
+
+    def _prefilter(self, query, provider, index=None):
+        """Prepare arguments for fetching provider's query candidates.
+
+        Returns `None`, if no resource of provider's realm can match the
+        query, or a tuple (tags, filter) of arguments for
+        `get_tagged_resources()`. If `tags` is `None`, resources satisfying
+        `filter` are known to match the query already. All query methods
+        share these candidates, so that their results agree.
+        """
+        realm = provider.get_taggable_realm()
+        possible, filter, ids = query.prefilter(realm)
+        if not possible:
+            return None
+        if ids is not None and len(ids) <= MAX_NAMES_FILTER:
+            # Too many IDs are left for checking query matches afterwards.
+            filter.append(names_filter(ids))
+        if isinstance(provider, DefaultTagProvider):
+            if index is not None:
+                matches = index.evaluate(query, realm)
+                if matches is not None:
+                    if not matches:
+                        return None
+                    if index.count(matches) <= MAX_NAMES_FILTER:
+                        # Fetch indexed candidates only.
+                        return None, [names_filter(index.names(matches))]
+            # Let the db select exact matches, including those of negated
+            # terms, that a restriction to query terms would miss.
+            condition = query.as_filter(realm)
+            if condition is not None:
+                return None, filter + [condition]
+        return set(query.terms()), filter
+
+    def _exact_filter(self, provider, tags, filter):
+        """Return conditions selecting exactly the query matches of provider.
+
+        Returns `None`, unless the query compiles to SQL and provider's view
+        permission can be checked once for the whole realm.
+        """
+        if not isinstance(provider, DefaultTagProvider) or \
+                not provider.fast_permcheck:
+            return None
+        if tags is None:
+            # Already resolved by the tag index or compiled to SQL.
+            return filter
+
+    def _sorted_results(self, req, provider, tags, filter, start):
+        """Yield (key, resource, tags) tuples of provider in sort order."""
+        if hasattr(provider, 'get_sorted_tagged_resources'):
+            results = provider.get_sorted_tagged_resources(req, tags, filter,
+                                                           start)
+        else:
+            # Third-party providers require sorting of complete results.
+            results = sorted(provider.get_tagged_resources(req, tags, filter)
+                             or [], key=lambda r: _sort_key(r[0].realm,
+                                                            r[0].id))
+        for resource, tags in results:
+            yield _sort_key(resource.realm, resource.id), resource, tags
+
     def _populate_provider_map(self):
         if self._realm_provider_map is None:
             # Only use the map once it is fully initialized.
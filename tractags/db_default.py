@@ -8,7 +8,7 @@
 
 from trac.db import Table, Column, Index
 
-schema_version = 4
+schema_version = 6
 
 
 schema = [
@@ -16,8 +16,10 @@ schema = [
         Column('tagspace'),
         Column('name'),
         Column('tag'),
+        Column('sortkey'),
         Index(['tagspace', 'name']),
         Index(['tagspace', 'tag']),
+        Index(['tagspace', 'sortkey']),
     ],
     Table('tags_change', key=('tagspace', 'name', 'time'))[
         Column('tagspace'),
@@ -26,6 +28,11 @@ schema = [
         Column('author'),
         Column('oldtags'),
         Column('newtags'),
+    ],
+    Table('tags_meta', key=('tagspace', 'name'))[
+        Column('tagspace'),
+        Column('name'),
+        Column('description'),
     ]
 ]
 
@@ -0,0 +1,63 @@
+// Suggest tags for the tags input field, configured by tags_autocomplete.
+jQuery(document).ready(function($) {
+  var opts = window.tags_autocomplete;
+  if (!opts)
+    return;
+  var sep = $.trim(opts.separator) + ' ';
+  var re = new RegExp(opts.separator.replace(/[-\/\\^$*+?.()|[\]{}]/g,
+                                             '\\$&') + '\\s*|\\s+');
+  function split(val) {
+    return val.split(re);
+  }
+  function extractLast(term) {
+    return split(term).pop();
+  }
+  $(opts.field)
+    // don't navigate away from field on tab when selecting an item
+    .bind("keydown", function(event) {
+      if (event.keyCode === $.ui.keyCode.TAB &&
+          $(this).data("autocomplete").menu.active) {
+        event.preventDefault();
+      }
+    })
+    .autocomplete({
+      // wait for a pause in typing before asking
+      delay: 300,
+      minLength: 0,
+      source: function(request, response) {
+        // ask for completions of the last term
+        var term = extractLast(request.term);
+        if (term.length < opts.min_length) {
+          response([]);
+          return;
+        }
+        $.getJSON(opts.url, {q: term})
+          .done(response)
+          .fail(function() { response([]); });
+      },
+      focus: function() {
+        // prevent value inserted on focus
+        return false;
+      },
+      select: function(event, ui) {
+        var terms = split(this.value);
+        // remove the current input
+        terms.pop();
+        // add the selected item
+        terms.push(ui.item.value);
+        // add placeholder to get the separator at the end
+        terms.push("");
+        this.value = terms.join(sep);
+        return false;
+      }
+    });
+  // Turn the field label into a link to the help resource.
+  if (opts.help_href) {
+    var link = $('<a></a>').attr('href', opts.help_href);
+    if (opts.help_new_window)
+      link.attr('target', 'blank');
+    $(opts.help_label).contents().filter(function() {
+      return this.nodeType === 3;
+    }).wrap(link);
+  }
+});
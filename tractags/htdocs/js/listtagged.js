@@ -0,0 +1,17 @@
+// Load results of asynchronous ListTagged macro calls and their pages.
+jQuery(document).ready(function($) {
+  $("div.listtagged-async").each(function() {
+    var container = $(this);
+    function load(url) {
+      container.addClass("loading");
+      $.get(url, function(html) {
+        container.removeClass("loading").html(html);
+      });
+    }
+    container.delegate(".paging a", "click", function(event) {
+      event.preventDefault();
+      load(this.href);
+    });
+    load(container.children("a").attr("href"));
+  });
+});
@@ -0,0 +1,9 @@
+// Add the tag query field to the timeline preferences form.
+jQuery(document).ready(function($) {
+  var opts = window.tags_timeline;
+  if (!opts)
+    return;
+  $("#prefs > div:first").append(
+    "<br />", document.createTextNode(opts.label),
+    $('<input type="text" />').attr("name", opts.key).val(opts.value));
+});
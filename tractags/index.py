@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2026 TracTags contributors
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""
+In-memory indexes over the tag db store.
+"""
+
+import binascii
+from bisect import bisect_left, insort
+from heapq import nsmallest
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+from trac.util.text import to_unicode
+
+from tractags.model import tags_generation
+
+__all__ = ['TagIndex']
+
+
+def bitmap(ids):
+    """Return a bitmap (long integer) with bits set for all given IDs.
+
+    >>> bin(bitmap([0, 3, 9]))
+    '0b1000001001'
+    >>> bitmap([])
+    0
+    """
+    if not ids:
+        return 0
+    bits = bytearray((max(ids) >> 3) + 1)
+    for i in ids:
+        bits[i >> 3] |= 1 << (i & 7)
+    bits.reverse()
+    return int(binascii.hexlify(bits), 16)
+
+
+def members(bitmap):
+    """Return the sorted list of IDs with bits set in a bitmap.
+
+    >>> members(0b1000001001)
+    [0, 3, 9]
+    """
+    if not bitmap:
+        return []
+    digits = '%x' % bitmap
+    bits = bytearray(binascii.unhexlify('0' * (len(digits) % 2) + digits))
+    bits.reverse()
+    ids = []
+    for offset, byte in enumerate(bits):
+        if byte:
+            base = offset << 3
+            ids.extend(base + i for i in xrange(8) if byte & (1 << i))
+    return ids
+
+
+def cardinality(bitmap):
+    """Return the number of bits set in a bitmap.
+
+    >>> cardinality(0b1000001001)
+    3
+    """
+    return bin(bitmap).count('1')
+
+
+class TagIndex(object):
+    """Inverted index with one bitmap per tag over dense resource IDs.
+
+    Bitmaps are plain Python long integers, so that boolean query operators
+    map to fast bitwise operations. The index is built from the `tags` db
+    table and validated against the tag generation counter, updated in place
+    for changes reported by the current process and rebuilt on any other
+    change.
+    """
+
+    def __init__(self):
+        self.generation = None
+        self._lock = threading.RLock()
+        self._ids = {}         # (realm, name) -> dense resource ID
+        self._resources = []   # dense resource ID -> (realm, name)
+        self._resource_tags = {}
+        self._realms = {}      # realm -> bitmap
+        self._tags = {}        # tag -> bitmap
+        # Tag name completion.
+        self._counts = {}      # realm -> {tag: number of resources}
+        self._sorted = []      # sorted (lower-case tag, tag) tuples
+        self._trigrams = {}    # lower-case trigram -> set of tags
+
+    # Public methods
+
+    def validate(self, env):
+        """Rebuild the index unless it matches the current tag generation."""
+        generation = tags_generation(env)
+        with self._lock:
+            if generation != self.generation:
+                self.build(env, generation)
+
+    def build(self, env, generation=None):
+        if generation is None:
+            generation = tags_generation(env)
+        ids = {}
+        resources = []
+        resource_tags = {}
+        realms = {}
+        tags = {}
+        for realm, name, tag in env.db_query("""
+                SELECT tagspace, name, tag FROM tags
+                """):
+            key = (realm, name)
+            id = ids.get(key)
+            if id is None:
+                id = ids[key] = len(resources)
+                resources.append(key)
+                resource_tags[id] = set()
+                realms.setdefault(realm, []).append(id)
+            resource_tags[id].add(tag)
+            tags.setdefault(tag, []).append(id)
+        counts = {}
+        for realm, realm_ids in realms.iteritems():
+            realm_counts = counts[realm] = {}
+            for id in realm_ids:
+                for tag in resource_tags[id]:
+                    realm_counts[tag] = realm_counts.get(tag, 0) + 1
+        trigrams = {}
+        for tag in tags:
+            for trigram in _trigrams(tag):
+                trigrams.setdefault(trigram, set()).add(tag)
+        with self._lock:
+            self._ids = ids
+            self._resources = resources
+            self._resource_tags = resource_tags
+            self._realms = dict((realm, bitmap(ids))
+                                for realm, ids in realms.iteritems())
+            self._tags = dict((tag, bitmap(ids))
+                              for tag, ids in tags.iteritems())
+            self._counts = counts
+            self._sorted = sorted((tag.lower(), tag) for tag in tags)
+            self._trigrams = trigrams
+            self.generation = generation
+
+    def update(self, realm, name, tags, generation, old_name=None):
+        """Apply a single resource change in place.
+
+        The change is applied only if it immediately follows the indexed
+        generation, otherwise the index is left for rebuild on validation.
+
+        :param tags: new tags of the resource, or `None` when moving tags
+                     unchanged from `old_name` to `name`.
+        """
+        with self._lock:
+            if self.generation is None or generation != self.generation + 1:
+                return
+            name = to_unicode(name)
+            if old_name is not None:
+                old_id = self._ids.get((realm, to_unicode(old_name)))
+                tags = old_id is not None and \
+                       self._resource_tags.get(old_id) or set()
+                self._set(realm, to_unicode(old_name), set())
+            self._set(realm, name, set(tags or ()))
+            self.generation = generation
+
+    def evaluate(self, query, realm):
+        """Return a bitmap of resources in `realm` matching `query`.
+
+        Attribute expressions are evaluated by their handler prefilters (see
+        `tractags.query.Query`). The result is exact, so matches require no
+        further evaluation of the query. Returns `None` for any attribute,
+        that can't be resolved into a set of resources in advance.
+        """
+        def _evaluate(node):
+            if not node or node.type in (None, node.NULL):
+                return universe
+            elif node.type == node.TERM:
+                return self._tags.get(node.value, 0) & universe
+            elif node.type == node.AND:
+                left = _evaluate(node.left)
+                return left and left & _evaluate(node.right)
+            elif node.type == node.OR:
+                return _evaluate(node.left) | _evaluate(node.right)
+            elif node.type == node.NOT:
+                return universe & ~_evaluate(node.left)
+            elif node.type == node.ATTR:
+                return _evaluate_attr(node)
+            raise _Unresolved()
+
+        def _evaluate_attr(node):
+            handler = query.attribute_handlers.get(node.left.value)
+            prefilter = getattr(handler, 'prefilter', None)
+            if prefilter is None:
+                raise _Unresolved()
+            value = prefilter(node.left.value, node.right, realm)
+            if value is True:
+                return universe
+            elif value is False:
+                return 0
+            elif value is None or isinstance(value, (basestring, tuple)):
+                raise _Unresolved()
+            keys = [(realm, to_unicode(name)) for name in value]
+            return bitmap([self._ids[key] for key in keys
+                           if key in self._ids]) & universe
+
+        with self._lock:
+            universe = self._realms.get(realm, 0)
+            try:
+                return _evaluate(query)
+            except _Unresolved:
+                return None
+
+    def names(self, bitmap):
+        """Return resource IDs for a bitmap returned by `evaluate()`."""
+        with self._lock:
+            return [self._resources[id][1] for id in members(bitmap)]
+
+    def count(self, bitmap):
+        return cardinality(bitmap)
+
+    def complete(self, term, realms, limit=None, contains=False):
+        """Return (tag, count) tuples of tags starting with `term`, or
+        containing it if `contains` is set, ignoring case.
+
+        Counts are numbers of tagged resources in given realms. Tags
+        starting with `term` rank first, then tags by descending count.
+        """
+        term = term.lower()
+        with self._lock:
+            prefixed = []
+            i = bisect_left(self._sorted, (term,))
+            while i < len(self._sorted) and \
+                    self._sorted[i][0].startswith(term):
+                prefixed.append(self._sorted[i][1])
+                i += 1
+            others = []
+            if contains and term:
+                if len(term) >= 3:
+                    candidates = None
+                    for trigram in _trigrams(term):
+                        tags = self._trigrams.get(trigram, frozenset())
+                        if candidates is None:
+                            candidates = set(tags)
+                        else:
+                            candidates &= tags
+                        if not candidates:
+                            break
+                else:
+                    candidates = self._tags
+                others = [tag for tag in candidates or ()
+                          if term in tag.lower() and
+                             not tag.lower().startswith(term)]
+            counts = [self._counts.get(realm, {}) for realm in realms]
+        results = []
+        for tags in (prefixed, others):
+            matches = [(tag, sum(c.get(tag, 0) for c in counts))
+                       for tag in tags]
+            matches = [(tag, count) for tag, count in matches if count]
+            key = lambda match: (-match[1], match[0])
+            if limit is None:
+                results.extend(sorted(matches, key=key))
+            else:
+                results.extend(nsmallest(limit - len(results), matches, key))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def tag_counts(self, realms):
+        """Return a dict of numbers of tagged resources in given realms by
+        tag.
+        """
+        all_counts = {}
+        with self._lock:
+            for realm in realms:
+                for tag, count in self._counts.get(realm, {}).iteritems():
+                    all_counts[tag] = all_counts.get(tag, 0) + count
+        return all_counts
+
+    def tag_names(self, realms):
+        """Return tags used in given realms in alphabetical order,
+        ignoring case.
+        """
+        with self._lock:
+            counts = [self._counts.get(realm, {}) for realm in realms]
+            return [tag for lower, tag in self._sorted
+                    if any(tag in c for c in counts)]
+
+    # Internal methods
+
+    def _set(self, realm, name, tags):
+        key = (realm, name)
+        id = self._ids.get(key)
+        if id is None:
+            if not tags:
+                return
+            id = self._ids[key] = len(self._resources)
+            self._resources.append(key)
+            self._resource_tags[id] = set()
+        bit = 1 << id
+        old_tags = self._resource_tags[id]
+        counts = self._counts.setdefault(realm, {})
+        for tag in old_tags - tags:
+            self._tags[tag] &= ~bit
+            counts[tag] -= 1
+            if not counts[tag]:
+                del counts[tag]
+            if not self._tags[tag]:
+                del self._tags[tag]
+                self._remove_name(tag)
+        for tag in tags - old_tags:
+            if tag not in self._tags:
+                self._add_name(tag)
+            self._tags[tag] = self._tags.get(tag, 0) | bit
+            counts[tag] = counts.get(tag, 0) + 1
+        if tags:
+            self._realms[realm] = self._realms.get(realm, 0) | bit
+        elif realm in self._realms:
+            self._realms[realm] &= ~bit
+        self._resource_tags[id] = tags
+
+    def _add_name(self, tag):
+        insort(self._sorted, (tag.lower(), tag))
+        for trigram in _trigrams(tag):
+            self._trigrams.setdefault(trigram, set()).add(tag)
+
+    def _remove_name(self, tag):
+        i = bisect_left(self._sorted, (tag.lower(), tag))
+        if i < len(self._sorted) and self._sorted[i][1] == tag:
+            del self._sorted[i]
+        for trigram in _trigrams(tag):
+            tags = self._trigrams.get(trigram)
+            if tags is not None:
+                tags.discard(tag)
+                if not tags:
+                    del self._trigrams[trigram]
+
+
+def _trigrams(text):
+    """Return the set of lower-case trigrams of a text.
+
+    >>> sorted(_trigrams('Tags'))
+    ['ags', 'tag']
+    """
+    text = text.lower()
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+class _Unresolved(Exception):
+    """Raised for query expressions the index can't evaluate."""
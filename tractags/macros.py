@@ -11,32 +11,45 @@
 
 import re
 
+from bisect import bisect_left
 from fnmatch import fnmatchcase
+from hashlib import sha1
+from heapq import nsmallest
 from genshi.builder import tag as builder
 from pkg_resources import resource_filename
 
-from trac.config import BoolOption, ListOption, Option
+from trac.config import BoolOption, IntOption, ListOption, Option
 from trac.core import Component, TracError, implements
 from trac.resource import Resource, get_resource_url, render_resource_link
-from trac.ticket.api import TicketSystem
-from trac.ticket.model import Ticket
-from trac.util import as_int, embedded_numbers
+from trac.ticket.api import ITicketChangeListener, TicketSystem
+from trac.util import as_bool, as_int, embedded_numbers
+from trac.util.html import Markup, escape
 from trac.util.presentation import Paginator
-from trac.util.text import shorten_line, to_unicode
+from trac.util.text import shorten_line, to_unicode, unicode_quote
+from trac.util.text import unicode_quote_plus
 from trac.web.chrome import Chrome, ITemplateProvider, add_link, \
-                            add_stylesheet
-from trac.wiki.api import IWikiMacroProvider, parse_args
+                            add_script, add_stylesheet
+from trac.wiki.api import IWikiChangeListener, IWikiMacroProvider
+from trac.wiki.api import parse_args
 from trac.wiki.formatter import format_to_oneliner, system_message
 
 from tractags.api import Counter, InvalidTagRealm, TagSystem, N_, _, gettext
 from tractags.query import InvalidQuery
-from tractags.util import query_realms
+from tractags.ticket import TicketTagProvider
+from tractags.model import tags_generation
+from tractags.util import GenerationalCache, LRUCache, query_realms
 
 # Check for unsupported pre-tags-0.6 macro keyword arguments.
 _OBSOLETE_ARGS_RE = re.compile(r"""
     (expression|operation|showheadings|tagspace|tagspaces)=
     """, re.VERBOSE)
 
+# Conservative match for descriptions rendering identical to their text,
+# that is without any wiki markup, TracLinks or CamelCase page names.
+# Lower case words never contain wiki markup.
+_PLAIN_TEXT_RE = re.compile(r"^[a-z\s]*$")
+_LINK_TEXT_RE = re.compile(r"[A-Z]\S*[A-Z]|\b[rR]\d")
+
 
 class TagTemplateProvider(Component):
     """Provides templates and static resources for the tags plugin."""
@@ -62,7 +75,8 @@ class TagTemplateProvider(Component):
 class TagWikiMacros(TagTemplateProvider):
     """[opt] Provides macros, that utilize the tag system in wiki markup."""
 
-    implements(IWikiMacroProvider)
+    implements(IWikiChangeListener, IWikiMacroProvider,
+               ITicketChangeListener)
 
     caseless_sort = BoolOption('tags', 'cloud_caseless_sort', default=False,
         doc="Whether the tag cloud should be sorted case-sensitive.")
@@ -81,9 +95,17 @@ class TagWikiMacros(TagTemplateProvider):
         doc="Number of tagged resources displayed per page of tag query "
             "results requested by `ListTagged` macros and from `/tags`.")
     items_per_page = as_int(items_per_page, 100)
+    oneliner_cache_size = IntOption('tags', 'listtagged_cache_size', 1000,
+        doc="Maximum number of rendered resource descriptions kept in "
+            "memory for `ListTagged` macros and `/tags` result lists.")
+    cloud_cache_size = IntOption('tags', 'cloud_cache_size', 100,
+        doc="Maximum number of rendered tag clouds kept in memory for "
+            "`TagCloud` macros and the `/tags` page.")
     supported_cols = frozenset(['realm', 'id', 'description', 'tags'])
 
     def __init__(self):
+        self._oneliners = LRUCache(self.oneliner_cache_size)
+        self._clouds = GenerationalCache(self.cloud_cache_size)
         # TRANSLATOR: Keep macro doc style formatting here, please.
         self.doc_cloud = N_("""Display a tag cloud.
 
@@ -92,12 +114,15 @@ class TagWikiMacros(TagTemplateProvider):
     Usage:
 
     {{{
-    [[TagCloud(<query>[,caseless_sort=<bool>][,mincount=<n>])]]
+    [[TagCloud(<query>[,caseless_sort=<bool>][,mincount=<n>][,max_tags=<n>])]]
     }}}
     caseless_sort::
       Whether the tag cloud should be sorted case-sensitive.
     mincount::
       Optional integer threshold to hide tags with smaller count.
+    max_tags::
+      Optional maximum number of most frequent tags to show, with a link
+      to show all tags.
 
     See tags documentation for the query syntax.
     """)
@@ -107,6 +132,7 @@ class TagWikiMacros(TagTemplateProvider):
 
     {{{
     [[ListTagged(<query>[,exclude=<list>],[[format=<format>],cols=<columns>])]]
+    [[ListTagged(<query>[,async=<bool>][,...])]]
     }}}
     format::
       result list presentation; supported values:
@@ -121,6 +147,9 @@ class TagWikiMacros(TagTemplateProvider):
     exclude::
       exclude tagged resources that match a name in the colon-separated list
       of resource ids, accepts shell-style patterns
+    async::
+      load results after the page, so that it is displayed without waiting
+      for the query; pages of results are loaded in place too
 
     See tags documentation for the query syntax.
     """)
@@ -137,10 +166,12 @@ class TagWikiMacros(TagTemplateProvider):
         if name == 'TagCloud':
             return gettext(self.doc_cloud)
 
-    def expand_macro(self, formatter, name, content, realms=[]):
+    def expand_macro(self, formatter, name, content, realms=[],
+                     fragment=False):
         """Evaluate macro call and render results.
 
-        Calls from web-UI come with pre-processed realm selection.
+        Calls from web-UI come with pre-processed realm selection. Results
+        of asynchronous `ListTagged` calls are only rendered as `fragment`.
         """
         env = self.env
         req = formatter.req
@@ -166,19 +197,39 @@ class TagWikiMacros(TagTemplateProvider):
             # Set implicit 'all tagged realms' as default.
             if not realms:
                 realms = all_realms
-            if query:
-                all_tags = Counter()
-                # Require per resource query including view permission checks.
-                for resource, tags in tag_system.query(req, query):
-                    all_tags.update(tags)
-            else:
-                # Allow faster per tag query, side steps permission checks.
-                all_tags = tag_system.get_all_tags(req, realms=realms)
             mincount = 'mincount' in kw and kw['mincount'] or None
-            return self.render_cloud(req, all_tags,
-                                     caseless_sort=self.caseless_sort,
-                                     mincount=mincount, realms=realms)
+            max_tags = as_int(req.args.get('tagcloud_max_tags'),
+                              as_int(kw.get('max_tags'), 0), min=0)
+
+            def render():
+                if query:
+                    # Require view permission checks, per resource if needed.
+                    all_tags = tag_system.get_query_tags(req, query)
+                else:
+                    # Allow faster per tag query, side steps permission checks.
+                    # Fetch one more tag to tell if there are more tags.
+                    all_tags = tag_system.get_all_tags(req, realms=realms,
+                                    mincount=as_int(mincount, None),
+                                    limit=max_tags and max_tags + 1 or None)
+                cloud = self.render_cloud(req, all_tags,
+                                          caseless_sort=self.caseless_sort,
+                                          mincount=mincount, realms=realms,
+                                          max_tags=max_tags)
+                return escape(cloud)
+            key = self._get_cloud_key(req, query, realms, mincount, max_tags)
+            # Tag links depend on existence of tag wiki pages too.
+            generation = (tags_generation(env), tag_system.wiki_page_link and
+                                                tag_system._tag_pages)
+            return self._clouds.get(key, generation, render)
         elif name == 'ListTagged':
+            if as_bool(kw.get('async')) and not fragment:
+                # Leave results to a request for the fragment only.
+                href = req.href.tags('api', 'listtagged', q=content)
+                add_script(req, 'tags/js/listtagged.js')
+                add_stylesheet(req, 'common/css/search.css')
+                return builder.div(builder.a(_("Loading tagged resources..."),
+                                             href=href),
+                                   class_='listtagged-async')
             if content and _OBSOLETE_ARGS_RE.search(content):
                 data = {'warning': 'obsolete_args'}
             else:
@@ -194,18 +245,50 @@ class TagWikiMacros(TagTemplateProvider):
                     return ''
             query = '(%s) (%s)' % (query or '', ' or '.join(['realm:%s' % (r)
                                                              for r in realms]))
-            query_result = tag_system.query(req, query)
             excludes = [exc.strip()
                         for exc in kw.get('exclude', '' ).split(':')
                         if exc.strip()]
-            if excludes and query_result:
-                filtered_result = [(resource, tags)
-                                   for resource, tags in query_result
-                                   if not any(fnmatchcase(resource.id, exc)
-                                              for exc in excludes)]
-                query_result = filtered_result
-            if not query_result:
-                return ''
+            try:
+                if excludes:
+                    # Exclusion patterns require the complete query result.
+                    query_result = [(resource, tags) for resource, tags
+                                    in tag_system.query(req, query)
+                                    if not any(fnmatchcase(resource.id, exc)
+                                               for exc in excludes)]
+                    if not query_result:
+                        return ''
+                    results = sorted(query_result, key=lambda r:
+                                     embedded_numbers(to_unicode(r[0].id)))
+                    results = self._paginate(req, results, realms)
+                else:
+                    # Fetch only the current page of the query result.
+                    num_items = tag_system.query_count(req, query)
+                    page, per_page = self._get_page_args(req)
+                    if (page - 1) * per_page >= max(num_items, 1):
+                        page = 1
+                    after = req.args.get('listtagged_after')
+                    if after and ':' in after:
+                        after = tuple(after.split(':', 1))
+                        offset = 0
+                    else:
+                        after = None
+                        offset = (page - 1) * per_page
+                    results = tag_system.query_page(req, query, per_page,
+                                                    after, offset)
+                    results = self._paginate(req, results, realms, page,
+                                             num_items)
+            except (InvalidQuery, InvalidTagRealm), e:
+                return system_message(_("ListTagged macro error"), e)
+
+            # Fetch row data for all resources on the page at once.
+            resources = [resource for resource, tags in results]
+            descriptions = tag_system.describe_tagged_resources(req,
+                                                                resources)
+            tickets = {}
+            if env.is_component_enabled(TicketTagProvider):
+                tickets = TicketTagProvider(env).get_ticket_summaries(
+                    req, [resource for resource in resources
+                          if resource.realm == 'ticket'])
 
             def _link(resource):
                 if resource.realm == 'tag':
@@ -213,13 +296,15 @@ class TagWikiMacros(TagTemplateProvider):
                     return builder.a(resource.id,
                                      href=self.get_href(req, realms,
                                                         tag=resource))
-                elif resource.realm == 'ticket':
+                elif resource.realm == 'ticket' and \
+                        as_int(resource.id, None) in tickets:
                     # Return resource link including ticket status dependend
                     #   class to allow for common Trac ticket link style.
-                    ticket = Ticket(env, resource.id)
-                    return builder.a('#%s' % ticket.id,
+                    id = as_int(resource.id, None)
+                    ticket = tickets[id]
+                    return builder.a('#%s' % id,
                                      class_=ticket['status'],
-                                     href=formatter.href.ticket(ticket.id),
+                                     href=formatter.href.ticket(id),
                                      title=shorten_line(ticket['summary']))
                 return render_resource_link(env, context, resource, 'compact')
 
@@ -240,17 +325,11 @@ class TagWikiMacros(TagTemplateProvider):
                 data.update({'cols': cols,
                              'headers': headers})
 
-            try:
-                results = sorted(query_result, key=lambda r:
-                                 embedded_numbers(to_unicode(r[0].id)))
-            except (InvalidQuery, InvalidTagRealm), e:
-                return system_message(_("ListTagged macro error"), e)
-            results = self._paginate(req, results, realms)
             rows = []
             for resource, tags in results:
-                desc = tag_system.describe_tagged_resource(req, resource)
+                desc = descriptions[(resource.realm, resource.id)]
                 tags = sorted(tags)
-                wiki_desc = format_to_oneliner(env, context, desc)
+                wiki_desc = self._format_description(context, resource, desc)
                 if tags:
                     rendered_tags = [_link(Resource('tag', tag))
                                      for tag in tags]
@@ -293,6 +372,34 @@ class TagWikiMacros(TagTemplateProvider):
             return Chrome(env).render_template(
                 req, 'listtagged_results.html', data, 'text/html', True)
 
+    # IWikiChangeListener methods
+
+    def wiki_page_added(self, page):
+        pass
+
+    def wiki_page_changed(self, page, version, t, comment, author, ipnr):
+        self._invalidate(page.resource)
+
+    def wiki_page_deleted(self, page):
+        self._invalidate(page.resource)
+
+    def wiki_page_version_deleted(self, page):
+        self._invalidate(page.resource)
+
+    def wiki_page_renamed(self, page, old_name):
+        self._invalidate(Resource('wiki', old_name))
+
+    # ITicketChangeListener methods
+
+    def ticket_created(self, ticket):
+        pass
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        self._invalidate(ticket.resource)
+
+    def ticket_deleted(self, ticket):
+        self._invalidate(ticket.resource)
+
     def get_href(self, req, realms, query=None, per_page=None, page=None,
                  tag=None, **kwargs):
         """Prepare href objects for tag links and pager navigation.
@@ -314,7 +421,7 @@ class TagWikiMacros(TagTemplateProvider):
                         listtagged_page=page, **kwargs)
 
     def render_cloud(self, req, cloud, renderer=None, caseless_sort=False,
-                     mincount=None, realms=()):
+                     mincount=None, realms=(), max_tags=None):
         """Render a tag cloud.
 
         :cloud: Dictionary of {object: count} representing the cloud.
@@ -323,60 +430,150 @@ class TagWikiMacros(TagTemplateProvider):
         :param caseless_sort: Boolean, whether tag cloud should be sorted
                               case-sensitive.
         :param mincount: Integer threshold to hide tags with smaller count.
+        :param max_tags: Integer maximum number of most frequent tags to
+                         show, followed by a link to show all tags.
         """
-        min_px = 10.0
-        max_px = 30.0
-        scale = 1.0
-
-        if renderer is None:
-            def default_renderer(tag, count, percent):
-                href = self.get_href(req, realms, tag=Resource('tag', tag))
-                return builder.a(tag, rel='tag', title='%i' % count,
-                                 href=href, style='font-size: %ipx'
-                                 % int(min_px + percent * (max_px - min_px)))
-            renderer = default_renderer
-
-        # A LUT from count to n/len(cloud)
-        size_lut = dict([(c, float(i)) for i, c in
-                         enumerate(sorted(set([r for r in cloud.values()])))])
-        if size_lut:
-            scale = 1.0 / len(size_lut)
-
+        mincount = as_int(mincount, 0)
+        items = [(tag, count) for tag, count in cloud.iteritems()
+                 if count >= mincount]
+        if not items:
+            return _("No tags found")
+        more = max_tags and len(items) > max_tags
+        if more:
+            items = nsmallest(max_tags, items,
+                              key=lambda (tag, count): (-count, tag))
         if caseless_sort:
             # Preserve upper-case precedence within similar tags.
-            items = reversed(sorted(cloud.iteritems(),
-                                    key=lambda t: t[0].lower(), reverse=True))
+            items.sort(key=lambda (tag, count): (tag.lower(), tag))
+        else:
+            items.sort()
+        # Font size scales with rank of the count among shown counts.
+        counts = sorted(set(count for tag, count in items))
+        scale = 1.0 / len(counts)
+
+        if renderer is None:
+            cloud = self._render_cloud_markup(req, items, counts, scale,
+                                              realms)
         else:
-            items = sorted(cloud.iteritems())
-        ul = li = None
-        for i, (tag, count) in enumerate(items):
-            percent = size_lut[count] * scale
-            if mincount and count < as_int(mincount, 1):
-                # Tag count is too low.
-                continue
-            if ul:
-                # Found new tag for cloud; now add previously prepared one.
-                ul('\n', li)
+            cloud = builder.ul(class_='tagcloud')
+            for tag, count in items:
+                percent = bisect_left(counts, count) * scale
+                cloud('\n', builder.li(renderer(tag, count, percent)))
+            # Mark latest tag as last one (no tailing colon).
+            cloud.children[-1](class_='last')
+            cloud('\n')
+        if more:
+            more_href = req.href(req.path_info,
+                                 dict(req.args, tagcloud_max_tags=0))
+            cloud = builder(cloud, builder.p(builder.a(_("Show all tags"),
+                                                       href=more_href),
+                                             class_='tagcloud-more'))
+        return cloud
+
+    def _render_cloud_markup(self, req, items, counts, scale, realms):
+        """Render tag cloud items in bulk as HTML markup."""
+        min_px = 10
+        max_px = 30
+        tag_system = TagSystem(self.env)
+        pages = tag_system.wiki_page_link and tag_system._tag_pages or ()
+        prefix = tag_system.wiki_page_prefix
+        # Prepare links like `get_href()` does once for all tags.
+        form_realms = dict((realm, 'on') for realm in realms)
+        path_safe = getattr(req.href, 'path_safe', "/!~*'()")
+        query_safe = getattr(req.href, 'query_safe', "!~*'()")
+        if form_realms:
+            tags_href = req.href.tags(form_realms) + '&q='
+        else:
+            tags_href = req.href.tags() + '/'
+        wiki_href = req.href.wiki() + '/'
+        html = [u'<ul class="tagcloud">']
+        last = len(items) - 1
+        for idx, (tag, count) in enumerate(items):
+            if prefix + tag in pages:
+                href = wiki_href + unicode_quote(prefix + tag, path_safe)
+            elif form_realms:
+                href = tags_href + unicode_quote_plus(tag, query_safe)
+            elif '/' in tag:
+                # Leave normalization of slashes to `Href`.
+                href = req.href.tags(tag)
             else:
-                # Found first tag for cloud; now create the list.
-                ul = builder.ul(class_='tagcloud')
-            # Prepare current tag entry.
-            li = builder.li(renderer(tag, count, percent))
-        if li:
-            # All tags checked; mark latest tag as last one (no tailing colon).
-            li(class_='last')
-            ul('\n', li, '\n')
-        return ul and ul or _("No tags found")
-
-    def _paginate(self, req, results, realms):
-        query = req.args.get('q', None)
+                href = tags_href + unicode_quote(tag, path_safe)
+            size = int(min_px + bisect_left(counts, count) * scale *
+                                (max_px - min_px))
+            html.append(u'\n<li%s><a rel="tag" title="%i" href="%s" '
+                        u'style="font-size: %ipx">%s</a></li>'
+                        % (idx == last and u' class="last"' or u'', count,
+                           escape(href), size, escape(tag)))
+        html.append(u'\n</ul>')
+        return Markup(u''.join(html))
+
+    def _get_cloud_key(self, req, query, realms, mincount, max_tags):
+        """Return the cache key for a tag cloud rendered for `req`."""
+        tag_system = TagSystem(self.env)
+        visible = tag_system.get_taggable_realms(req.perm, req)
+        # Results are the same for all users, if all permission checks
+        # can be done per realm.
+        per_user = any(not getattr(p, 'fast_permcheck', False)
+                       for p in tag_system.tag_providers
+                       if p.get_taggable_realm() in realms)
+        # Links to the complete cloud refer to the current page.
+        more_args = max_tags and (req.path_info, tuple(sorted(
+            (name, isinstance(value, list) and tuple(value) or value)
+            for name, value in req.args.iteritems())))
+        return (query, tuple(sorted(set(realms))), mincount, max_tags,
+                more_args, self.caseless_sort, tuple(sorted(visible)),
+                per_user and req.authname or None, req.href.base,
+                to_unicode(getattr(req, 'locale', None)))
+
+    def _format_description(self, context, resource, desc):
+        """Render a resource description, reusing earlier results."""
+        if _PLAIN_TEXT_RE.match(desc):
+            # Skip the wiki formatter for plain text.
+            return escape(desc.strip())
+        perm = getattr(context, 'perm', None)
+        href = getattr(context, 'href', None)
+        parent = getattr(context, 'resource', None)
+        flavor = (href and href.base, getattr(perm, 'username', None),
+                  parent and (parent.realm, parent.id))
+        key = (resource.realm, to_unicode(resource.id),
+               sha1(to_unicode(desc).encode('utf-8')).hexdigest(), flavor)
+        wiki_desc = self._oneliners.get(key)
+        if wiki_desc is None:
+            wiki_desc = format_to_oneliner(self.env, context, desc)
+            # Rendered links depend on their targets and on permissions,
+            # and macro or processor output on anything, which may change
+            # anytime, so only cache descriptions without them.
+            if '<a ' not in wiki_desc and not _LINK_TEXT_RE.search(desc) \
+                    and '[[' not in desc and '{{{' not in desc:
+                self._oneliners[key] = wiki_desc
+        return wiki_desc
+
+    def _invalidate(self, resource):
+        """Discard rendered descriptions of a changed resource."""
+        realm, id = resource.realm, to_unicode(resource.id)
+        self._oneliners.discard(lambda key: key[:2] == (realm, id))
+
+    def _get_page_args(self, req):
         current_page = as_int(req.args.get('listtagged_page'), 1, min=1)
         items_per_page = as_int(req.args.get('listtagged_per_page'),
                                 self.items_per_page)
         if items_per_page < 1:
             items_per_page = self.items_per_page
+        return current_page, items_per_page
+
+    def _paginate(self, req, results, realms, current_page=None,
+                  num_items=None):
+        """Prepare pager navigation for results.
+
+        :param num_items: if provided, `results` are the items of the
+                          current page only.
+        """
+        query = req.args.get('q', None)
+        page, items_per_page = self._get_page_args(req)
+        current_page = current_page or page
         try:
-            result = Paginator(results, current_page - 1, items_per_page)
+            result = Paginator(results, current_page - 1, items_per_page,
+                               num_items)
         except (AssertionError, TracError), e:
             # AssertionError raised in Trac < 1.0.10, TracError otherwise
             self.log.warn("ListTagged macro: %s", e)
@@ -397,8 +594,13 @@ class TagWikiMacros(TagTemplateProvider):
                                'string': str(result.page + 1), 'title': None}
 
         if result.has_next_page:
+            kwargs = {}
+            if num_items is not None and result.items:
+                # Resume after the last resource of the current page.
+                last = result.items[-1][0]
+                kwargs['listtagged_after'] = '%s:%s' % (last.realm, last.id)
             next_href = self.get_href(req, realms, query, items_per_page,
-                                      current_page + 1)
+                                      current_page + 1, **kwargs)
             add_link(req, 'next', next_href, _('Next Page'))
 
         if result.has_previous_page:
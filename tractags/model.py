@@ -10,9 +10,11 @@
 from __future__ import with_statement
 
 from datetime import datetime
-from itertools import groupby
+from heapq import merge
+from itertools import groupby, islice
 
 from trac.resource import Resource
+from trac.util import embedded_numbers
 from trac.util.datefmt import to_datetime, to_utimestamp, utc
 from trac.util.text import to_unicode
 
@@ -24,26 +26,136 @@ from tractags.util import split_into_tags
 
 # Utility functions
 
+def filter_sql(filter):
+    """Return SQL and arguments for a sequence of resource conditions.
+
+    Conditions are SQL strings or tuples of an SQL string with placeholders
+    and a sequence of arguments, all referring to columns of the `tags` db
+    table. The result is suitable for appending to a WHERE clause.
+    """
+    sql = ''
+    args = []
+    for f in filter or ():
+        if isinstance(f, tuple):
+            sql += " AND (%s)" % f[0]
+            args.extend(f[1])
+        else:
+            sql += " AND %s" % f
+    return sql, args
+
+
+def names_filter(names):
+    """Return a resource condition restricting resource IDs to `names`."""
+    names = [to_unicode(name) for name in names]
+    return ('name IN (%s)' % ','.join(['%s'] * len(names)), names)
+
+
+def natural_sort_key(name):
+    """Return a collation-independent key for natural order of resource IDs.
+
+    Keys contain hexadecimal digits only, so that plain string comparison,
+    i.e. by the db, yields the same order as comparing `embedded_numbers()`:
+    text as fixed-width code points with terminator, numbers as significant
+    digits with length prefix.
+
+    >>> natural_sort_key(u'Page10')
+    u'000051000062000068000066000000000210000000'
+    >>> sorted([u'a10', u'a2', u'a', u'b1', u'A'], key=natural_sort_key)
+    [u'A', u'a', u'a2', u'a10', u'b1']
+    """
+    key = []
+    for piece in embedded_numbers(to_unicode(name)):
+        if isinstance(piece, basestring):
+            key.extend('%06x' % (ord(c) + 1) for c in piece)
+            key.append('000000')
+        else:
+            digits = str(piece)
+            key.append('%04x%s' % (len(digits), digits))
+    return u''.join(key)
+
+
+def update_sort_keys(env, realm=None):
+    """Add missing sort keys to tags db table.
+
+    Tags are usually stored with their sort key, but this catches up on
+    rows written by other means, i.e. manually or by older plugin versions.
+    Reads sort such rows without writing, but slower, so this is run by
+    `trac-admin tags resync`.
+
+    Returns the number of resources updated.
+    """
+    sql = "SELECT DISTINCT tagspace, name FROM tags WHERE sortkey IS NULL"
+    args = []
+    if realm is not None:
+        sql += " AND tagspace=%s"
+        args.append(realm)
+    rows = env.db_query(sql, args)
+    if rows:
+        with env.db_transaction as db:
+            db.executemany("""
+                UPDATE tags SET sortkey=%s
+                WHERE tagspace=%s AND name=%s
+                """, [(natural_sort_key(name), tagspace, name)
+                      for tagspace, name in rows])
+    return len(rows)
+
+
 def delete_tags(env, resource, tags=None, purge=False):
     """Delete tags and tag changes for a Trac resource.
 
     :param purge: if `True`, delete the change history.
+
+    Returns the new tag generation.
     """
-    args = [resource.realm, to_unicode(resource.id)]
-    sql = ''
-    if tags:
-        args += list(tags)
-        sql += " AND tags.tag IN (%s)" % ','.join(['%s'] * len(tags))
     with env.db_transaction as db:
-        db("""DELETE FROM tags
-              WHERE tagspace=%%s AND name=%%s%s
-              """ % sql, args)
+        _delete_tags(db, resource, tags)
+        generation = bump_tags_generation(db)
         if purge:
             # Call outside of another db transaction means resource destruction,
             # so purge change records too.
             db("""DELETE FROM tags_change
                   WHERE tagspace=%s AND name=%s
                   """, (resource.realm, to_unicode(resource.id)))
+    return generation
+
+
+def _delete_tags(db, resource, tags=None):
+    args = [resource.realm, to_unicode(resource.id)]
+    sql = ''
+    if tags:
+        args += list(tags)
+        sql += " AND tags.tag IN (%s)" % ','.join(['%s'] * len(tags))
+    db("""DELETE FROM tags
+          WHERE tagspace=%%s AND name=%%s%s
+          """ % sql, args)
+
+
+def bump_tags_generation(db):
+    """Increment the tag db store generation inside a transaction."""
+    db("""UPDATE system SET value=%s
+          WHERE name='tags_generation'
+          """ % db.cast(db.cast('value', 'int') + '+1', 'text'))
+    for value, in db("""
+            SELECT value FROM system WHERE name='tags_generation'
+            """):
+        return int(value)
+    db("""INSERT INTO system (name, value)
+          VALUES ('tags_generation', '1')
+          """)
+    return 1
+
+
+def tags_generation(env):
+    """Return the current generation of the tag db store.
+
+    The generation number is incremented by each change to stored tags, so
+    it may be used to validate cached information about tags.
+    """
+    for value, in env.db_query("""
+            SELECT value FROM system WHERE name='tags_generation'
+            """):
+        return int(value)
+    return 0
 
 
 def tag_changes(env, resource, start=None, stop=None):
@@ -64,23 +176,78 @@ def tag_changes(env, resource, start=None, stop=None):
                 """, (to_utimestamp(start), to_utimestamp(stop)))]
 
 
-def tag_frequency(env, realm, filter=None, db=None):
-    """Return tags and numbers of their occurrence."""
-    if filter:
-        sql = ''.join(" AND %s" % f for f in filter)
+def tag_frequency(env, realm, filter=None, db=None, mincount=None,
+                  limit=None):
+    """Return tags and numbers of their occurrence.
+
+    :param mincount: if provided, skip tags occurring less often.
+    :param limit: if provided, return only as many most frequent tags,
+                  most frequent tags first.
+    """
+    return tag_frequencies(env, [(realm, filter)], mincount, limit)
+
+
+def tag_frequencies(env, realm_filters, mincount=None, limit=None):
+    """Return tags and numbers of their occurrence summed up across realms.
+
+    :param realm_filters: sequence of (realm, filter) tuples, with resource
+                          conditions applying to that realm only.
+
+    Other arguments are like for `tag_frequency()`, but apply to the
+    combined frequencies, all counted by a single db query.
+    """
+    if not realm_filters:
+        return
+    sql = []
+    args = []
+    for realm, filter in realm_filters:
+        filter_, filter_args = filter_sql(filter)
+        sql.append("(tagspace=%%s%s)" % filter_)
+        args.append(realm)
+        args.extend(filter_args)
+    sql = "WHERE %s GROUP BY tag" % ' OR '.join(sql)
+    if mincount and mincount > 1:
+        sql += " HAVING count(tag)>=%s"
+        args.append(mincount)
+    if limit:
+        sql += " ORDER BY count(tag) DESC, tag LIMIT %s"
+        args.append(limit)
     for row in env.db_query("""
-            SELECT tag,count(tag) FROM tags
-            WHERE tagspace=%%s%s GROUP BY tag
-            """ % (filter and sql or ''), (realm,)):
+            SELECT tag,count(tag) FROM tags %s
+            """ % sql, args):
         yield row[0], row[1]
 
 
+def tagged_resource_count(env, realm, filter=None):
+    """Return the number of resources matching all conditions."""
+    sql, args = filter_sql(filter)
+    for count, in env.db_query("""
+            SELECT COUNT(DISTINCT name) FROM tags
+            WHERE tagspace=%%s%s
+            """ % sql, [realm] + args):
+        return count
+    return 0
+
+
+def tagged_resource_exists(env, realm, filter=None):
+    """Return whether any resource matches all conditions."""
+    sql, args = filter_sql(filter)
+    for row in env.db_query("""
+            SELECT 1 FROM tags
+            WHERE tagspace=%%s%s LIMIT 1
+            """ % sql, [realm] + args):
+        return True
+    return False
+
+
 def tag_resource(env, resource, old_id=None, author='anonymous', tags=None,
                  log=False, when=None):
     """Save tags and tag changes for a Trac resource.
 
     This function combines delete, reparent and set actions now, but it could
     possibly be still a bit more efficient.
+
+    Returns the new tag generation, or `None` if tags were left unchanged.
     """
     tags = tags or []
     if when is None:
@@ -91,34 +258,42 @@ def tag_resource(env, resource, old_id=None, author='anonymous', tags=None,
     if old_id:
         with env.db_transaction as db:
             db("""
-               UPDATE tags SET name=%s
+               UPDATE tags SET name=%s, sortkey=%s
                WHERE tagspace=%s AND name=%s
-               """, (to_unicode(resource.id), resource.realm,
-                     to_unicode(old_id)))
+               """, (to_unicode(resource.id), natural_sort_key(resource.id),
+                     resource.realm, to_unicode(old_id)))
             db("""
                UPDATE tags_change SET name=%s
                WHERE tagspace=%s AND name=%s
                """, (to_unicode(resource.id), resource.realm,
                      to_unicode(old_id)))
+            return bump_tags_generation(db)
     else:
         # Calculate effective tag changes.
         old_tags = set(resource_tags(env, resource))
         tags = set(tags)
         remove = old_tags - tags
+        generation = None
+        add = tags - old_tags
         with env.db_transaction as db:
             if remove:
-                if tags:
-                    delete_tags(env, resource, remove)
-                else:
-                    # Delete all resource's tags - simplified transaction.
-                    delete_tags(env, resource)
-            add = tags - old_tags
+                # Delete all resource's tags - simplified statement.
+                _delete_tags(db, resource, tags and remove or None)
             if add:
+                sortkey = natural_sort_key(resource.id)
                 db.executemany("""
-                    INSERT INTO tags (tagspace, name, tag)
-                    VALUES (%s,%s,%s)
-                    """, [(resource.realm, to_unicode(resource.id), tag)
-                          for tag in add])
+                    INSERT INTO tags (tagspace, name, tag, sortkey)
+                    VALUES (%s,%s,%s,%s)
+                    """, [(resource.realm, to_unicode(resource.id), tag,
+                           sortkey) for tag in add])
+                # Catch up on kept tags stored without sort key.
+                db("""
+                    UPDATE tags SET sortkey=%s
+                    WHERE tagspace=%s AND name=%s AND sortkey IS NULL
+                    """, (sortkey, resource.realm, to_unicode(resource.id)))
+            if remove or add:
+                # One generation per change, for in-place index updates.
+                generation = bump_tags_generation(db)
             if log:
                 db("""
                   INSERT INTO tags_change
@@ -128,32 +303,38 @@ def tag_resource(env, resource, old_id=None, author='anonymous', tags=None,
                         when, author,
                         u' '.join(sorted(map(to_unicode, old_tags))),
                         u' '.join(sorted(map(to_unicode, tags))),))
+        return generation
 
 
 def tagged_resources(env, perm_check, perm, realm, tags=None, filter=None,
-                     db=None):
+                     db=None, perm_filter=None):
     """Return Trac resources including their associated tags.
 
     This is currently known to be a major performance hog.
+
+    :param perm_filter: if provided, a callable returning the viewable ones
+                        of a list of resources, replacing per resource
+                        calls of `perm_check`.
     """
-    args = [realm]
+    where, args = filter_sql(filter)
+    args = [realm] + args
     sql = """
         SELECT DISTINCT name
           FROM tags
-         WHERE tagspace=%s"""
-    if filter:
-        sql += ''.join([" AND %s" % f for f in filter])
+         WHERE tagspace=%s""" + where
     if tags:
         sql += " AND tags.tag IN (%s)" % ','.join(['%s' for tag in tags])
         args += tags
     sql += " ORDER by name"
 
-    # Inline permission check for efficiency.
-    resources = {}
-    for name, in env.db_query(sql, args):
-        resource = Resource(realm, name)
-        if perm_check(perm(resource), 'view'):
-            resources[resource.id] = resource
+    resources = [Resource(realm, name) for name, in env.db_query(sql, args)]
+    if perm_filter is not None:
+        resources = perm_filter(resources)
+    else:
+        # Inline permission check for efficiency.
+        resources = [resource for resource in resources
+                     if perm_check(perm(resource), 'view')]
+    resources = dict((resource.id, resource) for resource in resources)
     if not resources:
         return
 
@@ -169,6 +350,70 @@ def tagged_resources(env, perm_check, perm, realm, tags=None, filter=None,
         yield resource, set([tag[1] for tag in tags])
 
 
+def sorted_tagged_resources(env, realm, tags=None, filter=None, start=None,
+                            perm_filter=None, batch=100):
+    """Return Trac resources including their associated tags in natural
+    order of resource IDs.
+
+    Resources are loaded lazily in batches ordered by the db, so that
+    consumers only pay for resources they actually take.
+
+    :param start: if provided, skip resources sorting before this ID.
+    :param perm_filter: if provided, a callable returning the viewable ones
+                        of a list of resources.
+    """
+    where, args = filter_sql(filter)
+    args = [realm] + args
+    sql = """
+          FROM tags
+         WHERE tagspace=%s""" + where
+    if tags:
+        sql += " AND tags.tag IN (%s)" % ','.join(['%s' for tag in tags])
+        args += tags
+    start_key = start is not None and natural_sort_key(start) or None
+
+    def keyed_rows():
+        if start_key is not None:
+            where, key_args = " AND sortkey>=%s", [start_key]
+        else:
+            where, key_args = " AND sortkey IS NOT NULL", []
+        while True:
+            rows = env.db_query("SELECT DISTINCT sortkey, name" + sql +
+                                where + """
+                ORDER BY sortkey, name LIMIT %d""" % batch, args + key_args)
+            for row in rows:
+                yield row
+            if len(rows) < batch:
+                break
+            # Resume after the last resource of this batch.
+            where = " AND (sortkey>%s OR sortkey=%s AND name>%s)"
+            key_args = [rows[-1][0], rows[-1][0], rows[-1][1]]
+
+    # Rows without sort key, written by other means and not backfilled by
+    # `update_sort_keys()` yet, are few and sorted here instead.
+    unkeyed = sorted((natural_sort_key(name), name) for name, in
+                     env.db_query("SELECT DISTINCT name" + sql +
+                                  " AND sortkey IS NULL", args))
+    if start_key is not None:
+        unkeyed = [row for row in unkeyed if row[0] >= start_key]
+    # Resources with keyed and unkeyed rows are merged into one.
+    rows = (row for row, dups in groupby(merge(keyed_rows(), unkeyed)))
+
+    while True:
+        chunk = list(islice(rows, batch))
+        resources = [Resource(realm, name) for sortkey, name in chunk]
+        if perm_filter is not None and resources:
+            resources = perm_filter(resources)
+        if resources:
+            tags_by_name = resources_tags(env, realm,
+                                          [resource.id
+                                           for resource in resources])
+            for resource in resources:
+                yield resource, tags_by_name[resource.id]
+        if len(chunk) < batch:
+            break
+
+
 def resource_tags(env, resource, when=None):
     """Return all tags for a Trac resource by realm and ID."""
     id = to_unicode(resource.id)
@@ -188,3 +433,59 @@ def resource_tags(env, resource, when=None):
                 """, (resource.realm, id, when)):
             for tag in split_into_tags(newtags):
                 yield tag
+
+
+def resources_tags(env, realm, names):
+    """Return tags of several Trac resources of a realm as dict of sets by
+    resource ID.
+    """
+    tags = {}
+    names = [to_unicode(name) for name in names]
+    for i in xrange(0, len(names), 100):
+        chunk = names[i:i + 100]
+        for name, tag in env.db_query("""
+                SELECT DISTINCT name, tag FROM tags
+                WHERE tagspace=%%s AND name IN (%s)
+                """ % ', '.join(['%s'] * len(chunk)), [realm] + chunk):
+            tags.setdefault(name, set()).add(tag)
+    return tags
+
+
+def resource_descriptions(env, realm, names):
+    """Return stored descriptions of resources as dict by resource ID.
+
+    Resources without stored description are missing from the result.
+    """
+    names = [to_unicode(name) for name in names]
+    if not names:
+        return {}
+    return dict(env.db_query("""
+        SELECT name, description FROM tags_meta
+        WHERE tagspace=%%s AND name IN (%s)
+        """ % ','.join(['%s'] * len(names)), [realm] + names))
+
+
+def set_resource_descriptions(env, realm, descriptions):
+    """Store descriptions of resources given as dict by resource ID."""
+    rows = [(realm, to_unicode(name), description)
+            for name, description in descriptions.iteritems()]
+    if rows:
+        with env.db_transaction as db:
+            db.executemany("""
+                DELETE FROM tags_meta WHERE tagspace=%s AND name=%s
+                """, [row[:2] for row in rows])
+            db.executemany("""
+                INSERT INTO tags_meta (tagspace, name, description)
+                VALUES (%s,%s,%s)
+                """, rows)
+
+
+def delete_resource_descriptions(env, realm, names=None):
+    """Delete stored descriptions of resources, or of the whole realm."""
+    with env.db_transaction as db:
+        if names is None:
+            db("DELETE FROM tags_meta WHERE tagspace=%s", (realm,))
+        else:
+            db.executemany("""
+                DELETE FROM tags_meta WHERE tagspace=%s AND name=%s
+                """, [(realm, to_unicode(name)) for name in names])
@@ -13,6 +13,7 @@ A generalised query parser and matcher.
 import re
 
 from trac.core import TracError
+from trac.util.text import to_unicode
 
 from tractags.api import _
 
@@ -163,6 +164,18 @@ class Query(QueryNode):
         representing the RHS of the attribute expression and context is a custom
         parameter passed to Query.__call__().
 
+        A handler may additionally carry a `prefilter` callable with the
+        signature (attribute_name, node, realm), that is evaluated once per
+        tag realm before any resources are fetched. It returns `True` or
+        `False`, if the expression is known to match all or none of the
+        resources in that realm, a set of resource IDs or an SQL condition
+        on the `name` column of the `tags` db table, that is satisfied by
+        exactly the matching resources, or `None`, if nothing is known in
+        advance. Conditions are either a string or a tuple of a string with
+        placeholders and a sequence of arguments. Results must be exact,
+        because negated expressions are evaluated from them too, see
+        `Query.as_filter()` and `tractags.index.TagIndex.evaluate()`.
+
         :param phrase: Query phrase.
         :param attribute_handlers: A dictionary of attribute handlers.
         """
@@ -295,6 +308,154 @@ class Query(QueryNode):
         return _match(node)
 
 
+    def prefilter(self, realm):
+        """Evaluate attribute handler prefilters for a tag realm.
+
+        Returns a tuple (possible, filter, ids). If `possible` is False, no
+        resource of the realm can match the query at all. Otherwise `filter`
+        is a list of SQL conditions and `ids` a set of candidate resource IDs
+        or `None`, collected from attribute expressions, that must match for
+        the whole query to match. Matching candidates still require
+        evaluation by `Query.__call__()`.
+
+        >>> def handler(name, node, context):
+        ...     return False
+        >>> handler.prefilter = lambda name, node, realm: realm == node.value
+        >>> q = Query('foo realm:wiki', attribute_handlers={'realm': handler})
+        >>> q.prefilter('wiki')
+        (True, [], None)
+        >>> q.prefilter('ticket')
+        (False, [], None)
+        >>> q = Query('foo or realm:wiki', attribute_handlers={'realm': handler})
+        >>> q.prefilter('ticket')
+        (True, [], None)
+        """
+        def _prefilter(node):
+            """Three-valued evaluation: True, False or None (unknown)."""
+            if not node or node.type in (None, node.NULL):
+                return True
+            elif node.type == node.AND:
+                left, right = _prefilter(node.left), _prefilter(node.right)
+                if left is False or right is False:
+                    return False
+                return left and right
+            elif node.type == node.OR:
+                left, right = _prefilter(node.left), _prefilter(node.right)
+                if left or right:
+                    return True
+                if left is None or right is None:
+                    return None
+                return False
+            elif node.type == node.NOT:
+                value = _prefilter(node.left)
+                if value is None:
+                    return None
+                return not value
+            elif node.type == node.ATTR:
+                value = _attr_prefilter(node)
+                if isinstance(value, bool):
+                    return value
+            return None
+
+        def _attr_prefilter(node):
+            handler = self.attribute_handlers.get(node.left.value)
+            prefilter = getattr(handler, 'prefilter', None)
+            if prefilter is None:
+                return None
+            return prefilter(node.left.value, node.right, realm)
+
+        def _conjuncts(node):
+            if node and node.type == node.AND:
+                for child in _conjuncts(node.left):
+                    yield child
+                for child in _conjuncts(node.right):
+                    yield child
+            elif node:
+                yield node
+
+        if _prefilter(self) is False:
+            return False, [], None
+        filter = []
+        ids = None
+        for node in _conjuncts(self):
+            if node.type != node.ATTR:
+                continue
+            value = _attr_prefilter(node)
+            if value is None or isinstance(value, bool):
+                continue
+            if isinstance(value, (basestring, tuple)):
+                filter.append(value)
+            else:
+                ids = ids is None and set(value) or ids.intersection(value)
+        if ids is not None and not ids:
+            return False, [], None
+        return True, filter, ids
+
+    def as_filter(self, realm):
+        """Compile the query into a single SQL condition for a tag realm.
+
+        The condition refers to columns of the `tags` db table, like filters
+        of `ITagProvider.get_tagged_resources()`, and selects exactly the
+        tagged resources matching the query, without requiring evaluation by
+        `Query.__call__()`. Returns `None`, if the query contains attribute
+        expressions without SQL-capable prefilter.
+
+        >>> def handler(name, node, context):
+        ...     return False
+        >>> handler.prefilter = lambda name, node, realm: set([node.value])
+        >>> q = Query('foo -bar page:Start', attribute_handlers={'page': handler})
+        >>> sql, args = q.as_filter('wiki')
+        >>> print sql
+        (name IN (SELECT t.name FROM tags t WHERE t.tagspace=%s AND t.tag=%s) AND (NOT (name IN (SELECT t.name FROM tags t WHERE t.tagspace=%s AND t.tag=%s)) AND name IN (%s)))
+        >>> args
+        ['wiki', 'foo', 'wiki', 'bar', u'Start']
+        >>> Query('foo page:Start').as_filter('wiki')
+        """
+        def _compile(node):
+            if not node or node.type in (None, node.NULL):
+                return '1=1', []
+            elif node.type == node.TERM:
+                return ('name IN (SELECT t.name FROM tags t'
+                        ' WHERE t.tagspace=%s AND t.tag=%s)'), \
+                       [realm, node.value]
+            elif node.type in (node.AND, node.OR):
+                left, left_args = _compile(node.left)
+                right, right_args = _compile(node.right)
+                op = node.type == node.AND and 'AND' or 'OR'
+                return '(%s %s %s)' % (left, op, right), left_args + right_args
+            elif node.type == node.NOT:
+                sql, args = _compile(node.left)
+                return 'NOT (%s)' % sql, args
+            elif node.type == node.ATTR:
+                return _compile_attr(node)
+            raise _Uncompilable()
+
+        def _compile_attr(node):
+            handler = self.attribute_handlers.get(node.left.value)
+            prefilter = getattr(handler, 'prefilter', None)
+            if prefilter is None:
+                raise _Uncompilable()
+            value = prefilter(node.left.value, node.right, realm)
+            if value is True:
+                return '1=1', []
+            elif value is False:
+                return '1=0', []
+            elif value is None:
+                raise _Uncompilable()
+            elif isinstance(value, tuple):
+                return '(%s)' % value[0], list(value[1])
+            elif isinstance(value, basestring):
+                return '(%s)' % value, []
+            elif not value:
+                return '1=0', []
+            return 'name IN (%s)' % ','.join(['%s'] * len(value)), \
+                   [to_unicode(name) for name in value]
+
+        try:
+            return _compile(self)
+        except _Uncompilable:
+            return None
+
     def _compile_call(self, text, attribute_handlers=None):
         import compiler
         import types
@@ -428,6 +589,10 @@ class Query(QueryNode):
     def _invalid_handler(self, name, node, context):
         raise InvalidQuery(_("Invalid attribute '%s'") % name)
 
+
+class _Uncompilable(Exception):
+    """Raised for query expressions without SQL equivalent."""
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
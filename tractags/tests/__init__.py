@@ -22,6 +22,9 @@ def test_suite():
     import tractags.tests.db
     suite.addTest(tractags.tests.db.test_suite())
 
+    import tractags.tests.index
+    suite.addTest(tractags.tests.index.test_suite())
+
     import tractags.tests.macros
     suite.addTest(tractags.tests.macros.test_suite())
 
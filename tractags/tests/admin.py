@@ -13,7 +13,23 @@ import unittest
 
 from trac.test import EnvironmentStub
 
-from tractags.admin import TagChangeAdminPanel
+from tractags.admin import TagAdminCommands, TagChangeAdminPanel
+
+
+class TagAdminCommandsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'tractags.*'])
+        self.env.path = tempfile.mkdtemp()
+
+        self.tag_ac = TagAdminCommands(self.env)
+
+    def tearDown(self):
+        shutil.rmtree(self.env.path)
+
+    def test_get_admin_commands(self):
+        self.assertEquals(['tags resync'],
+                          [cmd[0] for cmd in self.tag_ac.get_admin_commands()])
 
 
 class TagChangeAdminPanelTestCase(unittest.TestCase):
@@ -34,6 +50,7 @@ class TagChangeAdminPanelTestCase(unittest.TestCase):
 
 def test_suite():
     suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TagAdminCommandsTestCase))
     suite.addTest(unittest.makeSuite(TagChangeAdminPanelTestCase))
     return suite
 
@@ -16,15 +16,17 @@ import unittest
 
 from trac.core import implements
 from trac.perm import IPermissionRequestor, PermissionCache, PermissionError
-from trac.perm import PermissionSystem
+from trac.perm import DefaultPermissionPolicy, PermissionSystem
 from trac.resource import Resource
-from trac.test import EnvironmentStub, Mock
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.web.href import Href
+from trac.wiki.model import WikiPage
 
 import tractags.api
 
 from tractags.db import TagSetup
 from tractags.ticket import TicketTagProvider
-from tractags.wiki import WikiTagProvider
+from tractags.wiki import WikiTagInterface, WikiTagProvider
 
 
 class _BaseTestCase(unittest.TestCase):
@@ -55,6 +57,7 @@ class _BaseTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_meta")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -99,6 +102,82 @@ class TagPolicyTestCase(_BaseTestCase):
                                      PermissionCache(self.env,
                                                      username='other')), None)
 
+    def test_page_deleted(self):
+        resource = Resource('wiki', 'PublicPage')
+        perm = PermissionCache(self.env)
+        self.assertEquals(True, self.check('WIKI_MODIFY', 'anonymous',
+                                           resource, perm))
+        WikiTagInterface(self.env).wiki_page_deleted(WikiPage(self.env,
+                                                              'PublicPage'))
+        self.assertEquals(None, self.check('WIKI_MODIFY', 'anonymous',
+                                           resource, perm))
+
+    def test_ticket_sync(self):
+        resource = Resource('ticket', '5')
+        perm = PermissionCache(self.env)
+        provider = TicketTagProvider(self.env)
+        self.env.db_transaction("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES ('ticket', '5', 'anonymous:modify')
+            """)
+        policy = tractags.api.TagPolicy(self.env)
+        del policy._acl
+        self.assertEquals(True, self.check('TICKET_MODIFY', 'anonymous',
+                                           resource, perm))
+        # Tags of tickets, that don't exist, are removed.
+        provider._fetch_tkt_tags()
+        self.assertEquals(None, self.check('TICKET_MODIFY', 'anonymous',
+                                           resource, perm))
+
+    def test_permitted_resources(self):
+        resources = [Resource('wiki', name) for name in
+                     ('PublicPage', 'RestrictedPage', 'UserPage')]
+        req = Mock(authname='anonymous', perm=PermissionCache(self.env))
+        tag_s = tractags.api.TagSystem(self.env)
+        self.assertEquals(['PublicPage', 'UserPage'],
+                          [resource.id for resource in
+                           tag_s.permitted_resources(req, resources,
+                                                     'WIKI_VIEW')])
+        self.assertEquals(['PublicPage'],
+                          [resource.id for resource in
+                           tag_s.permitted_resources(req, resources,
+                                                     'WIKI_MODIFY')])
+        # Same decisions as checked per resource.
+        for action in ('WIKI_VIEW', 'WIKI_MODIFY'):
+            self.assertEquals([action in req.perm(resource)
+                               for resource in resources],
+                              [resource in tag_s.permitted_resources(
+                                   req, resources, action)
+                               for resource in resources])
+
+    def test_permitted_resources_cached(self):
+        self.env.config.set('tags', 'permission_cache_time', 3600)
+        resources = [Resource('wiki', name) for name in
+                     ('PublicPage', 'RestrictedPage', 'UserPage')]
+        tag_s = tractags.api.TagSystem(self.env)
+
+        def permitted():
+            req = Mock(authname='anonymous', perm=PermissionCache(self.env))
+            return [resource.id for resource in
+                    tag_s.permitted_resources(req, resources, 'WIKI_VIEW')]
+        self.assertEquals(['PublicPage', 'UserPage'], permitted())
+
+        # Unchanged tag generation, so decisions are reused.
+        with self.env.db_transaction as db:
+            db("""INSERT INTO tags (tagspace, name, tag)
+                  VALUES ('wiki', 'UserPage', 'anonymous:-view')""")
+        self.assertEquals(['PublicPage', 'UserPage'], permitted())
+
+        # Tag changes through TagSystem refresh all permission caches.
+        req = Mock(authname='admin', perm=MockPerm())
+        tag_s.add_tags(req, Resource('wiki', 'UserPage'), ['secret'])
+        self.assertEquals(['PublicPage'], permitted())
+
+        # Permission changes apply as soon as seen by Trac's policies.
+        self.perms.revoke_permission('anonymous', 'WIKI_VIEW')
+        DefaultPermissionPolicy(self.env).permission_cache = {}
+        self.assertEquals([], permitted())
+
 
 class TagSystemTestCase(_BaseTestCase):
 
@@ -133,6 +212,29 @@ class TagSystemTestCase(_BaseTestCase):
         # Shouldn't raise an error with appropriate permission.
         self.tag_s.set_tags(self.req, resource, tags)
 
+    def test_request_memo(self):
+        resource = Resource('wiki', 'WikiStart')
+        self.req.perm = PermissionCache(self.env, username='editor')
+        self.tag_s.set_tags(self.req, resource, ['tag1'])
+        self.assertEquals(set(['tag1']),
+                          self.tag_s.get_tags(self.req, resource))
+        self.assertEquals({'tag1': 1}, self.tag_s.get_all_tags(self.req))
+
+        # Changes by other means remain unseen during the request.
+        with self.env.db_transaction as db:
+            db("""INSERT INTO tags (tagspace, name, tag)
+                  VALUES ('wiki', 'WikiStart', 'tag2')""")
+        self.assertEquals(set(['tag1']),
+                          self.tag_s.get_tags(self.req, resource))
+        self.assertEquals({'tag1': 1}, self.tag_s.get_all_tags(self.req))
+
+        # Changes through the request discard memoized values.
+        self.tag_s.add_tags(self.req, resource, ['tag3'])
+        self.assertEquals(set(['tag1', 'tag2', 'tag3']),
+                          self.tag_s.get_tags(self.req, resource))
+        self.assertEquals({'tag1': 1, 'tag2': 1, 'tag3': 1},
+                          self.tag_s.get_all_tags(self.req))
+
     def test_query_no_args(self):
         # Regression test for query without argument,
         #   reported as th:ticket:7857.
@@ -143,6 +245,273 @@ class TagSystemTestCase(_BaseTestCase):
                            self.tag_s.query(self.req, query='')],
                           [])
 
+    def test_query_attribute_prefilter(self):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag)
+                VALUES (%s,%s,%s)
+                """, [('wiki', 'PageOne', 'tag1'),
+                      ('wiki', 'PageTwo', 'tag1')])
+        seen = []
+
+        def page_handler(name, node, context):
+            seen.append(context.id)
+            return context.id == node.value
+
+        page_handler.prefilter = lambda name, node, realm: set([node.value])
+        self.req.perm = PermissionCache(self.env)
+        result = self.tag_s.query(self.req, 'tag1 page:PageTwo',
+                                  attribute_handlers={'page': page_handler})
+        self.assertEquals([Resource('wiki', 'PageTwo')],
+                          [resource for resource, tags in result])
+        # Candidates are restricted before resources are fetched.
+        self.assertEquals(['PageTwo'], seen)
+
+    def test_query_realm_prefilter(self):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag)
+                VALUES (%s,%s,%s)
+                """, [('wiki', 'PageOne', 'tag1'),
+                      ('ticket', '1', 'tag1')])
+        self.req.perm = PermissionCache(self.env)
+        result = self.tag_s.query(self.req, 'tag1 (realm:wiki or realm:xyz)')
+        self.assertRaises(tractags.api.InvalidTagRealm, list, result)
+        result = self.tag_s.query(self.req, 'tag1 (realm:wiki or realm:wiki)')
+        self.assertEquals([Resource('wiki', 'PageOne')],
+                          [resource for resource, tags in result])
+
+    def test_query_bitmap_engine(self):
+        self.env.config.set('tags', 'query_engine', 'bitmap')
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag)
+                VALUES (%s,%s,%s)
+                """, [('wiki', 'PageOne', 'tag1'),
+                      ('wiki', 'PageTwo', 'obsolete'),
+                      ('ticket', '1', 'tag1')])
+        self.req.perm = PermissionCache(self.env, username='editor')
+        query = lambda q: sorted(resource.id for resource, tags
+                                 in self.tag_s.query(self.req, q))
+        self.assertEquals(['1', 'PageOne'], query('tag1'))
+        self.assertEquals(['PageOne'], query('-obsolete realm:wiki'))
+        # Index follows changes of tags.
+        self.tag_s.set_tags(self.req, Resource('wiki', 'PageTwo'), ['tag1'])
+        self.assertEquals(['1', 'PageOne', 'PageTwo'], query('tag1'))
+        self.tag_s.reparent_tags(self.req, Resource('wiki', 'PageThree'),
+                                 'PageTwo')
+        self.assertEquals(['PageOne', 'PageThree'], query('tag1 realm:wiki'))
+
+    def test_query_bitmap_engine_broad_query(self):
+        self.env.config.set('tags', 'query_engine', 'bitmap')
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag)
+                VALUES (%s,%s,%s)
+                """, [('wiki', 'Page%d' % i, 'tag%d' % (i % 2))
+                      for i in xrange(6)])
+        self.req.perm = PermissionCache(self.env, username='editor')
+        max_names = tractags.api.MAX_NAMES_FILTER
+        tractags.api.MAX_NAMES_FILTER = 2
+        try:
+            query = self.tag_s._parse_query('-tag1 realm:wiki')
+            tags, filter = self.tag_s._prefilter(
+                query, WikiTagProvider(self.env), self.tag_s._get_index())
+            # Not resolved into a list of resource IDs.
+            self.assertEquals(None, tags)
+            self.assertFalse([f for f in filter
+                              if isinstance(f, tuple) and
+                                 f[0].startswith('name IN (%s')])
+            self.assertEquals(['Page0', 'Page2', 'Page4'],
+                              sorted(resource.id for resource, tags
+                                     in self.tag_s.query(self.req,
+                                                         '-tag1 realm:wiki')))
+            self.assertEquals(3, self.tag_s.query_count(self.req,
+                                                         '-tag1 realm:wiki'))
+            self.assertEquals(['Page1', 'Page3'],
+                              [resource.id for resource, tags
+                               in self.tag_s.query_page(self.req, 'tag1', 2)])
+        finally:
+            tractags.api.MAX_NAMES_FILTER = max_names
+
+    def test_get_query_tags(self):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag)
+                VALUES (%s,%s,%s)
+                """, [('wiki', 'PageOne', 'tag1'),
+                      ('wiki', 'PageOne', 'tag2'),
+                      ('wiki', 'PageTwo', 'tag1'),
+                      ('wiki', 'PageThree', 'tag2'),
+                      ('ticket', '1', 'tag1')])
+        self.req.perm = PermissionCache(self.env, username='editor')
+        expected = {'tag1': 3, 'tag2': 1}
+        for engine in ('default', 'bitmap'):
+            self.env.config.set('tags', 'query_engine', engine)
+            self.assertEquals(expected,
+                              self.tag_s.get_query_tags(self.req, 'tag1'))
+        self.assertEquals({'tag1': 2, 'tag2': 1},
+                          self.tag_s.get_query_tags(self.req,
+                                                    'tag1 realm:wiki'))
+        # Counts are subject to view permission.
+        self.perms.revoke_permission('anonymous', 'TICKET_VIEW')
+        self.req.perm = PermissionCache(self.env)
+        self.assertEquals({'tag1': 2, 'tag2': 1},
+                          self.tag_s.get_query_tags(self.req, 'tag1'))
+
+    def test_get_query_tags_aggregate(self):
+        self.env.db_transaction("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES ('wiki', 'PageOne', 'tag1')
+            """)
+        self.req.perm = PermissionCache(self.env, username='editor')
+        provider = WikiTagProvider(self.env)
+        def get_tagged_resources(*args, **kwargs):
+            self.fail("Resources enumerated")
+        provider.get_tagged_resources = get_tagged_resources
+        # Counted by the db with the default query engine too.
+        self.assertEquals({'tag1': 1},
+                          self.tag_s.get_query_tags(self.req,
+                                                    'tag1 -tag2 realm:wiki'))
+
+    def test_get_query_tags_negated(self):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag)
+                VALUES (%s,%s,%s)
+                """, [('wiki', 'PageOne', 'tag1'),
+                      ('wiki', 'PageTwo', 'tag2'),
+                      ('wiki', 'PageThree', 'tag3')])
+        self.req.perm = PermissionCache(self.env, username='editor')
+        q = 'tag1 or -tag2 realm:wiki'
+        for engine in ('default', 'bitmap'):
+            self.env.config.set('tags', 'query_engine', engine)
+            # Same resources as listed by query().
+            expected = tractags.api.Counter()
+            for resource, tags in self.tag_s.query(self.req, q):
+                expected.update(tags)
+            self.assertEquals({'tag1': 1, 'tag3': 1}, expected)
+            self.assertEquals(expected,
+                              self.tag_s.get_query_tags(self.req, q))
+
+    def test_get_all_tags_mincount_limit(self):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag)
+                VALUES (%s,%s,%s)
+                """, [('wiki', 'PageOne', 'tag1'),
+                      ('wiki', 'PageOne', 'tag2'),
+                      ('wiki', 'PageTwo', 'tag1'),
+                      ('wiki', 'PageTwo', 'tag3'),
+                      ('wiki', 'PageThree', 'tag2'),
+                      ('ticket', '1', 'tag3'),
+                      ('ticket', '2', 'tag3')])
+        self.req.perm = PermissionCache(self.env, username='editor')
+        get_all_tags = self.tag_s.get_all_tags
+        self.assertEquals({'tag1': 2, 'tag2': 2},
+                          get_all_tags(self.req, ['wiki'], mincount=2))
+        self.assertEquals({'tag1': 2},
+                          get_all_tags(self.req, ['wiki'], limit=1))
+        # Counts are merged across realms before the cut.
+        self.assertEquals({'tag3': 3, 'tag1': 2, 'tag2': 2},
+                          get_all_tags(self.req, mincount=2))
+        self.assertEquals({'tag3': 3},
+                          get_all_tags(self.req, mincount=3))
+        self.assertEquals({'tag3': 3, 'tag1': 2},
+                          get_all_tags(self.req, limit=2))
+
+    def test_query_count_exists(self):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag)
+                VALUES (%s,%s,%s)
+                """, [('wiki', 'PageOne', 'tag1'),
+                      ('wiki', 'PageOne', 'tag2'),
+                      ('wiki', 'PageTwo', 'tag1'),
+                      ('wiki', 'PageTemplates/Tagged', 'tag1'),
+                      ('ticket', '1', 'tag1')])
+        self.req.perm = PermissionCache(self.env)
+        for policies in ('DefaultPermissionPolicy',
+                         'TagPolicy, DefaultPermissionPolicy'):
+            self.env.config.set('trac', 'permission_policies', policies)
+            for p in self.tag_s.tag_providers:
+                p.fast_permcheck = policies == 'DefaultPermissionPolicy'
+            count = lambda q: self.tag_s.query_count(self.req, q)
+            self.assertEquals(3, count('tag1'))
+            self.assertEquals(1, count('tag1 -tag2 realm:wiki'))
+            self.assertEquals(2, count('tag2 or tag1 realm:ticket'))
+            self.assertTrue(self.tag_s.query_exists(self.req, 'tag1 tag2'))
+            self.assertFalse(self.tag_s.query_exists(self.req,
+                                                     'tag2 realm:ticket'))
+            self.assertFalse(self.tag_s.query_exists(self.req, 'tag3'))
+
+    def test_query_page(self):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag)
+                VALUES (%s,%s,%s)
+                """, [('wiki', 'Page10', 'tag1'),
+                      ('wiki', 'Page2', 'tag1'),
+                      ('wiki', 'Page2', 'tag2'),
+                      ('wiki', 'PageTemplates/Tagged', 'tag1'),
+                      ('ticket', '2', 'tag1'),
+                      ('ticket', '10', 'tag1'),
+                      ('ticket', '11', 'tag2')])
+        self.req.perm = PermissionCache(self.env)
+        page = lambda *args, **kwargs: \
+               [(r.realm, r.id) for r, tags
+                in self.tag_s.query_page(self.req, 'tag1', *args, **kwargs)]
+        self.assertEquals([('ticket', '2'), ('ticket', '10'),
+                           ('wiki', 'Page2')], page(3))
+        self.assertEquals([('wiki', 'Page10')], page(3, offset=3))
+        self.assertEquals([('wiki', 'Page2'), ('wiki', 'Page10')],
+                          page(3, after=('ticket', '10')))
+        self.assertEquals([('wiki', 'Page10')], page(3, after=('wiki', 'Page2')))
+        self.assertEquals([], page(3, after=('wiki', 'Page10')))
+
+    def test_query_page_negated(self):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag)
+                VALUES (%s,%s,%s)
+                """, [('wiki', 'PageA', 'tag1'),
+                      ('wiki', 'PageB', 'tag2'),
+                      ('wiki', 'PageC', 'tag3'),
+                      ('ticket', '1', 'tag2')])
+        self.req.perm = PermissionCache(self.env)
+        q = 'tag1 or -tag2'
+        for engine in ('default', 'bitmap'):
+            self.env.config.set('tags', 'query_engine', engine)
+            # Resources matched by the negated term only are listed too.
+            page = [(r.realm, r.id) for r, tags
+                    in self.tag_s.query_page(self.req, q, 10)]
+            self.assertEquals([('wiki', 'PageA'), ('wiki', 'PageC')], page)
+            self.assertEquals(len(page), self.tag_s.query_count(self.req, q))
+            self.assertEquals(sorted(page),
+                              sorted((r.realm, r.id) for r, tags
+                                     in self.tag_s.query(self.req, q)))
+
+    def test_get_resource_url(self):
+        self.env.config.set('tags', 'wiki_page_prefix', 'tags/')
+        href = Href('/trac')
+        tag = Resource('tag', 'onion')
+        self.assertEquals('/trac/tags/onion',
+                          self.tag_s.get_resource_url(tag, href))
+        self.assertEquals('onion',
+                          self.tag_s.get_resource_description(tag))
+
+        page = WikiPage(self.env, 'tags/onion')
+        page.text = 'Layered tag.'
+        page.save('editor', 'Tag page', '::1')
+        self.assertEquals('/trac/wiki/tags/onion',
+                          self.tag_s.get_resource_url(tag, href))
+        self.assertEquals('tags/onion',
+                          self.tag_s.get_resource_description(tag))
+
+        page.delete()
+        self.assertEquals('/trac/tags/onion',
+                          self.tag_s.get_resource_url(tag, href))
+
     def test_get_taggable_realms(self):
 
         class HiddenTagProvider(tractags.api.DefaultTagProvider):
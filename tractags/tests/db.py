@@ -20,6 +20,7 @@ from trac.test import EnvironmentStub
 
 from tractags import db_default
 from tractags.db import TagSetup
+from tractags.model import natural_sort_key
 
 
 class TagSetupTestCase(unittest.TestCase):
@@ -46,6 +47,7 @@ class TagSetupTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_meta")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -74,7 +76,7 @@ class TagSetupTestCase(unittest.TestCase):
             cursor.execute("SELECT * FROM tags")
             cols = [col[0] for col in self._get_cursor_description(cursor)]
             self.assertEquals([], cursor.fetchall())
-            self.assertEquals(['tagspace', 'name', 'tag'], cols)
+            self.assertEquals(['tagspace', 'name', 'tag', 'sortkey'], cols)
         self.assertEquals(db_default.schema_version, self.get_db_version())
 
     def test_upgrade_schema_v1(self):
@@ -110,11 +112,11 @@ class TagSetupTestCase(unittest.TestCase):
         with self.env.db_query as db:
             cursor = db.cursor()
             cursor.execute("SELECT * FROM tags")
-            tags = cursor.fetchall()
+            tags = [row[:3] for row in cursor.fetchall()]
             cols = [col[0] for col in self._get_cursor_description(cursor)]
             # Db content should be migrated.
             self.assertEquals([('wiki', 'WikiStart', 'tag')], tags)
-            self.assertEquals(['tagspace', 'name', 'tag'], cols)
+            self.assertEquals(['tagspace', 'name', 'tag', 'sortkey'], cols)
             self.assertEquals(db_default.schema_version, self.get_db_version())
 
     def test_upgrade_schema_v2(self):
@@ -152,11 +154,11 @@ class TagSetupTestCase(unittest.TestCase):
         with self.env.db_query as db:
             cursor = db.cursor()
             cursor.execute("SELECT * FROM tags")
-            tags = cursor.fetchall()
+            tags = [row[:3] for row in cursor.fetchall()]
             cols = [col[0] for col in self._get_cursor_description(cursor)]
             # Db should be unchanged.
             self.assertEquals([('wiki', 'WikiStart', 'tag')], tags)
-            self.assertEquals(['tagspace', 'name', 'tag'], cols)
+            self.assertEquals(['tagspace', 'name', 'tag', 'sortkey'], cols)
             self.assertEquals(db_default.schema_version, self.get_db_version())
 
     def test_upgrade_schema_v3(self):
@@ -197,6 +199,73 @@ class TagSetupTestCase(unittest.TestCase):
                                'oldtags', 'newtags'], cols)
         self.assertEquals(db_default.schema_version, self.get_db_version())
 
+    def test_upgrade_schema_v4(self):
+        # Add natural sort key column to tags db table.
+        schema = [
+            Table('tags', key=('tagspace', 'name', 'tag'))[
+                Column('tagspace'),
+                Column('name'),
+                Column('tag'),
+                Index(['tagspace', 'name']),
+                Index(['tagspace', 'tag']),
+            ],
+            Table('tags_change', key=('tagspace', 'name', 'time'))[
+                Column('tagspace'),
+                Column('name'),
+                Column('time', type='int64'),
+                Column('author'),
+                Column('oldtags'),
+                Column('newtags'),
+            ]
+        ]
+        setup = TagSetup(self.env)
+        # Current tractags schema is setup with enabled component anyway.
+        #   Revert these changes for clean install testing.
+        self._revert_tractags_schema_init()
+
+        connector = self.db_mgr._get_connector()[0]
+        with self.env.db_transaction as db:
+            for table in schema:
+                for stmt in connector.to_sql(table):
+                    db(stmt)
+            db("""INSERT INTO tags (tagspace, name, tag)
+                  VALUES ('wiki', 'Page10', 'tag')""")
+            # Preset system db table with old version.
+            db("""INSERT INTO system (name, value)
+                  VALUES ('tags_version', '4')""")
+
+        self.assertEquals(4, setup.get_schema_version())
+        self.assertTrue(setup.environment_needs_upgrade())
+
+        setup.upgrade_environment()
+        self.assertFalse(setup.environment_needs_upgrade())
+        tags = self.env.db_query("SELECT * FROM tags")
+        self.assertEquals([('wiki', 'Page10', 'tag',
+                            natural_sort_key('Page10'))], tags)
+        self.assertEquals(db_default.schema_version, self.get_db_version())
+
+    def test_upgrade_schema_v5(self):
+        # Add table for precomputed resource descriptions.
+        setup = TagSetup(self.env)
+        self._revert_tractags_schema_init()
+        setup.upgrade_environment()
+        with self.env.db_transaction as db:
+            db("DROP TABLE tags_meta")
+            db("""UPDATE system SET value='5'
+                  WHERE name='tags_version'""")
+
+        self.assertEquals(5, setup.get_schema_version())
+        self.assertTrue(setup.environment_needs_upgrade())
+
+        setup.upgrade_environment()
+        self.assertFalse(setup.environment_needs_upgrade())
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            cursor.execute("SELECT * FROM tags_meta")
+            cols = [col[0] for col in self._get_cursor_description(cursor)]
+            self.assertEquals(['tagspace', 'name', 'description'], cols)
+        self.assertEquals(db_default.schema_version, self.get_db_version())
+
 
 def test_suite():
     suite = unittest.TestSuite()
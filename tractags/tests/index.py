@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2026 TracTags contributors
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from __future__ import with_statement
+
+import doctest
+import shutil
+import tempfile
+import unittest
+
+from trac.resource import Resource
+from trac.test import EnvironmentStub
+
+import tractags.index
+
+from tractags.db import TagSetup
+from tractags.index import TagIndex
+from tractags.model import bump_tags_generation, tag_resource
+from tractags.model import tags_generation
+from tractags.query import Query
+
+
+class TagIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'tractags.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = TagSetup(self.env)
+        # Current tractags schema is setup with enabled component anyway.
+        #   Revert these changes for getting a clean setup.
+        self._revert_tractags_schema_init()
+        setup.upgrade_environment()
+
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag)
+                VALUES (%s,%s,%s)
+                """, [('wiki', 'PageOne', 'tag1'),
+                      ('wiki', 'PageOne', 'obsolete'),
+                      ('wiki', 'PageTwo', 'tag1'),
+                      ('wiki', 'PageThree', 'tag2'),
+                      ('ticket', '1', 'tag1')])
+        self.index = TagIndex()
+        self.index.validate(self.env)
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    # Helpers
+
+    def _revert_tractags_schema_init(self):
+        with self.env.db_transaction as db:
+            db("DROP TABLE IF EXISTS tags")
+            db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_meta")
+            db("DELETE FROM system WHERE name='tags_version'")
+            db("DELETE FROM permission WHERE action %s" % db.like(),
+               ('TAGS_%',))
+
+    def _names(self, query, realm='wiki'):
+        def realm_handler(_, node, context):
+            return query.match(node, [context.realm])
+
+        realm_handler.prefilter = lambda _, node, realm: \
+                                  query.match(node, [realm])
+        query = Query(query, attribute_handlers={'realm': realm_handler})
+        matches = self.index.evaluate(query, realm)
+        return matches is not None and sorted(self.index.names(matches))
+
+    # Tests
+
+    def test_evaluate(self):
+        self.assertEquals(['PageOne', 'PageTwo'], self._names('tag1'))
+        self.assertEquals(['1'], self._names('tag1', 'ticket'))
+        self.assertEquals(['PageOne', 'PageThree', 'PageTwo'],
+                          self._names('tag1 or tag2'))
+        self.assertEquals(['PageThree', 'PageTwo'],
+                          self._names('-obsolete realm:wiki'))
+        self.assertEquals([], self._names('-obsolete realm:wiki', 'ticket'))
+        self.assertEquals([], self._names('tag1 tag2'))
+
+    def test_evaluate_exact(self):
+        """Index and SQL results equal full evaluation of queries."""
+        def realm_handler(_, node, context):
+            return query.match(node, [context.realm])
+
+        realm_handler.prefilter = lambda _, node, realm: \
+                                  query.match(node, [realm])
+        resources = {}
+        for realm, name, tag in self.env.db_query("""
+                SELECT tagspace, name, tag FROM tags"""):
+            resources.setdefault((realm, name), set()).add(tag)
+        for phrase in ('-tag1', '-tag1 -tag2', 'tag1 or -obsolete',
+                       '(tag1 or tag2) -obsolete', 'realm:ticket or tag2',
+                       '-tag1 or realm:ticket', '-obsolete realm:wiki',
+                       'realm:ticket or -obsolete -tag2'):
+            query = Query(phrase, attribute_handlers={'realm': realm_handler})
+            for realm in ('wiki', 'ticket'):
+                expected = sorted(name for (realm_, name), tags
+                                  in resources.iteritems()
+                                  if realm_ == realm and
+                                     query(tags, context=Resource(realm,
+                                                                  name)))
+                self.assertEquals(expected, self._names(phrase, realm),
+                                  (phrase, realm))
+                sql, args = query.as_filter(realm)
+                self.assertEquals(expected, [name for name, in
+                                             self.env.db_query("""
+                    SELECT DISTINCT name FROM tags
+                    WHERE tagspace=%%s AND %s ORDER BY name
+                    """ % sql, [realm] + args)], (phrase, realm))
+
+    def test_evaluate_unresolved(self):
+        query = Query('tag1 page:PageOne',
+                      attribute_handlers={'page': lambda *args: True})
+        self.assertEquals(None, self.index.evaluate(query, 'wiki'))
+
+    def test_update(self):
+        generation = self.index.generation
+        self.index.update('wiki', 'PageThree', set(['tag1']), generation + 1)
+        self.assertEquals(['PageOne', 'PageThree', 'PageTwo'],
+                          self._names('tag1'))
+        self.assertEquals([], self._names('tag2'))
+        self.index.update('wiki', 'PageFour', None, generation + 2,
+                          old_name='PageOne')
+        self.assertEquals(['PageFour'], self._names('obsolete'))
+        # Out-of-order changes are ignored.
+        self.index.update('wiki', 'PageFive', set(['tag2']), generation + 4)
+        self.assertEquals(generation + 2, self.index.generation)
+        self.assertEquals([], self._names('tag2'))
+
+    def test_complete(self):
+        realms = ['ticket', 'wiki']
+        self.assertEquals([('tag1', 3), ('tag2', 1)],
+                          self.index.complete('TAG', realms))
+        self.assertEquals([('tag1', 2)], self.index.complete('tag', ['wiki'],
+                                                             limit=1))
+        self.assertEquals([], self.index.complete('ag', realms))
+        self.assertEquals([('tag1', 3), ('tag2', 1)],
+                          self.index.complete('ag', realms, contains=True))
+        self.assertEquals([('obsolete', 1)],
+                          self.index.complete('sole', realms, contains=True))
+        self.assertEquals(['obsolete', 'tag1', 'tag2'],
+                          self.index.tag_names(realms))
+        self.assertEquals(['tag1'], self.index.tag_names(['ticket']))
+
+    def test_complete_unknown_substring(self):
+        realms = ['ticket', 'wiki']
+        self.assertEquals([], self.index.complete('zzzz', realms, 10, True))
+        self.assertEquals([], self.index.complete('tagz', realms, 10, True))
+        self.assertEquals([], self.index.complete('zzz', realms, None, True))
+
+    def test_complete_update(self):
+        generation = self.index.generation
+        self.index.update('wiki', 'PageOne', set(['tag2', 'Tag3']),
+                          generation + 1)
+        self.assertEquals([('tag1', 2), ('tag2', 2), ('Tag3', 1)],
+                          self.index.complete('tag', ['ticket', 'wiki']))
+        self.assertEquals([('Tag3', 1)],
+                          self.index.complete('g3', ['wiki'], contains=True))
+        self.assertEquals({'tag1': 1, 'tag2': 2, 'Tag3': 1},
+                          self.index.tag_counts(['wiki']))
+        self.assertEquals(['tag1', 'tag2', 'Tag3'],
+                          self.index.tag_names(['wiki']))
+
+    def test_update_replaced_tags(self):
+        resource = Resource('wiki', 'PageOne')
+        generation = tag_resource(self.env, resource,
+                                  tags=['tag1', 'tag2'])
+        self.assertEquals(self.index.generation + 1, generation)
+        self.index.update('wiki', 'PageOne', set(['tag1', 'tag2']),
+                          generation)
+        self.assertEquals(generation, self.index.generation)
+        # Applied in place, so validation doesn't require a rebuild.
+        def build(env, generation=None):
+            self.fail("Index rebuilt")
+        self.index.build = build
+        self.index.validate(self.env)
+        self.assertEquals(['PageOne', 'PageThree'], self._names('tag2'))
+        self.assertEquals([], self._names('obsolete'))
+
+    def test_validate(self):
+        with self.env.db_transaction as db:
+            db("""INSERT INTO tags (tagspace, name, tag)
+                  VALUES ('wiki', 'PageFour', 'tag2')""")
+            bump_tags_generation(db)
+        self.assertEquals(['PageThree'], self._names('tag2'))
+        self.index.validate(self.env)
+        self.assertEquals(tags_generation(self.env), self.index.generation)
+        self.assertEquals(['PageFour', 'PageThree'], self._names('tag2'))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(module=tractags.index))
+    suite.addTest(unittest.makeSuite(TagIndexTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
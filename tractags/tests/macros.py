@@ -15,29 +15,34 @@ import shutil
 import tempfile
 import unittest
 
+from trac.resource import Resource
 from trac.test import EnvironmentStub, Mock, MockPerm
-from trac.web.chrome import Chrome
+from trac.util.html import escape
+from trac.web.chrome import Chrome, web_context
 from trac.web.href import Href
+from trac.wiki.formatter import format_to_oneliner
 from trac.wiki.test import wikisyntax_test_suite
 
 from tractags.db import TagSetup
 from tractags.macros import TagWikiMacros, query_realms
+from tractags.model import bump_tags_generation, natural_sort_key
 
 
 def _revert_tractags_schema_init(env):
     with env.db_transaction as db:
         db("DROP TABLE IF EXISTS tags")
         db("DROP TABLE IF EXISTS tags_change")
+        db("DROP TABLE IF EXISTS tags_meta")
         db("DELETE FROM system WHERE name='tags_version'")
         db("DELETE FROM permission WHERE action %s" % db.like(),
            ('TAGS_%',))
 
 
 def _insert_tags(env, tagspace, name, tags):
-    args = [(tagspace, name, tag) for tag in tags]
+    args = [(tagspace, name, tag, natural_sort_key(name)) for tag in tags]
     with env.db_transaction as db:
         db.executemany("""
-            INSERT INTO tags (tagspace,name,tag) VALUES (%s,%s,%s)
+            INSERT INTO tags (tagspace,name,tag,sortkey) VALUES (%s,%s,%s,%s)
             """, args)
 
 
@@ -96,6 +101,25 @@ class ListTaggedMacroTestCase(_BaseTestCase):
                         str(self.tag_twm.expand_macro(formatter,
                                                       'ListTagged', '')))
 
+    def test_format_description(self):
+        context = web_context(self.req, Resource('wiki', 'ListTaggedPage'))
+        resource = Resource('wiki', 'TaggedPage')
+        for desc in ('plain heading ', 'Rich (text), 1.2 - x?', 'Wiki Start',
+                     'WikiStart', "''Italic''", 'see r1 or #1', '',
+                     'a [[span(macro)]]', 'a {{{#!span processor}}}'):
+            self.assertEquals(format_to_oneliner(self.env, context, desc),
+                              self.tag_twm._format_description(context,
+                                                               resource, desc))
+        # Neither plain text nor descriptions with links, macros or
+        # processors are cached.
+        self.assertEquals(3, len(self.tag_twm._oneliners))
+        cached = [self.tag_twm._oneliners.get(key)
+                  for key in self.tag_twm._oneliners.keys()]
+        self.assertFalse([html for html in cached
+                          if '<span>' in html or '<code>' in html])
+        self.tag_twm._invalidate(resource)
+        self.assertEquals([], self.tag_twm._oneliners.keys())
+
     def test_listtagged_exclude(self):
         self._insert_tags('wiki', 'InterTrac', ('blah',))
         self._insert_tags('wiki', 'InterWiki', ('blah',))
@@ -132,6 +156,8 @@ class ListTaggedMacroTestCase(_BaseTestCase):
         self.assertTrue('InterTrac' in result)
         self.assertTrue('InterWiki' in result)
         self.assertFalse('WikiStart' in result)
+        self.assertTrue('listtagged_after=wiki%3AInterWiki' in
+                        self.req.chrome['links']['next'][0]['href'])
 
     def test_listtagged_paginate_page2(self):
         """Paginate results for page 2 has one item."""
@@ -154,6 +180,32 @@ class ListTaggedMacroTestCase(_BaseTestCase):
         self.assertTrue('InterWiki' in result)
         self.assertFalse('WikiStart' in result)
 
+    def test_listtagged_paginate_after(self):
+        """Next page resumes after the last resource of previous page."""
+        self.req.args['listtagged_after'] = 'wiki:InterTrac'
+        result = self._test_listtagged_paginate(2)
+        self.assertFalse('InterTrac' in result)
+        self.assertTrue('InterWiki' in result)
+        self.assertTrue('WikiStart' in result)
+
+    def test_listtagged_async(self):
+        """Asynchronous calls render a placeholder to load results from."""
+        self._insert_tags('wiki', 'WikiStart', ('blah',))
+        context = Mock(env=self.env, href=Href('/'), req=self.req)
+        formatter = Mock(context=context, req=self.req)
+        result = unicode(self.tag_twm.expand_macro(formatter, 'ListTagged',
+                                                   'blah,async=true'))
+        self.assertFalse('WikiStart' in result)
+        self.assertTrue('<div class="listtagged-async">' in result)
+        self.assertTrue('href="/tags/api/listtagged?q=blah%2Casync%3Dtrue"'
+                        in result)
+        self.assertTrue('tags/js/listtagged.js' in
+                        self.req.chrome['scriptset'])
+        result = unicode(self.tag_twm.expand_macro(formatter, 'ListTagged',
+                                                   'blah,async=true',
+                                                   fragment=True))
+        self.assertTrue('WikiStart' in result)
+
     def test_listtagged_paginate_per_page_invalid(self):
         """Invalid per_page defaults to items_per_page (100)."""
         result = self._test_listtagged_paginate(2, -1)
@@ -198,6 +250,12 @@ class TagCloudMacroTestCase(_BaseTestCase):
 
     def setUp(self):
         _BaseTestCase.setUp(self)
+        self._new_request()
+        self.tag_twm = TagWikiMacros(self.env)
+
+    # Helpers
+
+    def _new_request(self):
         self.req = Mock(path_info='/wiki/TagCloudPage',
                         args={}, authname='user', perm=MockPerm(),
                         href=Href('/'),
@@ -206,10 +264,6 @@ class TagCloudMacroTestCase(_BaseTestCase):
         self.context = Mock(env=self.env, href=self.req.href, req=self.req)
         self.formatter = Mock(context=self.context, req=self.req)
 
-        self.tag_twm = TagWikiMacros(self.env)
-
-    # Helpers
-
     def _expand_macro(self, content):
         return self.tag_twm.expand_macro(self.formatter, 'TagCloud', content)
 
@@ -264,6 +318,64 @@ class TagCloudMacroTestCase(_BaseTestCase):
         result = unicode(self._expand_macro('mincount=100'))
         self.assertEquals('No tags found', result)
 
+    def test_cached(self):
+        self._insert_tags('wiki', 'CamelCase', ('blah',))
+        result = unicode(self._expand_macro(''))
+        self.assertTrue('">blah</a>' in result, repr(result))
+
+        # Unchanged generation of tags, rendered tag cloud is reused.
+        self._insert_tags('wiki', 'SandBox', ('foo',))
+        self.assertEquals(result, unicode(self._expand_macro('')))
+
+        with self.env.db_transaction as db:
+            bump_tags_generation(db)
+        # Tags are read once per request.
+        self._new_request()
+        result = unicode(self._expand_macro(''))
+        self.assertTrue('">foo</a>' in result, repr(result))
+
+    def test_render_cloud_links(self):
+        with self.env.db_transaction as db:
+            db("""INSERT INTO wiki (name, version, text)
+                  VALUES ('bar', 1, 'Tag page')""")
+        cloud = {'bar': 1, 'a b&c': 2, u'd\xe9+': 3, 'x/y': 4, '"q"': 5}
+        for realms in ([], ['ticket', 'wiki']):
+            result = unicode(self.tag_twm.render_cloud(self.req, cloud,
+                                                       realms=realms))
+            for tag in cloud:
+                href = self.tag_twm.get_href(self.req, realms,
+                                             tag=Resource('tag', tag))
+                self.assertTrue(u'href="%s"' % escape(href) in result,
+                                (href, result))
+                self.assertTrue(u'>%s</a>' % escape(tag) in result)
+        self.assertTrue('href="/wiki/bar"' in result)
+        self.assertEquals(1, result.count('<li class="last">'))
+        # Custom renderers get the same tags.
+        result = unicode(self.tag_twm.render_cloud(self.req, cloud,
+                         renderer=lambda tag, count, percent:
+                                  '%s:%s:%.1f' % (tag, count, percent)))
+        self.assertTrue('<li class="last">x/y:4:0.6</li>' in result, result)
+
+    def test_max_tags(self):
+        self._insert_tags('wiki', 'CamelCase', ('blah', 'foo', 'bar'))
+        self._insert_tags('wiki', 'InterWiki', ('blah', 'foo'))
+        self._insert_tags('wiki', 'SandBox', ('blah',))
+        result = unicode(self._expand_macro('max_tags=2'))
+        self.assertTrue('">blah</a>' in result, repr(result))
+        self.assertTrue('">foo</a>' in result, repr(result))
+        self.assertFalse('">bar</a>' in result, repr(result))
+        self.assertTrue('<a href="/wiki/TagCloudPage?tagcloud_max_tags=0">'
+                        'Show all tags</a>' in result, repr(result))
+        self.req.args['tagcloud_max_tags'] = '0'
+        result = unicode(self._expand_macro('max_tags=2'))
+        self.assertTrue('">bar</a>' in result, repr(result))
+        self.assertFalse('Show all' in result, repr(result))
+        # Repeated request arguments are part of the cache key too.
+        del self.req.args['tagcloud_max_tags']
+        self.req.args['realm'] = ['wiki', 'ticket']
+        result = unicode(self._expand_macro('max_tags=2'))
+        self.assertTrue('realm=wiki&amp;realm=ticket' in result, repr(result))
+
 
 class QueryRealmsTestCase(unittest.TestCase):
     def test_query_realms(self):
@@ -8,6 +8,7 @@
 
 from __future__ import with_statement
 
+import doctest
 import shutil
 import tempfile
 import unittest
@@ -16,8 +17,12 @@ from trac.perm import PermissionCache, PermissionSystem
 from trac.resource import Resource
 from trac.test import EnvironmentStub, Mock
 
+import tractags.model
+
 from tractags.db import TagSetup
-from tractags.model import resource_tags, tag_resource, tagged_resources
+from tractags.model import resource_tags, sorted_tagged_resources
+from tractags.model import tag_frequencies, tag_frequency, tag_resource
+from tractags.model import tagged_resources, update_sort_keys
 from tractags.wiki import WikiTagProvider
 
 
@@ -54,6 +59,7 @@ class TagModelTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_meta")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -94,12 +100,74 @@ class TagModelTestCase(unittest.TestCase):
                                               self.realm, tags)],
                          [(resource, tags)])
 
+    def test_tag_frequency(self):
+        self.env.db_transaction.executemany("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES (%s,%s,%s)
+            """, [('wiki', 'PageOne', 'tag1'), ('wiki', 'PageOne', 'tag2'),
+                  ('wiki', 'PageTwo', 'tag2'), ('ticket', '1', 'tag2')])
+        self.assertEquals([('tag1', 2), ('tag2', 2)],
+                          sorted(tag_frequency(self.env, self.realm)))
+        self.assertEquals([('tag1', 2), ('tag2', 2)],
+                          list(tag_frequency(self.env, self.realm, limit=5)))
+        self.assertEquals([('tag1', 2)],
+                          list(tag_frequency(self.env, self.realm, limit=1,
+                                             mincount=2)))
+        self.assertEquals([], list(tag_frequency(self.env, self.realm,
+                                                 mincount=3)))
+
+    def test_tag_frequencies(self):
+        self.env.db_transaction.executemany("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES (%s,%s,%s)
+            """, [('wiki', 'PageOne', 'tag2'), ('ticket', '1', 'tag2'),
+                  ('ticket', '2', 'tag3'), ('ticket', '3', 'tag3')])
+        realm_filters = [('wiki', ["name!='WikiStart'"]), ('ticket', [])]
+        self.assertEquals([('tag2', 2), ('tag3', 2)],
+                          sorted(tag_frequencies(self.env, realm_filters)))
+        self.assertEquals([('tag2', 2)],
+                          list(tag_frequencies(self.env, realm_filters,
+                                               limit=1)))
+        self.assertEquals([('tag1', 1), ('tag2', 2), ('tag3', 2)],
+                          sorted(tag_frequencies(self.env,
+                                                 [('wiki', []),
+                                                  ('ticket', [])])))
+        self.assertEquals([], list(tag_frequencies(self.env, [])))
+
     def test_reparent(self):
         resource = Resource(self.realm, 'TaggedPage')
         old_name = 'WikiStart'
         tag_resource(self.env, resource, 'WikiStart', self.req.authname)
         self.assertEquals(dict(TaggedPage=set(['tag1'])), self._tags())
 
+    def test_sorted_tagged_resource(self):
+        for name in ('Page10', 'Page9', 'page1', 'Page'):
+            tag_resource(self.env, Resource(self.realm, name),
+                         author=self.req.authname, tags=['tag1'])
+        tag_resource(self.env, Resource(self.realm, 'Page11'), 'Page9',
+                     self.req.authname)
+        names = lambda **kwargs: [res.id for res, tags in
+                                  sorted_tagged_resources(self.env, self.realm,
+                                                          batch=2, **kwargs)]
+        self.assertEquals(['Page', 'Page10', 'Page11', 'WikiStart', 'page1'],
+                          names())
+        self.assertEquals(['Page10', 'Page11', 'WikiStart', 'page1'],
+                          names(start='Page10'))
+        self.assertEquals(['Page', 'Page11', 'page1'],
+                          names(perm_filter=lambda resources:
+                                [res for res in resources if res.id in
+                                 ('Page', 'Page11', 'page1')]))
+        # Rows written without sort key, like WikiStart's, are paged alike.
+        with self.env.db_transaction as db:
+            db("""INSERT INTO tags (tagspace, name, tag)
+                  VALUES (%s, 'Page10', 'tag2')""", (self.realm,))
+        self.assertEquals(['Page', 'Page10', 'Page11', 'WikiStart', 'page1'],
+                          names())
+        self.assertEquals(['WikiStart', 'page1'], names(start='Page12'))
+        self.assertEquals(2, update_sort_keys(self.env))
+        self.assertEquals(['Page', 'Page10', 'Page11', 'WikiStart', 'page1'],
+                          names())
+
     def test_tag_changes(self):
         # Add previously untagged resource.
         resource = Resource(self.realm, 'TaggedPage')
@@ -130,6 +198,7 @@ class TagModelTestCase(unittest.TestCase):
 
 def test_suite():
     suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(module=tractags.model))
     suite.addTest(unittest.makeSuite(TagModelTestCase))
     return suite
 
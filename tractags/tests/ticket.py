@@ -22,6 +22,7 @@ from trac.util.text import to_unicode
 
 from tractags.api import TagSystem
 from tractags.db import TagSetup
+from tractags.model import bump_tags_generation
 from tractags.ticket import TicketTagProvider
 
 
@@ -75,6 +76,7 @@ class TicketTagProviderTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_meta")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -141,6 +143,44 @@ class TicketTagProviderTestCase(unittest.TestCase):
             self.provider.describe_tagged_resource(self.req, resource),
             'defect: summary')
 
+    def test_describe_tagged_resources(self):
+        self._create_ticket(self.tags, status='closed', resolution='fixed')
+        resources = [Resource('ticket', 1), Resource('ticket', 2),
+                     Resource('ticket', 3)]
+        self.assertEquals({1: 'defect: summary',
+                           2: 'defect: summary (closed: fixed)', 3: ''},
+                          self.provider.describe_tagged_resources(self.req,
+                                                                  resources))
+
+    def test_get_ticket_summaries(self):
+        self._create_ticket(self.tags, status='closed', resolution='fixed')
+        resources = [Resource('ticket', 2), Resource('ticket', 'x')]
+        self.assertEquals({2: {'summary': 'summary', 'status': 'closed',
+                               'resolution': 'fixed', 'type': 'defect'}},
+                          self.provider.get_ticket_summaries(self.req,
+                                                             resources))
+        self.perms.revoke_permission('anonymous', 'TICKET_VIEW')
+        self.assertEquals({},
+                          self.provider.get_ticket_summaries(
+                              Mock(perm=PermissionCache(self.env)),
+                              resources))
+
+    def test_fetch_tkt_tags_index(self):
+        self.env.config.set('tags', 'query_engine', 'bitmap')
+        for i in range(3):
+            self._create_ticket(['foo'], status='new')
+        with self.env.db_transaction as db:
+            db("DELETE FROM tags WHERE tag='foo'")
+            bump_tags_generation(db)
+        # Build the index before syncing tags of several tickets.
+        self.assertEquals([], self.tag_sys.complete_tags(self.req, 'fo'))
+        self.provider._fetch_tkt_tags()
+        self.assertEquals([('foo', 3)],
+                          self.tag_sys.complete_tags(self.req, 'fo'))
+        self.assertEquals(['2', '3', '4'],
+                          sorted(resource.id for resource, tags in
+                                 self.tag_sys.query(self.req, 'foo')))
+
     def test_create_ticket_by_anonymous(self):
         ticket = self._create_ticket(self.tags, reporter='anonymous')
         tags = self.provider.get_resource_tags(self.req, ticket.resource)
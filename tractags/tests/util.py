@@ -6,12 +6,15 @@
 # you should have received as part of this distribution.
 #
 
+import doctest
 import shutil
 import tempfile
 import unittest
 
 from trac.test import EnvironmentStub
 
+import tractags.util
+
 from tractags.util import MockReq
 
 
@@ -33,6 +36,7 @@ class MockReqTestCase(unittest.TestCase):
 
 def test_suite():
     suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(module=tractags.util))
     suite.addTest(unittest.makeSuite(MockReqTestCase))
     return suite
 
@@ -10,14 +10,16 @@
 
 from __future__ import with_statement
 
+import json
 import shutil
 import tempfile
 import unittest
 
 from trac.test import EnvironmentStub, Mock, MockPerm
 from trac.perm import PermissionSystem, PermissionCache, PermissionError
+from trac.resource import Resource
 from trac.util.datefmt import utc
-from trac.web.api import _RequestArgs, RequestDone
+from trac.web.api import _RequestArgs, Request, RequestDone
 from trac.web.href import Href
 from trac.web.main import RequestDispatcher
 from trac.web.session import DetachedSession
@@ -76,6 +78,7 @@ class _BaseTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_meta")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -87,6 +90,7 @@ class TagInputAutoCompleteTestCase(_BaseTestCase):
         _BaseTestCase.setUp(self)
         self.req = Mock()
         self.req.perm = MockPerm()
+        self.req.session = {}
         self.tac = TagInputAutoComplete(self.env)
 
     # Tests
@@ -110,31 +114,98 @@ class TagInputAutoCompleteTestCase(_BaseTestCase):
         self.env.config.set('tags', 'separator', "' '")
         self.assertEqual(' ', self.tac.separator)
 
-    def test_get_keywords_no_keywords(self): 
-        self.assertEqual('', self.tac._get_keywords_string(self.req))
+    def _insert_tags(self, tagspace, name, tags):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace,name,tag) VALUES (%s,%s,%s)
+                """, [(tagspace, name, tag) for tag in tags])
+
+    def test_get_completions_no_keywords(self):
+        self.assertEqual([], self.tac._get_completions(self.req, ''))
 
-    def test_get_keywords_define_in_config(self):
+    def test_get_completions_define_in_config(self):
         self.env.config.set('tags', 'complete_sticky_tags',
                             'tag1, tag2, tag3')
-        self.assertEqual("'tag1','tag2','tag3'",
-                         self.tac._get_keywords_string(self.req))
+        self.assertEqual(['tag1', 'tag2', 'tag3'],
+                         self.tac._get_completions(self.req, ''))
 
-    def test_keywords_are_sorted(self):
-        self.env.config.set('tags', 'complete_sticky_tags',
-                            'tagb, tagc, taga')
-        self.assertEqual("'taga','tagb','tagc'",
-                         self.tac._get_keywords_string(self.req))
-    
-    def test_keywords_duplicates_removed(self):
+    def test_get_completions_duplicates_removed(self):
         self.env.config.set('tags', 'complete_sticky_tags',
                             'tag1, tag1, tag2')
-        self.assertEqual("'tag1','tag2'",
-                         self.tac._get_keywords_string(self.req))
-
-    def test_keywords_quoted_for_javascript(self):
-        self.env.config.set('tags', 'complete_sticky_tags', 'it\'s, "this"')
-        self.assertEqual('\'\\"this\\"\',\'it\\\'s\'',
-                         self.tac._get_keywords_string(self.req))
+        self._insert_tags('wiki', 'WikiStart', ('tag2',))
+        # Tags in use rank before unused ones.
+        self.assertEqual(['tag2', 'tag1'],
+                         self.tac._get_completions(self.req, ''))
+
+    def test_get_completions_ranked(self):
+        self.env.config.set('tags', 'complete_sticky_tags', 'ab')
+        self._insert_tags('wiki', 'WikiStart', ('abc', 'Abd', 'xab'))
+        self._insert_tags('wiki', 'SandBox', ('abd',))
+        self._insert_tags('ticket', '1', ('abd', 'xab'))
+        # Prefix matches first, sticky tags and then frequent tags first.
+        self.assertEqual(['ab', 'abd', 'Abd', 'abc', 'xab'],
+                         self.tac._get_completions(self.req, 'ab'))
+        self.assertEqual(['ab', 'abd'],
+                         self.tac._get_completions(self.req, 'ab', 2))
+        self.env.config.set('tags', 'complete_matchcontains', False)
+        self.assertEqual(['ab', 'abd', 'Abd', 'abc'],
+                         self.tac._get_completions(self.req, 'AB'))
+
+    def test_get_completions_recent(self):
+        self.env.config.set('tags', 'recent_tags_size', 3)
+        self._insert_tags('wiki', 'SandBox', ('abc', 'abd', 'abe'))
+        self._insert_tags('ticket', '1', ('abc', 'abd'))
+        with self.env.db_transaction as db:
+            db("""INSERT INTO session (sid, authenticated, last_visit)
+                  VALUES ('writer', 1, 42)""")
+        session = DetachedSession(self.env, 'writer')
+        req = self._create_request(authname='writer', perm=MockPerm(),
+                                   session=session)
+        self.tag_s.set_tags(req, Resource('wiki', 'WikiStart'), ['abf'])
+        self.tag_s.add_tags(req, Resource('wiki', 'WikiStart'),
+                            ['abe', 'xyz'])
+        self.assertEqual(['abe', 'xyz', 'abf'],
+                         self.tag_s.get_recent_tags(req))
+        # Recently applied tags rank first among prefix matches.
+        self.assertEqual(['abe', 'abf', 'abc', 'abd'],
+                         self.tac._get_completions(req, 'ab'))
+        req.session.save()
+        # Tags applied on behalf of the user are kept in the stored session.
+        mock_req = Mock(authname='writer', perm=MockPerm(), session={})
+        self.tag_s.set_tags(mock_req, Resource('wiki', 'SandBox'),
+                            ['abc', 'abd', 'abe', 'abg'])
+        self.assertEqual({}, mock_req.session)
+        session = DetachedSession(self.env, 'writer')
+        self.assertEqual('abg abe xyz', session['tags.recent'])
+
+    def test_complete_request(self):
+        self._insert_tags('wiki', 'WikiStart', ('it\'s', '"this"'))
+        headers = {}
+        req = self._create_request(authname='reader', perm=MockPerm(),
+                                   path_info='/tags/api/complete',
+                                   args={'q': 't'}, method='GET',
+                                   get_header=headers.get)
+        sent = {}
+
+        def check_modified(datetime, extra=''):
+            sent['extra'] = extra
+
+        def send(content, content_type='text/html', status=200):
+            sent.update(content=content, content_type=content_type)
+            raise RequestDone
+        req.check_modified = check_modified
+        req.send = send
+        self.assertTrue(self.tac.match_request(req))
+        self.assertFalse(self.tag_rh.match_request(req))
+        self.assertRaises(RequestDone, self.tac.process_request, req)
+        self.assertEqual('application/json', sent['content_type'])
+        self.assertEqual('["\\"this\\"","it\'s"]', sent['content'])
+
+    def test_complete_request_no_permission(self):
+        self._insert_tags('wiki', 'WikiStart', ('tag1',))
+        req = self._create_request(path_info='/tags/api/complete',
+                                   args={'q': 't'}, method='GET')
+        self.assertRaises(PermissionError, self.tac.process_request, req)
 
     def test_implements_irequestfilter(self):
         from trac.web.main import RequestDispatcher
@@ -144,9 +215,27 @@ class TagInputAutoCompleteTestCase(_BaseTestCase):
         from trac.web.chrome import Chrome
         self.assertTrue(self.tac in Chrome(self.env).template_providers)
 
-    def test_implements_itemplatestreamfilter(self):
-        from trac.web.chrome import Chrome
-        self.assertTrue(self.tac in Chrome(self.env).stream_filters)
+    def test_post_process_request_script_data(self):
+        self.env.config.set('tags', 'ticket_help', '/wiki/TagsHelp')
+        req = self._create_request(path_info='/newticket')
+        self.tac.post_process_request(req, 'ticket.html', {}, None)
+        opts = req.chrome['script_data']['tags_autocomplete']
+        self.assertEqual('#field-keywords', opts['field'])
+        self.assertEqual('/trac.cgi/tags/api/complete', opts['url'])
+        self.assertEqual('/trac.cgi/wiki/TagsHelp', opts['help_href'])
+        self.assertIn('tags/js/autocomplete.js', req.chrome['scriptset'])
+
+        req = self._create_request(path_info='/wiki/WikiStart')
+        self.tac.post_process_request(req, 'wiki_edit.html', {}, None)
+        opts = req.chrome['script_data']['tags_autocomplete']
+        self.assertEqual('#tags', opts['field'])
+        self.assertNotIn('help_href', opts)
+
+    def test_post_process_request_nothing_to_inject(self):
+        req = self._create_request(path_info='/wiki/WikiStart')
+        self.tac.post_process_request(req, 'wiki_view.html', {}, None)
+        self.assertNotIn('script_data', req.chrome)
+        self.assertNotIn('scriptset', req.chrome)
 
 
 class TagRequestHandlerTestCase(_BaseTestCase):
@@ -177,7 +266,8 @@ class TagRequestHandlerTestCase(_BaseTestCase):
                    chrome=dict(static_hash='hashme!'),
                    session=DetachedSession(self.env, 'reader'),
                    locale='',
-                   tz=''
+                   tz='',
+                   check_modified=lambda datetime, extra='': None
                 )
         template, data, content_type = self.tag_rh.process_request(req)
         self.assertEquals('tag_view.html', template)
@@ -186,6 +276,169 @@ class TagRequestHandlerTestCase(_BaseTestCase):
                            'tag_body', 'tag_query', 'tag_realms'],
                            sorted(data.keys()))
 
+    def _get_conditional(self, path_info, etag=None):
+        headers = {}
+        req = Mock(path_info=path_info, args={}, authname='reader',
+                   perm=self.reader, href=self.href, abs_href=self.abs_href,
+                   method='GET', chrome=dict(static_hash='hashme!'),
+                   session=DetachedSession(self.env, 'reader'), locale='',
+                   tz=utc, lc_time=None, callbacks={},
+                   get_header={'If-None-Match': etag}.get,
+                   send_header=headers.__setitem__,
+                   send_response=lambda code: headers.update(status=code),
+                   end_headers=lambda: None)
+        req.check_modified = lambda *args: \
+                             Request.check_modified.im_func(req, *args)
+        try:
+            self.tag_rh.process_request(req)
+        except RequestDone:
+            return headers.get('status')
+        return headers['ETag']
+
+    def test_get_page_not_modified(self):
+        self.tag_s.add_tags(Mock(authname='admin', perm=MockPerm()),
+                            Resource('wiki', 'WikiStart'), ['tag1'])
+        etag = self._get_conditional('/tags')
+        self.assertEqual(304, self._get_conditional('/tags', etag))
+        listing_etag = self._get_conditional('/tags/tag1')
+        self.assertNotEqual(etag, listing_etag)
+        self.assertEqual(304, self._get_conditional('/tags/tag1',
+                                                    listing_etag))
+        # Tag changes invalidate all pages.
+        self.tag_s.add_tags(Mock(authname='admin', perm=MockPerm()),
+                            Resource('wiki', 'WikiStart'), ['tag2'])
+        self.assertNotIn(self._get_conditional('/tags', etag), (304, etag))
+        new_etag = self._get_conditional('/tags/tag1', listing_etag)
+        self.assertNotIn(new_etag, (304, listing_etag))
+        # So do changes of listed resources.
+        with self.env.db_transaction as db:
+            db("""INSERT INTO wiki (name, version, time, text)
+                  VALUES ('WikiStart', 1, 42, 'Welcome')""")
+        self.assertNotIn(self._get_conditional('/tags/tag1', new_etag),
+                         (304, new_etag))
+
+    def _get_api(self, path_info, **args):
+        sent = {}
+
+        def send(content, content_type='text/html', status=200):
+            if not isinstance(content, basestring):
+                content = ''.join(content)
+            sent.update(content=json.loads(content), status=status,
+                        content_type=content_type)
+            raise RequestDone
+        req = Mock(path_info=path_info, args=_RequestArgs(args),
+                   authname='admin', perm=PermissionCache(self.env, 'admin'),
+                   session={}, check_modified=lambda datetime, extra='': None, send=send)
+        self.assertTrue(self.tag_rh.match_request(req))
+        self.assertRaises(RequestDone, self.tag_rh.process_request, req)
+        self.assertEqual('application/json', sent['content_type'])
+        return sent['status'], sent['content']
+
+    def _insert_api_tags(self):
+        PermissionSystem(self.env).grant_permission('admin', 'WIKI_VIEW')
+        req = Mock(authname='admin', perm=MockPerm())
+        for name, tags in (('PageA', ['tag1']), ('PageB', ['tag1', 'tag2']),
+                           ('PageC', ['tag2'])):
+            self.tag_s.set_tags(req, Resource('wiki', name), tags)
+
+    def test_api_query(self):
+        self._insert_api_tags()
+        self.assertEqual((200, {'next': None, 'results': [
+                              {'realm': 'wiki', 'id': 'PageA',
+                               'tags': ['tag1']},
+                              {'realm': 'wiki', 'id': 'PageB',
+                               'tags': ['tag1', 'tag2']}]}),
+                         self._get_api('/tags/api/query', q='tag1'))
+        self.assertEqual((200, {'next': 'wiki:PageB', 'results': [
+                              {'realm': 'wiki', 'id': 'PageA'},
+                              {'realm': 'wiki', 'id': 'PageB'}]}),
+                         self._get_api('/tags/api/query', q='', limit='2',
+                                       fields='id'))
+        self.assertEqual((200, {'next': None, 'results': [
+                              {'realm': 'wiki', 'id': 'PageC'}]}),
+                         self._get_api('/tags/api/query', q='', limit='2',
+                                       fields='id', after='wiki:PageB'))
+        self.assertEqual((200, {'next': None, 'results': []}),
+                         self._get_api('/tags/api/query', q='tag1',
+                                       realm='ticket'))
+        self.assertEqual(404, self._get_api('/tags/api/query', q='tag1',
+                                            realm='milestone')[0])
+        self.assertEqual(400, self._get_api('/tags/api/query',
+                                            after='PageB')[0])
+        self.assertEqual(400, self._get_api('/tags/api/query',
+                                            fields='description')[0])
+        self.assertEqual(400, self._get_api('/tags/api/query',
+                                            q='(tag1')[0])
+
+    def test_api_count_cloud_tags(self):
+        self._insert_api_tags()
+        self.assertEqual((200, {'count': 2}),
+                         self._get_api('/tags/api/count', q='tag2'))
+        self.assertEqual((200, {'tags': {'tag1': 2, 'tag2': 2}}),
+                         self._get_api('/tags/api/cloud'))
+        self.assertEqual((200, {'tags': {'tag1': 1, 'tag2': 2}}),
+                         self._get_api('/tags/api/cloud', q='tag2'))
+        self.assertEqual((200, {'tags': {'tag2': 2}}),
+                         self._get_api('/tags/api/cloud', q='tag2',
+                                       mincount='2'))
+        self.assertEqual((200, {'realm': 'wiki', 'id': 'PageB',
+                                'tags': ['tag1', 'tag2']}),
+                         self._get_api('/tags/api/tags/wiki/PageB'))
+        self.assertEqual(404, self._get_api('/tags/api/tags/milestone/m1')[0])
+        self.assertEqual(404, self._get_api('/tags/api/unknown')[0])
+
+    def test_api_realm_restriction(self):
+        self._insert_api_tags()
+        PermissionSystem(self.env).grant_permission('admin', 'TICKET_VIEW')
+        self.env.db_transaction("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES ('ticket', '1', 'tag3')
+            """)
+        ticket_only = (200, {'next': None, 'results': [
+                           {'realm': 'ticket', 'id': '1', 'tags': ['tag3']}]})
+        self.assertEqual(ticket_only,
+                         self._get_api('/tags/api/query', realm='ticket'))
+        self.assertEqual((200, {'count': 1}),
+                         self._get_api('/tags/api/count', realm='ticket'))
+        self.assertEqual((200, {'tags': {'tag3': 1}}),
+                         self._get_api('/tags/api/cloud', realm='ticket'))
+        # Realm restrictions in the query narrow results further.
+        self.assertEqual(ticket_only,
+                         self._get_api('/tags/api/query', realm='ticket',
+                                       q='realm:wiki or realm:ticket'))
+        self.assertEqual((200, {'count': 0}),
+                         self._get_api('/tags/api/count', realm='ticket',
+                                       q='realm:wiki'))
+        self.assertEqual((200, {'tags': {}}),
+                         self._get_api('/tags/api/cloud', realm='ticket',
+                                       q='realm:wiki'))
+
+    def test_listtagged_fragment(self):
+        self._insert_api_tags()
+        sent = {}
+
+        def send(content, content_type='text/html', status=200):
+            sent.update(content=content, content_type=content_type)
+            raise RequestDone
+        req = Mock(path_info='/tags/api/listtagged',
+                   args=_RequestArgs(q='tag1 or tag2,async=true',
+                                     listtagged_per_page='2'),
+                   authname='admin', perm=PermissionCache(self.env, 'admin'),
+                   href=self.href, abs_href=self.abs_href, chrome={},
+                   session={}, locale=None, tz=utc, lc_time=None,
+                   check_modified=lambda datetime, extra='': None, send=send)
+        self.assertTrue(self.tag_rh.match_request(req))
+        self.assertRaises(RequestDone, self.tag_rh.process_request, req)
+        self.assertEqual('text/html', sent['content_type'])
+        self.assertTrue('PageA' in sent['content'])
+        self.assertFalse('PageC' in sent['content'])
+        self.assertFalse('listtagged-async' in sent['content'])
+        # Pager links refer to the fragment.
+        self.assertTrue('/trac/tags/api/listtagged?' in
+                        req.chrome['links']['next'][0]['href'])
+        self.assertTrue('q=tag1+or+tag2%2Casync%3Dtrue' in
+                        req.chrome['links']['next'][0]['href'])
+
     def test_get_main_page_no_permission(self):
         req = Mock(path_info='/tags',
                    args={},
@@ -212,10 +465,6 @@ class TagTimelineEventFilterTestCase(_BaseTestCase):
         from trac.web.main import RequestDispatcher
         self.assertTrue(self.tef in RequestDispatcher(self.env).filters)
 
-    def test_implements_itemplatestreamfilter(self):
-        from trac.web.chrome import Chrome
-        self.assertTrue(self.tef in Chrome(self.env).stream_filters)
-
     def test_tag_query_save(self):
         """Save timeline tag query string in session."""
         self.assertEqual('tag_query', self.tef.key)
@@ -231,6 +480,10 @@ class TagTimelineEventFilterTestCase(_BaseTestCase):
         dispatcher = RequestDispatcher(self.env)
         self.assertRaises(RequestDone, dispatcher.dispatch, req)
         self.assertEqual('query_str', req.session['timeline.tag_query'])
+        # Rendering the page moves script data to early_script_data.
+        opts = req.chrome['early_script_data']['tags_timeline']
+        self.assertEqual('tag_query', opts['key'])
+        self.assertEqual('query_str', opts['value'])
 
 
 class TagTimelineEventProviderTestCase(_BaseTestCase):
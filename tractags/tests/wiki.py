@@ -16,8 +16,11 @@ import unittest
 from trac.perm import PermissionCache, PermissionError, PermissionSystem
 from trac.resource import Resource
 from trac.test import EnvironmentStub, Mock
+from trac.wiki.model import WikiPage
 from trac.wiki.test import wikisyntax_test_suite
 
+import tractags.wiki
+
 from tractags.api import TagSystem
 from tractags.db import TagSetup
 from tractags.wiki import WikiTagProvider
@@ -27,6 +30,7 @@ def _revert_tractags_schema_init(env):
     with env.db_transaction as db:
         db("DROP TABLE IF EXISTS tags")
         db("DROP TABLE IF EXISTS tags_change")
+        db("DROP TABLE IF EXISTS tags_meta")
         db("DELETE FROM system WHERE name='tags_version'")
         db("DELETE FROM permission WHERE action %s" % db.like(),
            ('TAGS_%',))
@@ -229,7 +233,87 @@ class WikiTagProviderTestCase(unittest.TestCase):
         tags = ['tag1', 'tag2']
         self.assertEquals(self.tag_s.get_all_tags(self.req).keys(), self.tags)
         self.env.config.set('tags', 'query_exclude_wiki_templates', False)
-        self.assertEquals(self.tag_s.get_all_tags(self.req).keys(), tags)
+        req = Mock(authname='editor', perm=PermissionCache(self.env))
+        self.assertEquals(self.tag_s.get_all_tags(req).keys(), tags)
+
+    def test_exclude_template_tags_completion(self):
+        self.env.db_transaction("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES ('wiki', 'PageTemplates/Template', 'tag2')
+            """)
+        self.assertEquals([('tag1', 1)],
+                          self.tag_s.complete_tags(self.req, 'tag'))
+        self.assertEquals(['tag1'], self.tag_s.get_tag_names(self.req))
+        self.env.config.set('tags', 'query_exclude_wiki_templates', False)
+        req = Mock(authname='editor', perm=PermissionCache(self.env))
+        self.assertEquals([('tag1', 1), ('tag2', 1)],
+                          self.tag_s.complete_tags(req, 'tag'))
+        self.assertEquals(['tag1', 'tag2'], self.tag_s.get_tag_names(req))
+
+    def test_describe_tagged_resources(self):
+        page = WikiPage(self.env, 'WikiStart')
+        page.text = '= Old heading ='
+        page.save('editor', 'Initial version')
+        page.text = 'Intro\n\n= The heading =\n\n== Section ==\n'
+        page.save('editor', 'Changed heading')
+        self.env.db_transaction("DELETE FROM tags_meta")
+        resources = [Resource('wiki', 'WikiStart'),
+                     Resource('wiki', 'MissingPage')]
+        self.assertEquals({'WikiStart': 'The heading ', 'MissingPage': ''},
+                          self.tag_wp.describe_tagged_resources(self.req,
+                                                                resources))
+        self.assertEquals({('wiki', 'WikiStart'): 'The heading ',
+                           ('wiki', 'MissingPage'): ''},
+                          self.tag_s.describe_tagged_resources(self.req,
+                                                               resources))
+        # Missing descriptions are computed, but not stored by reads.
+        self.assertEquals([], self.env.db_query("SELECT * FROM tags_meta"))
+
+    def test_descriptions_maintained(self):
+        meta = lambda: self.env.db_query("""
+            SELECT name, description FROM tags_meta ORDER BY name""")
+        page = WikiPage(self.env, 'TaggedPage')
+        page.text = '= Heading ='
+        page.save('editor', 'Initial version')
+        # Untagged pages are skipped.
+        self.assertEquals([], meta())
+        self.env.db_transaction("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES ('wiki', 'TaggedPage', 'tag1')
+            """)
+        page.text = '= New heading ='
+        page.save('editor', 'Changed heading')
+        self.assertEquals([('TaggedPage', 'New heading ')], meta())
+        # Unchanged descriptions aren't written again.
+        set_descriptions = tractags.wiki.set_resource_descriptions
+        def fail(*args):
+            self.fail("Description written")
+        tractags.wiki.set_resource_descriptions = fail
+        try:
+            page.text = '= New heading =\n\nMore text'
+            page.save('editor', 'Changed text only')
+        finally:
+            tractags.wiki.set_resource_descriptions = set_descriptions
+        page.rename('RenamedPage')
+        self.assertEquals([('RenamedPage', 'New heading ')], meta())
+        page.delete()
+        self.assertEquals([], meta())
+
+    def test_sync_descriptions(self):
+        page = WikiPage(self.env, 'WikiStart')
+        page.text = '= Heading ='
+        page.save('editor', 'Initial version')
+        self.env.db_transaction("DELETE FROM tags_meta")
+        # Untagged pages are skipped.
+        self.env.db_transaction("DELETE FROM tags")
+        self.assertEquals(0, self.tag_wp.sync_descriptions())
+        self.env.db_transaction("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES ('wiki', 'WikiStart', 'tag1')
+            """)
+        self.assertEquals(1, self.tag_wp.sync_descriptions())
+        self.assertEquals([('wiki', 'WikiStart', 'Heading ')],
+                          self.env.db_query("SELECT * FROM tags_meta"))
 
     def test_set_tags_no_perms(self):
         resource = Resource('wiki', 'TaggedPage')
@@ -17,11 +17,13 @@ from trac.perm import PermissionError
 from trac.resource import Resource
 from trac.ticket.api import ITicketChangeListener, TicketSystem
 from trac.ticket.model import Ticket
-from trac.util import get_reporter_id
+from trac.util import as_int, get_reporter_id
 from trac.util.text import to_unicode
 
-from tractags.api import DefaultTagProvider, _
-from tractags.model import delete_tags
+from tractags.api import DefaultTagProvider, TagSystem, _
+from tractags.api import uses_default_permission_policies
+from tractags.model import bump_tags_generation, delete_tags, filter_sql
+from tractags.model import natural_sort_key, sorted_tagged_resources
 from tractags.util import MockReq, split_into_tags
 
 
@@ -55,11 +57,7 @@ class TicketTagProvider(DefaultTagProvider):
             self._fetch_tkt_tags()
         except self.env.db_exc.IntegrityError, e:
             self.log.warn('tags for ticket already exist: %s', to_unicode(e))
-        cfg = self.config
-        cfg_key = 'permission_policies'
-        default_policies = cfg.defaults().get('trac', {}).get(cfg_key)
-        self.fast_permcheck = all(p in default_policies for
-                                  p in cfg.get('trac', cfg_key))
+        self.fast_permcheck = uses_default_permission_policies(self.config)
 
     def _check_permission(self, req, resource, action):
         """Optionally coarse-grained permission check."""
@@ -70,29 +68,81 @@ class TicketTagProvider(DefaultTagProvider):
         return self.check_permission(perm, action) and \
                self.map[action] in perm
 
+    def _get_all_tags_filter(self, req, filter=None):
+        if not self._check_permission(req, None, 'view'):
+            return None
+        return filter or []
+
     def get_tagged_resources(self, req, tags=None, filter=None):
         if not self._check_permission(req, None, 'view'):
             return
 
-        if not tags:
+        if not (tags or filter):
             # Cache 'all tagged resources' for better performance.
-            for resource, tags in self._tagged_resources:
-                if self.fast_permcheck or \
-                        self._check_permission(req, resource, 'view'):
-                    yield resource, tags
+            tagged_resources = list(self._tagged_resources)
         else:
+            sql, args = filter_sql(filter)
+            args = [self.realm] + args
+            if tags:
+                sql += """ AND name IN (SELECT name FROM tags
+                                        WHERE tagspace=%%s AND tag IN (%s))
+                       """ % ', '.join(['%s'] * len(tags))
+                args += [self.realm] + list(tags)
+            tagged_resources = []
             for name, tags in groupby(self.env.db_query("""
-                    SELECT ts.name, ts.tag FROM tags
-                     LEFT JOIN tags ts ON (tags.tagspace=ts.tagspace
-                                           AND tags.name=ts.name)
-                    WHERE tags.tagspace=%%s AND tags.tag IN (%s)
-                    ORDER by ts.name
-                    """ % ', '.join(['%s'] * len(tags)),
-                    [self.realm] + list(tags)), lambda row: row[0]):
-                resource = Resource(self.realm, name)
-                if self.fast_permcheck or \
-                        self._check_permission(req, resource, 'view'):
-                    yield resource, set([tag[1] for tag in tags])
+                    SELECT name, tag FROM tags
+                    WHERE tagspace=%%s%s
+                    ORDER by name
+                    """ % sql, args), lambda row: row[0]):
+                tagged_resources.append((Resource(self.realm, name),
+                                         set([tag[1] for tag in tags])))
+        if not self.fast_permcheck:
+            # Check permissions for all resources at once.
+            permitted = set(resource.id for resource in
+                            self.permitted_resources(req,
+                                [resource for resource, tags
+                                 in tagged_resources], 'view'))
+            tagged_resources = [(resource, tags)
+                                for resource, tags in tagged_resources
+                                if resource.id in permitted]
+        for resource, tags in tagged_resources:
+            yield resource, tags
+
+    def get_last_change(self):
+        for changetime, in self.env.db_query("""
+                SELECT MAX(changetime) FROM ticket
+                """):
+            return changetime or 0
+
+    def get_sorted_tagged_resources(self, req, tags=None, filter=None,
+                                    start=None):
+        if not self._check_permission(req, None, 'view'):
+            return []
+        perm_filter = None
+        if not self.fast_permcheck:
+            perm_filter = lambda resources: \
+                          self.permitted_resources(req, resources, 'view')
+        return sorted_tagged_resources(self.env, self.realm, tags, filter,
+                                       start, perm_filter)
+
+    def permitted_resources(self, req, resources, action):
+        if not self._check_permission(req, None, action):
+            return []
+        if self.fast_permcheck:
+            return list(resources)
+        return TagSystem(self.env).permitted_resources(req, resources,
+                                                       self.map[action])
+
+    def count_tagged_resources(self, req, filter=None):
+        if not self._check_permission(req, None, 'view'):
+            return 0
+        return super(TicketTagProvider, self).count_tagged_resources(req,
+                                                                     filter)
+
+    def has_tagged_resources(self, req, filter=None):
+        if not self._check_permission(req, None, 'view'):
+            return False
+        return super(TicketTagProvider, self).has_tagged_resources(req, filter)
 
     def get_resource_tags(self, req, resource):
         assert resource.realm == self.realm
@@ -161,6 +211,40 @@ class TicketTagProvider(DefaultTagProvider):
         else:
             return ''
 
+    def describe_tagged_resources(self, req, resources):
+        if not self.check_permission(req.perm, 'view'):
+            return dict((resource.id, '') for resource in resources)
+        ticket_system = TicketSystem(self.env)
+        tickets = self.get_ticket_summaries(req, resources)
+        descriptions = {}
+        for resource in resources:
+            fields = tickets.get(as_int(resource.id, None))
+            descriptions[resource.id] = fields and \
+                ticket_system.format_summary(fields['summary'] or '',
+                                             fields['status'],
+                                             fields['resolution'],
+                                             fields['type']) or ''
+        return descriptions
+
+    def get_ticket_summaries(self, req, resources):
+        """Return summary, status, resolution and type of tickets at once.
+
+        Returns a dict with ticket IDs (int) as keys, skipping invalid IDs.
+        """
+        if not self._check_permission(req, None, 'view'):
+            return {}
+        ids = [int(resource.id) for resource in resources
+               if to_unicode(resource.id).isdigit()]
+        tickets = {}
+        if ids:
+            for id, summary, status, resolution, type in self.env.db_query("""
+                    SELECT id, summary, status, resolution, type FROM ticket
+                    WHERE id IN (%s)
+                    """ % ','.join(['%s'] * len(ids)), ids):
+                tickets[id] = {'summary': summary, 'status': status,
+                               'resolution': resolution, 'type': type}
+        return tickets
+
     # ITicketChangeListener methods
 
     def ticket_created(self, ticket):
@@ -185,7 +269,8 @@ class TicketTagProvider(DefaultTagProvider):
     def ticket_deleted(self, ticket):
         """Called when a ticket is deleted."""
         # Ticket gone, so remove all records on it.
-        delete_tags(self.env, ticket.resource, purge=True)
+        generation = delete_tags(self.env, ticket.resource, purge=True)
+        self._tags_changed(ticket.resource, set(), generation)
         if self.use_cache:
             # Invalidate resource cache.
             del self._tagged_resources
@@ -200,7 +285,7 @@ class TicketTagProvider(DefaultTagProvider):
         ignore = ''
         if self.ignore_closed_tickets:
             ignore = " AND status != 'closed'"
-        with self.env.db_query as db:
+        with self.env.db_transaction as db:
             sql = """
                   SELECT *
                   FROM (SELECT id, %s, %s AS std_fields
@@ -217,23 +302,35 @@ class TicketTagProvider(DefaultTagProvider):
             ro_cursor = db.cursor()
             rw_cursor = db.cursor()
             # Delete tags for non-existent ticket
-            rw_cursor.execute("""
-                DELETE FROM tags
+            stale = """
                  WHERE tagspace=%%s
                    AND NOT EXISTS (SELECT * FROM ticket AS tkt
                                    WHERE tkt.id=%s%s)
-                """ % (db.cast('tags.name', 'int'), ignore),
-                (self.realm,))
+                """ % (db.cast('tags.name', 'int'), ignore)
+            ro_cursor.execute("SELECT DISTINCT name FROM tags" + stale,
+                              (self.realm,))
+            # Resources with changed tags, for notifying listeners.
+            changes = [(name, set()) for name, in ro_cursor]
+            if changes:
+                rw_cursor.execute("DELETE FROM tags" + stale, (self.realm,))
 
             ro_cursor.execute(sql, (self.realm,))
 
             for row in ro_cursor:
                 tkt_id, ttags = row[0], ' '.join([f for f in row[1:-1] if f])
                 ticket_tags = split_into_tags(ttags)
+                sortkey = natural_sort_key(tkt_id)
                 rw_cursor.executemany("""
-                    INSERT INTO tags (tagspace, name, tag)
-                    VALUES (%s, %s, %s)
-                    """, [(self.realm, str(tkt_id), tag) for tag in ticket_tags])
+                    INSERT INTO tags (tagspace, name, tag, sortkey)
+                    VALUES (%s, %s, %s, %s)
+                    """, [(self.realm, str(tkt_id), tag, sortkey)
+                          for tag in ticket_tags])
+                changes.append((str(tkt_id), ticket_tags))
+            # One generation per change, for in-place index updates.
+            changes = [(name, tags, bump_tags_generation(db))
+                       for name, tags in changes]
+        for name, tags, generation in changes:
+            self._tags_changed(Resource(self.realm, name), tags, generation)
 
     try:
         from trac.cache import cached
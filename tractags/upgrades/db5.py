@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2026 TracTags contributors
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from trac.db import Table, Column, Index, DatabaseManager
+
+from tractags.model import natural_sort_key
+
+schema = [
+    Table('tags', key=('tagspace', 'name', 'tag'))[
+        Column('tagspace'),
+        Column('name'),
+        Column('tag'),
+        Column('sortkey'),
+        Index(['tagspace', 'name']),
+        Index(['tagspace', 'tag']),
+        Index(['tagspace', 'sortkey']),
+    ]
+]
+
+
+def do_upgrade(env, ver, cursor):
+    """Add natural sort key column to tags db table."""
+
+    cursor.execute("CREATE TEMPORARY TABLE tags_old AS SELECT * FROM tags")
+    cursor.execute("DROP TABLE tags")
+
+    connector = DatabaseManager(env)._get_connector()[0]
+    for table in schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
+
+    cursor.execute("SELECT tagspace, name, tag FROM tags_old")
+    rows = [(tagspace, name, tag, natural_sort_key(name))
+            for tagspace, name, tag in cursor.fetchall()]
+    cursor.executemany("""
+        INSERT INTO tags
+               (tagspace, name, tag, sortkey)
+        VALUES (%s,%s,%s,%s)
+        """, rows)
+    cursor.execute("DROP TABLE tags_old")
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2026 TracTags contributors
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from trac.db import Table, Column, DatabaseManager
+
+schema = [
+    Table('tags_meta', key=('tagspace', 'name'))[
+        Column('tagspace'),
+        Column('name'),
+        Column('description'),
+    ]
+]
+
+
+def do_upgrade(env, ver, cursor):
+    """Add new table for precomputed resource descriptions.
+
+    The table is filled on demand, or at once by `trac-admin tags resync`.
+    """
+
+    connector = DatabaseManager(env)._get_connector()[0]
+    for table in schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
@@ -8,9 +8,17 @@
 # you should have received as part of this distribution.
 #
 
+from __future__ import with_statement
+
 import re
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+from collections import OrderedDict
 from functools import partial
 
+from genshi.core import END, START
 from trac.test import Mock, MockPerm
 from trac.web.api import _RequestArgs
 
@@ -33,3 +41,162 @@ def query_realms(query, all_realms):
 def split_into_tags(text):
     """Split plain text into tags."""
     return set(filter(None, [tag.strip() for tag in _TAG_SPLIT.split(text)]))
+
+
+def element_filter(test, content=None, after=False):
+    """Return a Genshi stream filter, that appends `content` to elements
+    matching `test`, or inserts it after them. Without `content`, matching
+    elements are removed.
+
+    `test` is called with tag name and attributes of every start tag. Unlike
+    a `Transformer`, the filter neither buffers nor marks events, but passes
+    them through while tracking nesting below matching elements only.
+
+    >>> from genshi.input import HTML
+    >>> html = HTML(u'<div><p id="a">x</p><p>y</p></div>')
+    >>> is_a = lambda name, attrs: attrs.get('id') == 'a'
+    >>> print(html | element_filter(is_a, HTML(u'<b>z</b>')))
+    <div><p id="a">x<b>z</b></p><p>y</p></div>
+    >>> print(html | element_filter(is_a, HTML(u'<b>z</b>'), after=True))
+    <div><p id="a">x</p><b>z</b><p>y</p></div>
+    >>> print(html | element_filter(is_a))
+    <div><p>y</p></div>
+    """
+    def _filter(stream):
+        depth = 0
+        for event in stream:
+            kind = event[0]
+            if depth:
+                if kind is START:
+                    depth += 1
+                elif kind is END:
+                    depth -= 1
+                if content is None:
+                    continue
+                if depth == 0 and not after:
+                    for child in content:
+                        yield child
+                yield event
+                if depth == 0 and after:
+                    for child in content:
+                        yield child
+            elif kind is START and test(event[1][0].localname, event[1][1]):
+                depth = 1
+                if content is not None:
+                    yield event
+            else:
+                yield event
+    return _filter
+
+
+class LRUCache(object):
+    """Bounded, thread-safe mapping, that discards least recently used items.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3
+    >>> sorted(cache.keys())
+    ['a', 'c']
+    >>> cache.discard(lambda key: key == 'c')
+    >>> cache.keys()
+    ['a']
+    """
+
+    def __init__(self, capacity):
+        self.capacity = max(capacity, 0)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def keys(self):
+        with self._lock:
+            return self._items.keys()
+
+    def discard(self, predicate):
+        """Remove all items with keys matching `predicate`."""
+        with self._lock:
+            for key in [key for key in self._items if predicate(key)]:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class GenerationalCache(object):
+    """Bounded cache of values computed from versioned source data.
+
+    Values are valid for one generation of their source data only. Missing
+    or outdated values are computed by one caller at a time per key: others
+    get the outdated value meanwhile, if there is one, or wait for the
+    computation to complete.
+
+    >>> cache = GenerationalCache(10)
+    >>> cache.get('key', 1, lambda: 'first')
+    'first'
+    >>> cache.get('key', 1, lambda: 'second')
+    'first'
+    >>> cache.get('key', 2, lambda: 'second')
+    'second'
+    """
+
+    def __init__(self, capacity, timeout=10):
+        self.timeout = timeout
+        self._entries = LRUCache(capacity)
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def get(self, key, generation, compute):
+        """Return the value for `key` and `generation`, computing it by
+        calling `compute` without arguments if required.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == generation:
+            return entry[1]
+        with self._lock:
+            event = self._pending.get(key)
+            if event is None:
+                event = self._pending[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            if entry is None:
+                event.wait(self.timeout)
+                entry = self._entries.get(key)
+            if entry is not None:
+                # Serve the outdated value during recomputation.
+                return entry[1]
+            return compute()
+        try:
+            value = compute()
+            self._entries[key] = (generation, value)
+            return value
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+
+    def clear(self):
+        self._entries.clear()
@@ -12,30 +12,33 @@
 
 import re
 
+from datetime import datetime
 from genshi.builder import tag as builder
-from genshi.core import Markup
-from genshi.filters.transform import Transformer
+from genshi.core import Stream
 
 from trac import __version__ as trac_version
-from trac.config import BoolOption, ListOption, Option
+from trac.config import BoolOption, IntOption, ListOption, Option
 from trac.core import implements
 from trac.resource import Resource, ResourceSystem, get_resource_name
 from trac.resource import get_resource_url
 from trac.timeline.api import ITimelineEventProvider
 from trac.util import to_unicode
-from trac.util.text import javascript_quote, unicode_quote_plus
+from trac.util.datefmt import utc
+from trac.util.presentation import to_json
+from trac.util.text import unicode_quote_plus
 from trac.web import IRequestFilter
-from trac.web.api import IRequestHandler, ITemplateStreamFilter
+from trac.web.api import IRequestHandler
 from trac.web.chrome import Chrome, INavigationContributor
-from trac.web.chrome import add_ctxtnav, add_script, add_stylesheet
+from trac.web.chrome import add_ctxtnav, add_script, add_script_data
+from trac.web.chrome import add_stylesheet
 from trac.web.chrome import add_warning, web_context
 from trac.wiki.formatter import Formatter
 from trac.wiki.model import WikiPage
 
-from tractags.api import REALM_RE, TagSystem, _, tag_, tagn_
+from tractags.api import REALM_RE, InvalidTagRealm, TagSystem, _, tag_, tagn_
 from tractags.macros import TagTemplateProvider, TagWikiMacros, as_int
 from tractags.macros import query_realms
-from tractags.model import tag_changes
+from tractags.model import tag_changes, tags_generation
 from tractags.query import InvalidQuery, Query
 from tractags.util import split_into_tags
 
@@ -47,7 +50,7 @@ class TagInputAutoComplete(TagTemplateProvider):
     0.5dev.
     """
 
-    implements(IRequestFilter, ITemplateStreamFilter)
+    implements(IRequestFilter, IRequestHandler)
 
     field_opt = Option('tags', 'complete_field', 'keywords',
         "Ticket field to which a drop-down tag list should be attached.")
@@ -74,6 +77,12 @@ class TagInputAutoComplete(TagTemplateProvider):
     sticky_tags_opt = ListOption('tags', 'complete_sticky_tags', '', ',',
         doc="A list of comma separated values available for input.")
 
+    min_length_opt = IntOption('tags', 'complete_min_length', 1,
+        "Number of characters to type before tags are suggested.")
+
+    max_results_opt = IntOption('tags', 'complete_max_results', 20,
+        "Maximum number of tags suggested at once.")
+
     def __init__(self):
         self.tags_enabled = self.env.is_enabled(TagSystem)
 
@@ -87,131 +96,84 @@ class TagInputAutoComplete(TagTemplateProvider):
         return handler
 
     def post_process_request(self, req, template, data, content_type):
-        if template is not None and \
-                (req.path_info.startswith('/ticket/') or
-                 req.path_info.startswith('/newticket') or
-                 (self.tags_enabled and req.path_info.startswith('/wiki/'))):
-            # In Trac 1.0 and later, jQuery-UI is included from the core.
-            if trac_version >= '1.0':
-                Chrome(self.env).add_jquery_ui(req)
-            else:
-                add_script(req, 'tags/js/jquery-ui-1.8.16.custom.min.js')
-                add_stylesheet(req, 'tags/css/jquery-ui-1.8.16.custom.css')
+        if template == 'ticket.html':
+            field = 'field-' + self.field_opt
+        elif self.tags_enabled and template == 'wiki_edit.html':
+            field = 'tags'
+        else:
+            return template, data, content_type
+        # In Trac 1.0 and later, jQuery-UI is included from the core.
+        if trac_version >= '1.0':
+            Chrome(self.env).add_jquery_ui(req)
+        else:
+            add_script(req, 'tags/js/jquery-ui-1.8.16.custom.min.js')
+            add_stylesheet(req, 'tags/css/jquery-ui-1.8.16.custom.css')
+        opts = {'field': '#' + field, 'url': req.href.tags('api', 'complete'),
+                'min_length': self.min_length_opt,
+                'separator': self.separator}
+        # Turn keywords field label into link to an arbitrary resource.
+        if template == 'ticket.html' and self.help_opt:
+            opts.update(help_href=self._get_help_link(req),
+                        help_new_window=self.helpnewwindow_opt,
+                        help_label='label[for="field-keywords"]')
+        add_script_data(req, tags_autocomplete=opts)
+        add_script(req, 'tags/js/autocomplete.js')
         return template, data, content_type
 
-    # ITemplateStreamFilter method
-    def filter_stream(self, req, method, filename, stream, data):
-
-        if not (filename == 'ticket.html' or
-                (self.tags_enabled and filename == 'wiki_edit.html')):
-            return stream
-
-        keywords = self._get_keywords_string(req)
-        if not keywords:
-            self.log.debug(
-                "No keywords found. TagInputAutoComplete is disabled.")
-            return stream
-
-        matchfromstart = '"^" +'
-        if self.matchcontains_opt:
-            matchfromstart = ''
-
-        js = """
-            jQuery(document).ready(function($) {
-                var keywords = [ %(keywords)s ]
-                var sep = '%(separator)s'.trim() + ' '
-                function split( val ) {
-                    return val.split( /%(separator)s\s*|\s+/ );
-                }
-                function extractLast( term ) {
-                    return split( term ).pop();
-                }
-                $('%(field)s')
-                    // don't navigate away from field on tab when selecting
-                    // an item
-                    .bind( "keydown", function( event ) {
-                        if ( event.keyCode === $.ui.keyCode.TAB &&
-                             $( this ).data( "autocomplete" ).menu.active ) {
-                            event.preventDefault();
-                        }
-                    })
-                    .autocomplete({
-                        delay: 0,
-                        minLength: 0,
-                        source: function( request, response ) {
-                            // delegate back to autocomplete, but extract
-                            // the last term
-                            response( $.ui.autocomplete.filter(
-                                keywords, extractLast( request.term ) ) );
-                        },
-                        focus: function() {
-                            // prevent value inserted on focus
-                            return false;
-                        },
-                        select: function( event, ui ) {
-                            var terms = split( this.value );
-                            // remove the current input
-                            terms.pop();
-                            // add the selected item
-                            terms.push( ui.item.value );
-                            // add placeholder to get the comma-and-space at
-                            // the end
-                            terms.push( "" );
-                            this.value = terms.join( sep );
-                            return false;
-                        }
-                    });
-            });"""
-
-        # Inject transient part of JavaScript into ticket.html template.
-        if req.path_info.startswith('/ticket/') or \
-           req.path_info.startswith('/newticket'):
-            js_ticket = js % {'field': '#field-' + self.field_opt,
-                              'keywords': keywords,
-                              'matchfromstart': matchfromstart,
-                              'separator': self.separator}
-            stream = stream | Transformer('.//head')\
-                              .append(builder.script(Markup(js_ticket),
-                                      type='text/javascript'))
-
-            # Turn keywords field label into link to an arbitrary resource.
-            if self.help_opt:
-                link = self._get_help_link(req)
-                if self.helpnewwindow_opt:
-                    link = builder.a(href=link, target='blank')
-                else:
-                    link = builder.a(href=link)
-                xpath = '//label[@for="field-keywords"]/text()'
-                stream = stream | Transformer(xpath).wrap(link)
-
-        # Inject transient part of JavaScript into wiki.html template.
-        elif self.tags_enabled and req.path_info.startswith('/wiki/'):
-            js_wiki = js % {'field': '#tags',
-                            'keywords': keywords,
-                            'matchfromstart': matchfromstart,
-                            'separator': self.separator}
-            stream = stream | Transformer('.//head')\
-                              .append(builder.script(Markup(js_wiki),
-                                                     type='text/javascript'))
-        return stream
+    # IRequestHandler methods
 
-    # Private methods
+    def match_request(self, req):
+        return req.path_info == '/tags/api/complete'
 
-    def _get_keywords_string(self, req):
-        keywords = set(self.sticky_tags_opt)  # prevent duplicates
+    def process_request(self, req):
+        term = req.args.get('q', '').strip()
+        limit = as_int(req.args.get('limit'), self.max_results_opt,
+                       min=1, max=self.max_results_opt)
         if self.tags_enabled:
-            # Use TagsPlugin >= 0.7 performance-enhanced API.
-            tags = TagSystem(self.env).get_all_tags(req)
-            keywords.update(tags.keys())
-
-        if keywords:
-            keywords = sorted(keywords)
-            keywords = ','.join(("'%s'" % javascript_quote(_keyword)
-                                 for _keyword in keywords))
+            req.perm.require('TAGS_VIEW')
+            tag_system = TagSystem(self.env)
+            realms = tag_system.get_taggable_realms(req.perm, req)
+            generation = tags_generation(self.env)
+            recent = tag_system.get_recent_tags(req)
         else:
-            keywords = ''
+            realms = generation = recent = None
+        # Revalidate responses cached by the browser with the tag generation.
+        req.check_modified(datetime.fromtimestamp(0, utc),
+                           [term, limit, sorted(realms or ()), generation,
+                            recent, self.sticky_tags_opt,
+                            self.matchcontains_opt])
+        req.send(to_json(self._get_completions(req, term, limit)),
+                 'application/json')
+
+    # Private methods
 
-        return keywords
+    def _get_completions(self, req, term, limit=None):
+        """Return tags starting with or, if configured, containing a term.
+
+        Matches are ranked by prefix matches, tags recently applied by the
+        user and sticky tags first, then by descending tag frequency.
+        """
+        tags = {}
+        recent = []
+        if self.tags_enabled:
+            tag_system = TagSystem(self.env)
+            tags = dict(tag_system.complete_tags(req, term, limit,
+                                                 self.matchcontains_opt))
+            recent = tag_system.get_recent_tags(req)
+        term = term.lower()
+
+        def matches(tag):
+            return tag.lower().startswith(term) or \
+                   self.matchcontains_opt and term in tag.lower()
+        sticky = set(filter(matches, self.sticky_tags_opt))
+        recent = dict((tag, idx) for idx, tag in enumerate(recent)
+                      if matches(tag))
+
+        def rank(tag):
+            return (not tag.lower().startswith(term),
+                    tag not in recent, recent.get(tag), tag not in sticky,
+                    -tags.get(tag, 0), tag)
+        return sorted(sticky.union(recent, tags), key=rank)[:limit]
 
     def _get_help_link(self, req):
         link = resource_id = None
@@ -253,12 +215,36 @@ class TagInputAutoComplete(TagTemplateProvider):
 
 
 class TagRequestHandler(TagTemplateProvider):
-    """[main] Implements the /tags handler."""
+    """[main] Implements the /tags handler.
+
+    Besides the tag cloud and tag query pages, it serves a JSON API below
+    `/tags/api/`:
+
+     `query?q=<expr>[&limit=<n>][&after=<cursor>][&fields=id|tags]`:: a page
+     of matching resources as `{"next": <cursor>, "results": [...]}`, with
+     `next` being `null` on the last page
+     `count?q=<expr>`:: the number of matching resources
+     `cloud[?q=<expr>][&mincount=<n>]`:: tag frequencies of all, or of
+     matching, resources
+     `tags/<realm>/<id>`:: tags of a resource
+
+    Query results may be restricted to realms by `realm` arguments.
+
+    Results of `ListTagged` macro calls with `async=true` are loaded from
+    `/tags/api/listtagged?q=<macro arguments>` as HTML fragment.
+    """
 
     implements(INavigationContributor, IRequestHandler)
 
+    api_max_results = IntOption('tags', 'api_max_results', 1000,
+        doc="""Maximum number of resources returned per request by the
+            JSON query API.""")
     cloud_mincount = Option('tags', 'cloud_mincount', 1,
         doc="""Integer threshold to hide tags with smaller count.""")
+    cloud_max_tags = IntOption('tags', 'cloud_max_tags', 0,
+        doc="""Maximum number of most frequent tags to show in the cloud
+            of the `/tags` page, with a link to show all tags. `0` shows
+            all tags.""")
     default_cols = Option('tags', 'default_table_cols', 'id|description|tags',
         doc="""Select columns and order for table format using a "|"-separated
             list of column names.
@@ -291,10 +277,15 @@ class TagRequestHandler(TagTemplateProvider):
 
     # IRequestHandler methods
     def match_request(self, req):
-        return req.path_info.startswith('/tags')
+        return req.path_info.startswith('/tags') and \
+               req.path_info != '/tags/api/complete'
 
     def process_request(self, req):
         req.perm.require('TAGS_VIEW')
+        if req.path_info == '/tags/api/listtagged':
+            self._process_fragment_request(req)
+        elif req.path_info.startswith('/tags/api/'):
+            self._process_api_request(req)
 
         match = re.match(r'/tags/?(.*)', req.path_info)
         tag_id = match.group(1) and match.group(1) or None
@@ -302,7 +293,7 @@ class TagRequestHandler(TagTemplateProvider):
 
         # Consider only providers, that are permitted for display.
         tag_system = TagSystem(self.env)
-        all_realms = tag_system.get_taggable_realms(req.perm)
+        all_realms = tag_system.get_taggable_realms(req.perm, req)
         if not (tag_id or query) or [r for r in all_realms
                                      if r in req.args] == []:
             for realm in all_realms:
@@ -333,6 +324,11 @@ class TagRequestHandler(TagTemplateProvider):
         if tag_id:
             data['tag_page'] = WikiPage(self.env,
                                         tag_system.wiki_page_prefix + tag_id)
+        # Answer conditional requests before expanding any macro.
+        self._check_modified(req, checked_realms,
+                             [tag_id, tag_id and data['tag_page'].version,
+                              self.default_format, self.default_cols,
+                              self.cloud_mincount, self.cloud_max_tags])
         if query or tag_id:
             macro = 'ListTagged'
             # TRANSLATOR: The meta-nav link label.
@@ -345,7 +341,11 @@ class TagRequestHandler(TagTemplateProvider):
             macro = 'TagCloud'
             mincount = as_int(req.args.get('mincount', None),
                               self.cloud_mincount)
-            args = mincount and "mincount=%s" % mincount or None
+            args = ','.join(arg for arg in
+                            (mincount and 'mincount=%s' % mincount,
+                             self.cloud_max_tags and
+                             'max_tags=%s' % self.cloud_max_tags) if arg) \
+                   or None
             data['mincount'] = mincount
         formatter = Formatter(self.env, web_context(req, Resource('tag')))
         self.env.log.debug("%s macro arguments: %s", macro,
@@ -363,26 +363,134 @@ class TagRequestHandler(TagTemplateProvider):
         add_stylesheet(req, 'tags/css/tractags.css')
         return 'tag_view.html', data, None
 
+    # Private methods
+
+    def _check_modified(self, req, realms, extra=[]):
+        """Answer a conditional request for tags or tagged resources of
+        realms with "304 Not Modified", if they are unchanged.
+        """
+        tag_system = TagSystem(self.env)
+        # Besides tags, listings show resource details and tags link to
+        #   wiki pages.
+        changed_realms = set(realms)
+        if tag_system.wiki_page_link:
+            changed_realms.add('wiki')
+        last_change = tag_system.get_last_change(changed_realms)
+        if last_change is not None:
+            req.check_modified(datetime.fromtimestamp(0, utc),
+                               [last_change,
+                                tag_system._get_permissions_signature(),
+                                sorted(req.args.items()),
+                                str(req.locale)] + extra)
+
+    def _process_fragment_request(self, req):
+        """Render results of an asynchronous `ListTagged` macro call."""
+        all_realms = TagSystem(self.env).get_taggable_realms(req.perm, req)
+        self._check_modified(req, all_realms)
+        formatter = Formatter(self.env, web_context(req, Resource('tag')))
+        fragment = TagWikiMacros(self.env).expand_macro(
+                       formatter, 'ListTagged', req.args.get('q', ''),
+                       fragment=True)
+        if isinstance(fragment, Stream):
+            fragment = fragment.render('xhtml', encoding=None)
+        req.send(to_unicode(fragment).encode('utf-8'), 'text/html')
+
+    def _process_api_request(self, req):
+        tag_system = TagSystem(self.env)
+        all_realms = tag_system.get_taggable_realms(req.perm, req)
+        method, sep, path = req.path_info[len('/tags/api/'):].partition('/')
+        query = req.args.get('q', '')
+        realms = req.args.getlist('realm')
+        req.check_modified(datetime.fromtimestamp(0, utc),
+                           [tag_system._get_permissions_signature(),
+                            req.path_info, sorted(req.args.items())])
+        try:
+            unknown = set(realms) - tag_system.get_taggable_realms()
+            if unknown:
+                raise InvalidTagRealm(_("Tags are not supported on the "
+                                        "'%s' realm") % unknown.pop())
+            if realms:
+                # Realms, that the user may not view, yield no results.
+                realm_query = ' or '.join('realm:%s' % r for r in realms)
+                if query:
+                    query = '(%s) (%s)' % (query, realm_query)
+                else:
+                    query = realm_query
+            if method == 'query' and not path:
+                self._send_api_query(req, query)
+            elif method == 'count' and not path:
+                data = {'count': tag_system.query_count(req, query)}
+            elif method == 'cloud' and not path:
+                mincount = as_int(req.args.get('mincount'), 1)
+                if req.args.get('q'):
+                    all_tags = tag_system.get_query_tags(req, query)
+                else:
+                    all_tags = tag_system.get_all_tags(req, realms,
+                                                       mincount=mincount)
+                data = {'tags': dict((tag, count)
+                                     for tag, count in all_tags.iteritems()
+                                     if count >= mincount)}
+            elif method == 'tags' and '/' in path:
+                realm, id = path.split('/', 1)
+                if realm not in all_realms:
+                    raise InvalidTagRealm(_("Tags are not supported on the "
+                                            "'%s' realm") % realm)
+                resource = Resource(realm, id)
+                data = {'realm': realm, 'id': id,
+                        'tags': sorted(tag_system.get_tags(req, resource))}
+            else:
+                self._send_api_error(req, 404, _("Unknown API method"))
+        except InvalidQuery, e:
+            self._send_api_error(req, 400, to_unicode(e))
+        except InvalidTagRealm, e:
+            self._send_api_error(req, 404, to_unicode(e))
+        req.send(to_json(data), 'application/json')
+
+    def _send_api_query(self, req, query):
+        """Stream a page of resources matching a query as JSON."""
+        limit = as_int(req.args.get('limit'), self.api_max_results,
+                       min=1, max=self.api_max_results)
+        after = req.args.get('after')
+        if after:
+            realm, sep, id = after.partition(':')
+            if not sep:
+                self._send_api_error(req, 400, _("Invalid cursor"))
+            after = (realm, id)
+        fields = set(req.args.get('fields', 'id|tags').split('|'))
+        if not fields <= set(['id', 'tags']):
+            self._send_api_error(req, 400, _("Invalid fields"))
+        results = TagSystem(self.env).query_page(req, query, limit + 1,
+                                                 after)
+        next = None
+        if len(results) > limit:
+            del results[limit:]
+            resource = results[-1][0]
+            next = u'%s:%s' % (resource.realm, resource.id)
+
+        def chunks():
+            yield '{"next":%s,"results":[' % to_json(next)
+            for idx, (resource, tags) in enumerate(results):
+                result = {'realm': resource.realm,
+                          'id': to_unicode(resource.id)}
+                if 'tags' in fields:
+                    result['tags'] = sorted(tags)
+                yield (idx and ',' or '') + to_json(result)
+            yield ']}'
+        req.send(chunks(), 'application/json')
+
+    def _send_api_error(self, req, status, message):
+        req.send(to_json({'error': message}), 'application/json', status)
+
 
 class TagTimelineEventFilter(TagTemplateProvider):
     """[opt] Filters timeline events by tags associated with listed resources
     mentioned in the event.
     """
 
-    implements(IRequestFilter, ITemplateStreamFilter)
+    implements(IRequestFilter)
 
     key = 'tag_query'
 
-    # ITemplateStreamFilter method
-    def filter_stream(self, req, method, filename, stream, data):
-        if req.path_info == '/timeline':
-            insert = builder(Markup('<br />'), tag_("matching tags "),
-                             builder.input(type='text', name=self.key,
-                                           value=data.get(self.key)))
-            xpath = '//form[@id="prefs"]/div[1]'
-            stream = stream | Transformer(xpath).append(insert)
-        return stream
-
     # IRequestFilter methods
 
     def pre_process_request(self, req, handler):
@@ -411,7 +519,7 @@ class TagTimelineEventFilter(TagTemplateProvider):
                 except InvalidQuery, e:
                     add_warning(req, _("Tag query syntax error: %s" % e))
                 else:
-                    all_realms = tag_system.get_taggable_realms(req.perm)
+                    all_realms = tag_system.get_taggable_realms(req.perm, req)
                     query_realms = set()
                     for m in REALM_RE.finditer(query.as_string()):
                         query_realms.add(m.group(1))
@@ -435,6 +543,10 @@ class TagTimelineEventFilter(TagTemplateProvider):
                 data[self.key] = query_str
             elif self.key in req.session:
                 del req.session[self.key]
+            add_script_data(req, tags_timeline={
+                'key': self.key, 'value': query_str or '',
+                'label': _("matching tags ")})
+            add_script(req, 'tags/js/timeline.js')
         return template, data, content_type
 
 
@@ -13,12 +13,12 @@ from __future__ import with_statement
 import re
 
 from genshi.builder import Fragment, Markup, tag
-from genshi.filters.transform import Transformer
 
 from trac.config import BoolOption
 from trac.core import Component, implements
 from trac.resource import Resource, render_resource_link, get_resource_url
 from trac.util.datefmt import to_utimestamp
+from trac.util.text import to_unicode
 from trac.web.api import IRequestFilter, ITemplateStreamFilter
 from trac.web.chrome import add_stylesheet, web_context
 from trac.wiki.api import IWikiChangeListener, IWikiPageManipulator
@@ -28,11 +28,15 @@ from trac.wiki.model import WikiPage
 from trac.wiki.parser import WikiParser
 from trac.wiki.web_ui import WikiModule
 
-from tractags.api import Counter, DefaultTagProvider, TagSystem, _, requests
+from tractags.api import DefaultTagProvider, TagSystem, _, requests
 from tractags.macros import TagTemplateProvider
-from tractags.model import delete_tags, tag_changes
+from tractags.model import delete_resource_descriptions, delete_tags
+from tractags.model import resource_descriptions, resource_tags
+from tractags.model import set_resource_descriptions
+from tractags.model import tag_changes
 from tractags.web_ui import render_tag_changes
-from tractags.util import MockReq, query_realms, split_into_tags
+from tractags.util import MockReq, element_filter, query_realms
+from tractags.util import split_into_tags
 
 
 class WikiTagProvider(DefaultTagProvider):
@@ -51,35 +55,137 @@ class WikiTagProvider(DefaultTagProvider):
         return super(WikiTagProvider, self).check_permission(perm, action) \
             and map[action] in perm
 
+    def permitted_resources(self, req, resources, action):
+        if not super(WikiTagProvider, self).check_permission(req.perm,
+                                                             action):
+            return []
+        map = {'view': 'WIKI_VIEW', 'modify': 'WIKI_MODIFY'}
+        return TagSystem(self.env).permitted_resources(req, resources,
+                                                       map[action])
+
     def get_tagged_resources(self, req, tags=None, filter=None):
-        if self.exclude_templates:
-            with self.env.db_query as db:
-                like_templates = ''.join(
-                    ["'", db.like_escape(WikiModule.PAGE_TEMPLATES_PREFIX),
-                     "%%'"])
-                filter = (' '.join(['name NOT', db.like() % like_templates]),)
         return super(WikiTagProvider, self).get_tagged_resources(req, tags,
-                                                                 filter)
+                                                self._get_filter(filter))
 
-    def get_all_tags(self, req, filter=None):
-        if not self.check_permission(req.perm, 'view'):
-            return Counter()
+    def get_last_change(self):
+        for time, in self.env.db_query("SELECT MAX(time) FROM wiki"):
+            return time or 0
+
+    def get_sorted_tagged_resources(self, req, tags=None, filter=None,
+                                    start=None):
+        return super(WikiTagProvider, self).get_sorted_tagged_resources(req,
+                                        tags, self._get_filter(filter), start)
+
+    def count_tagged_resources(self, req, filter=None):
+        return super(WikiTagProvider, self).count_tagged_resources(req,
+                                                self._get_filter(filter))
+
+    def has_tagged_resources(self, req, filter=None):
+        return super(WikiTagProvider, self).has_tagged_resources(req,
+                                                self._get_filter(filter))
+
+    def describe_tagged_resource(self, req, resource):
+        if not self.check_permission(req.perm(resource), 'view'):
+            return ''
+        name = to_unicode(resource.id)
+        return self._get_descriptions([name]).get(name, '')
+
+    def describe_tagged_resources(self, req, resources):
+        if self.fast_permcheck:
+            if not self.check_permission(req.perm(self.realm), 'view'):
+                return dict((resource.id, '') for resource in resources)
+            names = [to_unicode(resource.id) for resource in resources]
+        else:
+            names = [to_unicode(resource.id) for resource in resources
+                     if self.check_permission(req.perm(resource), 'view')]
+        page_descriptions = self._get_descriptions(names)
+        return dict((resource.id,
+                     page_descriptions.get(to_unicode(resource.id), ''))
+                    for resource in resources)
+
+    def update_description(self, page):
+        """Store the description of a tagged wiki page after changes.
+
+        The db is written only, if the description actually changed.
+        """
+        stored = resource_descriptions(self.env, self.realm,
+                                       [page.name]).get(page.name)
+        if iter_is_empty(resource_tags(self.env, page.resource)):
+            if stored is not None:
+                delete_resource_descriptions(self.env, self.realm,
+                                             [page.name])
+        else:
+            description = self._describe_text(page.text)
+            if description != stored:
+                set_resource_descriptions(self.env, self.realm,
+                                          {page.name: description})
+
+    def purge_page(self, page):
+        """Remove all records on a deleted wiki page."""
+        generation = delete_tags(self.env, page.resource, purge=True)
+        self._tags_changed(page.resource, set(), generation)
+        delete_resource_descriptions(self.env, self.realm, [page.name])
+
+    def sync_descriptions(self):
+        """Recompute stored descriptions of all tagged wiki pages.
+
+        Returns the number of stored descriptions.
+        """
+        delete_resource_descriptions(self.env, self.realm)
+        names = [name for name, in self.env.db_query("""
+            SELECT DISTINCT name FROM tags WHERE tagspace=%s
+            """, (self.realm,))]
+        return len(self._get_descriptions(names, store=True))
+
+    # Internal methods
+
+    def _describe_text(self, text):
+        ret = self.first_head.search(text)
+        return ret and ret.group(1) or ''
+
+    def _get_descriptions(self, names, batch=100, store=False):
+        """Return descriptions of existing pages by name.
+
+        Descriptions are looked up in the `tags_meta` db table, and computed
+        from latest page text, if missing there.  Computed descriptions are
+        only stored on request, so that reads don't write to the db.
+        """
+        descriptions = {}
+        for offset in xrange(0, len(names), batch):
+            chunk = names[offset:offset + batch]
+            descriptions.update(resource_descriptions(self.env, self.realm,
+                                                      chunk))
+            missing = [name for name in chunk if name not in descriptions]
+            if not missing:
+                continue
+            computed = {}
+            for name, text in self.env.db_query("""
+                    SELECT w.name, w.text FROM wiki AS w
+                    WHERE w.name IN (%s) AND w.version=(
+                        SELECT MAX(version) FROM wiki WHERE name=w.name)
+                    """ % ','.join(['%s'] * len(missing)), missing):
+                computed[name] = self._describe_text(text)
+            if store:
+                set_resource_descriptions(self.env, self.realm, computed)
+            descriptions.update(computed)
+        return descriptions
+
+    def _get_filter(self, filter=None):
+        """Add exclusion of wiki page templates to resource conditions."""
+        filter = list(filter or [])
         if self.exclude_templates:
-            with self.env.db_transaction as db:
+            with self.env.db_query as db:
                 like_templates = ''.join(
                     ["'", db.like_escape(WikiModule.PAGE_TEMPLATES_PREFIX),
                      "%%'"])
-                filter = (' '.join(['name NOT', db.like() % like_templates]),)
-        return super(WikiTagProvider, self).get_all_tags(req, filter)
+                filter.append(' '.join(['name NOT',
+                                        db.like() % like_templates]))
+        return filter
 
-    def describe_tagged_resource(self, req, resource):
-        if not self.check_permission(req.perm(resource), 'view'):
-            return ''
-        page = WikiPage(self.env, resource.id)
-        if page.exists:
-            ret = self.first_head.search(page.text)
-            return ret and ret.group(1) or ''
-        return ''
+    def _get_all_tags_filter(self, req, filter=None):
+        if not self.check_permission(req.perm, 'view'):
+            return None
+        return self._get_filter(filter)
 
 
 class WikiTagInterface(TagTemplateProvider):
@@ -122,7 +228,7 @@ class WikiTagInterface(TagTemplateProvider):
             return self._wiki_edit(req, stream)
         elif filename == 'history_view.html' and \
                          'TAGS_VIEW' in req.perm(resource):
-            return self._wiki_history(req, stream)
+            return self._wiki_history(req, stream, data)
         return stream
 
     # IWikiPageManipulator methods
@@ -151,11 +257,13 @@ class WikiTagInterface(TagTemplateProvider):
         req = requests.get()
         if req:
             self._update_tags(req, page, page.time)
+        WikiTagProvider(self.env).update_description(page)
 
     def wiki_page_changed(self, page, version, t, comment, author, ipnr):
         req = requests.get()
         if req:
             self._update_tags(req, page, page.time)
+        WikiTagProvider(self.env).update_description(page)
 
     def wiki_page_renamed(self, page, old_name):
         """Called when a page has been renamed (since Trac 0.12)."""
@@ -164,13 +272,16 @@ class WikiTagInterface(TagTemplateProvider):
         req = MockReq()
         self.tag_system.reparent_tags(req, Resource('wiki', page.name),
                                       old_name)
+        delete_resource_descriptions(self.env, 'wiki', [old_name])
+        WikiTagProvider(self.env).update_description(page)
 
     def wiki_page_deleted(self, page):
         # Page gone, so remove all records on it.
-        delete_tags(self.env, page.resource, purge=True)
+        WikiTagProvider(self.env).purge_page(page)
 
     def wiki_page_version_deleted(self, page):
-        pass
+        # Latest version might be gone, refresh description.
+        WikiTagProvider(self.env).update_description(page)
 
     # Internal methods
     def _page_tags(self, req):
@@ -247,8 +358,7 @@ class WikiTagInterface(TagTemplateProvider):
 
         # TRANSLATOR: Header label text for tag list at wiki page bottom.
         insert = tag.ul(class_='tags')(tag.li(_("Tags"), class_='header'), li)
-        return stream | (Transformer('//div[contains(@class,"wikipage")]')
-                         .after(insert))
+        return stream | element_filter(_is_wikipage, insert, after=True)
 
     def _update_tags(self, req, page, when=None):
         newtags = split_into_tags(req.args.get('tags', ''))
@@ -270,14 +380,14 @@ class WikiTagInterface(TagTemplateProvider):
                 value=req.args.get('tags', ' '.join(self._page_tags(req))))
         )
         insert = tag.div(tag.label(insert), class_='field')
-        return stream | Transformer('//div[@id="changeinfo1"]').append(insert)
+        return stream | element_filter(_is_changeinfo, insert)
 
-    def _wiki_history(self, req, stream):
-        xpath = '//input[@type="radio" and @value="*"]'
-        stream = stream | Transformer(xpath).remove()
-        # Remove invalid links to wiki page revisions (fix for Trac < 0.12).
-        xpath = '//a[contains(@href,"%2A")]'
-        return stream | Transformer(xpath).remove()
+    def _wiki_history(self, req, stream, data):
+        # Tag changes can't be selected for diffs, so drop their radios.
+        if not any(entry.get('version') == '*'
+                   for entry in data.get('history') or ()):
+            return stream
+        return stream | element_filter(_is_tags_version_radio)
 
     def _wiki_to_oneliner(self, context, wiki, shorten=None):
         if isinstance(wiki, Fragment):
@@ -285,6 +395,19 @@ class WikiTagInterface(TagTemplateProvider):
         return format_to_oneliner(self.env, context, wiki, shorten=shorten)
 
 
+def _is_wikipage(name, attrs):
+    return name == 'div' and 'wikipage' in (attrs.get('class') or '').split()
+
+
+def _is_changeinfo(name, attrs):
+    return name == 'div' and attrs.get('id') == 'changeinfo1'
+
+
+def _is_tags_version_radio(name, attrs):
+    return name == 'input' and attrs.get('type') == 'radio' and \
+           attrs.get('value') == '*'
+
+
 class TagWikiSyntaxProvider(Component):
     """[opt] Provides tag:<expr> links.
 
@@ -338,7 +461,8 @@ class TagWikiSyntaxProvider(Component):
 
         query = target
         # Pop realms from query expression.
-        all_realms = self.tag_system.get_taggable_realms(formatter.perm)
+        all_realms = self.tag_system.get_taggable_realms(formatter.perm,
+                                                         formatter.req)
         realms = query_realms(target, all_realms)
         if realms:
             kwargs = dict((realm, 'on') for realm in realms)
@@ -355,8 +479,7 @@ class TagWikiSyntaxProvider(Component):
         href = self.tag_system.get_resource_url(tag_res, context.href, kwargs)
         if all_realms and (
                 target in self.tag_system.get_all_tags(formatter.req) or
-                not iter_is_empty(self.tag_system.query(formatter.req,
-                                                        query))):
+                self.tag_system.query_exists(formatter.req, query)):
             # At least one tag provider is available and tag exists or
             # tags query yields at least one match.
             if label:
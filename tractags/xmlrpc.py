@@ -36,6 +36,8 @@ class TagRPC(Component):
         yield (None, ((list, str),), self.splitIntoTags)
         yield ('TAGS_VIEW', ((list,),), self.getTaggableRealms)
         yield ('TAGS_VIEW', ((dict,), (dict, list)), self.getAllTags)
+        yield ('TAGS_VIEW', ((list, str), (list, str, int)),
+               self.completeTags)
         yield ('TAGS_VIEW', ((list, str, str),), self.getTags)
         yield ('TAGS_VIEW', ((list, str),), self.query)
         yield ('TAGS_MODIFY', ((list, str, str, list),
@@ -57,6 +59,13 @@ class TagRPC(Component):
         self.tag_system.set_tags(req, resource, tags, comment)
         return self._get_tags(req, resource)
 
+    def completeTags(self, req, term, limit=20):
+        """Returns a list of tags starting with or containing the supplied
+        term, most frequent tags and tags starting with it first.
+        """
+        return [tag for tag, count in
+                self.tag_system.complete_tags(req, term, limit, True)]
+
     def getAllTags(self, req, realms=[]):
         """Returns a dict of all tags as keys and occurrences as values.
 